@@ -0,0 +1,232 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+
+"""asyncio front end of the scanning and ingestion tasks.
+
+Nothing here blocks the event loop: directory listing and hashing run in
+worker threads through `fs.hash_files`, and every SQLite call runs in the
+single thread owned by an `AsyncWriter`.
+"""
+from collections.abc import AsyncIterator, Callable
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import contextlib
+import functools
+import threading
+
+import pynder.db as dbu
+import pynder.fs as fs
+import pynder.task as task
+
+_DONE = object()
+_CLOSE = object()
+
+
+async def scan(path: str, workers: int=None, max_queued: int=256,
+               progress: Callable[[fs.ScanStats], None]=None,
+               cache: Callable[[fs.FileSignature], str | None]=None, **walk_options) -> AsyncIterator[fs.HashResult]:
+    """Asynchronously yields the hash of every file under `path`.
+
+    The walk and the hashing pool of `fs.hash_files` run in a background
+    thread feeding a queue of at most `max_queued` results, so a slow
+    consumer pauses the scan instead of buffering it. Cancelling the
+    consuming task, or leaving the `async for` early (with
+    `contextlib.aclosing`), stops the walk and the pool.
+
+    Args:
+        path (str): The directory to scan.
+        workers (int, optional): Number of hashing workers. Defaults to None (CPU count).
+        max_queued (int, optional): Results buffered ahead of the consumer. Defaults to 256.
+        progress (Callable, optional): Called with the `fs.ScanStats` after each result.
+        cache (Callable, optional): Stat cache lookup forwarded to `fs.hash_files`, called
+            from a worker thread. Defaults to None.
+        **walk_options: Filters forwarded to `fs.walk_files`.
+
+    Yields:
+        fs.HashResult: The result of each file, in completion order.
+    """
+    loop = asyncio.get_running_loop()
+    results = asyncio.Queue(maxsize=max_queued)
+    stop = threading.Event()
+    stats = fs.ScanStats()
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(results.put(item), loop).result()
+
+    def produce():
+        try:
+            hashes = fs.hash_files(fs.iter_files(path, **walk_options), workers=workers, stats=stats, cache=cache)
+            try:
+                for result in hashes:
+                    if stop.is_set():
+                        return
+                    put(result)
+            finally:
+                hashes.close()
+            item = _DONE
+        except BaseException as e:
+            item = e
+        if not stop.is_set():
+            put(item)
+
+    producer = loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item = await results.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+            if progress:
+                progress(stats)
+    finally:
+        stop.set()
+        # Unblock a producer waiting on a full queue, then wait for it to wind down
+        while not producer.done():
+            while not results.empty():
+                results.get_nowait()
+            await asyncio.wait({producer}, timeout=0.05)
+
+
+def _open(path: str, profile: str):
+    from pynder.pynder import open_or_create_db
+    return open_or_create_db(path, profile=profile)
+
+
+class AsyncWriter:
+    """Owns a SQLite connection used from a single dedicated thread.
+
+    Coroutines run arbitrary `db` functions through `call`, while `add`
+    queues `(repository, md5, path)` rows that a background task writes
+    with `db.add_files`, grouping whatever is queued up to `batch_size`
+    rows per transaction. Use it as an async context manager: leaving it
+    writes the rows still queued and closes the connection.
+
+    If a write fails the background task stops, and the next `add` or
+    `close` raises its exception instead of waiting for room in the queue.
+    """
+
+    def __init__(self, path: str, profile: str="bulk-ingest", batch_size: int=dbu.DEFAULT_BATCH_SIZE,
+                 max_queued: int=dbu.DEFAULT_BATCH_SIZE * 2):
+        self.path = path
+        self.profile = profile
+        self.batch_size = batch_size
+        self.db = None
+        self.added = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pynder-writer")
+        self._queue = asyncio.Queue(maxsize=max_queued)
+        self._task = None
+
+    async def open(self) -> "AsyncWriter":
+        loop = asyncio.get_running_loop()
+        self.db = await loop.run_in_executor(self._executor, _open, self.path, self.profile)
+        self._task = asyncio.create_task(self._drain())
+        return self
+
+    async def call(self, function: Callable, *args, **kwargs):
+        """Runs `function(db, *args, **kwargs)` in the writer thread."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(function, self.db, *args, **kwargs))
+
+    def _check_writer(self):
+        """Raises the exception that stopped the background task, if any."""
+        if self._task is not None and self._task.done() and not self._task.cancelled():
+            error = self._task.exception()
+            if error is not None:
+                raise error
+
+    async def _put(self, item):
+        self._check_writer()
+        if not self._queue.full():
+            self._queue.put_nowait(item)
+            return
+        # Waits for room in the queue, or for the task that makes it to fail
+        put = asyncio.ensure_future(self._queue.put(item))
+        done, _ = await asyncio.wait({put, self._task}, return_when=asyncio.FIRST_COMPLETED)
+        if put not in done:
+            put.cancel()
+            self._check_writer()
+
+    async def add(self, repository: int, md5: str, path: str):
+        await self._put((repository, md5, path))
+
+    async def _drain(self):
+        closing = False
+        while not closing:
+            item = await self._queue.get()
+            batch = []
+            while True:
+                if item is _CLOSE:
+                    closing = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size or self._queue.empty():
+                    break
+                item = self._queue.get_nowait()
+            by_repository = {}
+            for repository, md5, path in batch:
+                by_repository.setdefault(repository, []).append((md5, path))
+            for repository, rows in by_repository.items():
+                self.added += await self.call(dbu.add_files, rows, repository=repository, batch_size=self.batch_size)
+
+    async def close(self):
+        try:
+            if self._task is not None:
+                await self._put(_CLOSE)
+                await self._task
+        finally:
+            self._task = None
+            if self.db is not None:
+                await self.call(lambda db: db.close())
+                self.db = None
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self) -> "AsyncWriter":
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+async def add_repo_async(db_path: str, path: str, desc: str, allow_duplicate: bool=False, workers: int=None,
+                         batch_size: int=dbu.DEFAULT_BATCH_SIZE,
+                         progress: Callable[[fs.ScanStats], None]=None) -> int | None:
+    """Adds a repository and its files without blocking the event loop.
+
+    Same as `task.add_repo` followed by a scan of `path` whose files are
+    linked to the new repository. Cancelling the task stops the scan, the
+    files hashed so far are still written.
+
+    Args:
+        db_path (str): The path of the database file.
+        path (str): The path of the repository to add.
+        desc (str): The description of the repository.
+        allow_duplicate (bool, optional): Whether or not inserts if path already exists. Defaults to `False`.
+        workers (int, optional): Number of hashing workers. Defaults to None (CPU count).
+        batch_size (int, optional): Files written per transaction. Defaults to `db.DEFAULT_BATCH_SIZE`.
+        progress (Callable, optional): Called with the `fs.ScanStats` after each file.
+
+    Returns:
+        int | None: The id of the newly added repository, `None` if nothing is added.
+    """
+    async with AsyncWriter(db_path, batch_size=batch_size) as writer:
+        repository = await writer.call(task.add_repo, path, desc, allow_duplicate)
+        if repository is None:
+            return None
+        async with contextlib.aclosing(scan(path, workers=workers, progress=progress)) as results:
+            async for result in results:
+                await writer.add(repository, result.digest, result.path)
+    return repository
@@ -0,0 +1,158 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+
+"""A Bloom filter of the hashes already in the 'file' table.
+
+Ingestion asks the filter before asking SQLite: a negative answer is
+certain and skips the query, a positive one is confirmed by the DB. With
+the default false positive rate the filter takes about 1.2 bytes per
+hash, so tens of millions of files fit in a few tens of MB.
+
+The `db` write functions taking a `known` filter add the hashes they
+write to it and count the 'file' rows they insert. The filter can then be
+saved next to the DB and loaded at startup instead of being rebuilt from
+the 'file' table: rows of 'file' are never deleted, so a filter that
+accounts for as many rows as the table holds is current. Writes made
+without the filter (or by another process) leave it behind and the next
+load rebuilds it.
+"""
+import hashlib
+import math
+import os
+import sqlite3
+import struct
+
+import pynder.db as dbu
+
+# Fraction of unknown hashes reported as known when the filter is full
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+
+# Hashes the filter is sized for beyond those in the DB when built
+DEFAULT_HEADROOM = 1 << 20
+
+_HEADER = struct.Struct("<4sQIQQQ")
+_MAGIC = b"PYBF"
+
+
+class BloomFilter:
+    """A fixed size Bloom filter of strings using double hashing."""
+
+    def __init__(self, capacity: int, false_positive_rate: float=DEFAULT_FALSE_POSITIVE_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(64, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.capacity = capacity
+        self.count = 0
+        # Rows of the 'file' table accounted for by the filter
+        self.rows = 0
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key: str):
+        bits = self.bits
+        new = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                new = True
+        # Keys already present are not counted again, so `count` never exceeds the distinct keys
+        if new:
+            self.count += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key: str) -> bool:
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def full(self) -> bool:
+        """Whether more hashes than the filter was sized for have been added."""
+        return self.count > self.capacity
+
+    def save(self, path: str):
+        """Writes the filter to `path`, atomically replacing an older snapshot."""
+        temp = f"{path}.tmp"
+        with open(temp, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, self.size, self.hashes, self.capacity, self.count, self.rows))
+            f.write(self.bits)
+        os.replace(temp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BloomFilter":
+        """Reads a filter written by `save`, raising `ValueError` if the file is not one."""
+        with open(path, "rb") as f:
+            header = f.read(_HEADER.size)
+            if len(header) != _HEADER.size:
+                raise ValueError(f"Not a Bloom filter snapshot: {path}")
+            magic, size, hashes, capacity, count, rows = _HEADER.unpack(header)
+            bits = bytearray(f.read())
+        if magic != _MAGIC or len(bits) != (size + 7) // 8:
+            raise ValueError(f"Not a Bloom filter snapshot: {path}")
+        bloom = cls.__new__(cls)
+        bloom.size, bloom.hashes, bloom.capacity, bloom.count, bloom.rows = size, hashes, capacity, count, rows
+        bloom.bits = bits
+        return bloom
+
+
+def from_db(db: sqlite3.Connection, headroom: int=DEFAULT_HEADROOM,
+            false_positive_rate: float=DEFAULT_FALSE_POSITIVE_RATE) -> BloomFilter:
+    """Builds a filter of every md5 in the 'file' table, with room for `headroom` more."""
+    total = db.execute("SELECT count(*) FROM file;").fetchone()[0]
+    bloom = BloomFilter(total + headroom, false_positive_rate)
+    bloom.rows = total
+    bloom.update(dbu.iter_of_files(db))
+    return bloom
+
+
+def known_hashes(db: sqlite3.Connection, snapshot: str=None, headroom: int=DEFAULT_HEADROOM) -> BloomFilter:
+    """Returns the filter of the hashes in the DB, from `snapshot` when it is current.
+
+    The snapshot is used if it accounts for as many rows as the 'file'
+    table holds and still has room for new hashes, otherwise the filter
+    is rebuilt from the DB and the snapshot rewritten.
+
+    Args:
+        db (sqlite3.Connection): The DB whose hashes are loaded.
+        snapshot (str, optional): The path of the snapshot file. Defaults to None (always rebuild).
+        headroom (int, optional): Room for new hashes when rebuilding. Defaults to `DEFAULT_HEADROOM`.
+
+    Returns:
+        BloomFilter: The filter, to be kept up to date by passing it to the `db` write functions.
+    """
+    if snapshot is not None and os.path.exists(snapshot):
+        try:
+            bloom = BloomFilter.load(snapshot)
+        except (OSError, ValueError):
+            bloom = None
+        total = db.execute("SELECT count(*) FROM file;").fetchone()[0]
+        if bloom is not None and bloom.rows == total and not bloom.full:
+            return bloom
+    bloom = from_db(db, headroom)
+    if snapshot is not None:
+        bloom.save(snapshot)
+    return bloom
@@ -0,0 +1,439 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+
+"""Non-interactive command line interface, run with `python -m pynder`.
+
+Every command writes its records to stdout as tab separated text (the
+default), a single JSON array (`--format json`) or one JSON object per
+line as soon as it is available (`--format ndjson`). Errors go to stderr
+and set the exit code.
+
+Only `argparse` is imported up front: each command imports the modules
+it needs, so that listings do not pay for the hashing and scanning code.
+"""
+from collections.abc import Iterable, Iterator
+import argparse
+import os
+import sys
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_USAGE = 2
+EXIT_INTERRUPTED = 130
+
+DEFAULT_DB = os.path.join("~", ".pynder.sqlite")
+
+
+class CommandError(Exception):
+    """A failure reported to the user as a message and `EXIT_ERROR`."""
+
+
+def _db_path(args: argparse.Namespace) -> str:
+    return os.path.expanduser(args.db)
+
+
+def _open_read(args: argparse.Namespace):
+    import pynder.db as dbu
+    path = _db_path(args)
+    if not os.path.exists(path):
+        raise CommandError(f"Database not found: {path}")
+    return dbu.connect(path, "read-only")
+
+
+def _open_write(args: argparse.Namespace):
+    from pynder.pynder import open_or_create_db
+    return open_or_create_db(_db_path(args), profile="bulk-ingest")
+
+
+def _emit(args: argparse.Namespace, records: Iterable[dict], out=None) -> int:
+    """Writes `records` in the selected format, returns how many were written."""
+    out = out or sys.stdout
+    count = 0
+    if args.format == "json":
+        import json
+        records = list(records)
+        json.dump(records, out, indent=2)
+        out.write("\n")
+        return len(records)
+    if args.format == "ndjson":
+        import json
+        for record in records:
+            out.write(json.dumps(record))
+            out.write("\n")
+            out.flush()
+            count += 1
+        return count
+    for record in records:
+        out.write("\t".join("" if value is None else str(value) for value in record.values()))
+        out.write("\n")
+        count += 1
+    return count
+
+
+def _stats_record(stats) -> dict:
+    for path in stats.skipped:
+        print(f"pynder: skipped unreadable path {path}", file=sys.stderr)
+    return {
+        "files": stats.files,
+        "cached": stats.cached,
+        "bytes": stats.bytes,
+        "seconds": round(stats.seconds, 3),
+        "skipped": len(stats.skipped),
+    }
+
+
+def _progress(args: argparse.Namespace):
+    """Returns the callback printing the progress of resumable scans on stderr, if asked to."""
+    if not args.progress:
+        return None
+    return lambda progress: print(progress, file=sys.stderr, flush=True)
+
+
+def cmd_scan(args: argparse.Namespace) -> int:
+    from pynder.bloom import known_hashes
+    import pynder.task as task
+    path = os.path.abspath(args.path)
+    if not os.path.isdir(path):
+        raise CommandError(f"Not a directory: {path}")
+    db = _open_write(args)
+    try:
+        snapshot = f"{_db_path(args)}.bloom"
+        known = known_hashes(db, snapshot)
+        scanned = []
+        added = task.scan_and_add_directory(db, path, workers=args.workers, report=scanned.append,
+                                            verify=args.verify, known=known, resumable=True,
+                                            progress=_progress(args))
+        known.save(snapshot)
+    finally:
+        db.close()
+    _emit(args, [{"path": path, "added": added, **_stats_record(scanned[0])}])
+    return EXIT_OK
+
+
+def cmd_resume(args: argparse.Namespace) -> int:
+    from pynder.bloom import known_hashes
+    import pynder.db as dbu
+    import pynder.task as task
+    db = _open_write(args)
+    records = []
+    try:
+        jobs = [args.id] if args.id is not None else [job[0] for job in dbu.unfinished_scan_jobs(db)]
+        snapshot = f"{_db_path(args)}.bloom"
+        known = known_hashes(db, snapshot)
+        for job in jobs:
+            scanned = []
+            try:
+                added = task.resume_scan(db, job, workers=args.workers, report=scanned.append, verify=args.verify,
+                                         known=known, progress=_progress(args))
+            except ValueError as e:
+                raise CommandError(str(e))
+            records.append({"job": job, "added": added, **_stats_record(scanned[0])})
+        known.save(snapshot)
+    finally:
+        db.close()
+    _emit(args, records)
+    return EXIT_OK
+
+
+def _shard(value: str) -> tuple[int, int]:
+    """Parses a shard given as `I/N` (the I-th of N shards, counting from 0)."""
+    try:
+        shard, shards = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected I/N, got {value!r}")
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError(f"shard {shard} out of range for {shards} shard(s)")
+    return shard, shards
+
+
+def cmd_worker(args: argparse.Namespace) -> int:
+    import pynder.shard as shard
+    path = os.path.abspath(args.path)
+    if not os.path.isdir(path):
+        raise CommandError(f"Not a directory: {path}")
+    index, shards = args.shard
+    scanned = []
+    files = shard.scan_shard(path, args.output, index, shards, args.subtree, workers=args.workers,
+                             report=scanned.append)
+    _emit(args, [{"output": args.output, "shard": f"{index}/{shards}", "written": files,
+                  **_stats_record(scanned[0])}])
+    return EXIT_OK
+
+
+def cmd_collect(args: argparse.Namespace) -> int:
+    from pynder.bloom import known_hashes
+    import pynder.task as task
+    db = _open_write(args)
+    try:
+        snapshot = f"{_db_path(args)}.bloom"
+        known = known_hashes(db, snapshot)
+        try:
+            added = task.merge_shards(db, args.results, repository=args.repo, root=args.root,
+                                      cache=args.cache, known=known)
+        except ValueError as e:
+            raise CommandError(str(e))
+        known.save(snapshot)
+    finally:
+        db.close()
+    _emit(args, [{"results": len(args.results), "added": added}])
+    return EXIT_OK
+
+
+def cmd_ls_files(args: argparse.Namespace) -> int:
+    import pynder.db as dbu
+    db = _open_read(args)
+    try:
+        if args.limit is None:
+            md5s = dbu.iter_of_files(db)
+        else:
+            md5s = dbu.page_of_files(db, after=args.after, limit=args.limit)
+        _emit(args, ({"md5": md5} for md5 in md5s))
+    finally:
+        db.close()
+    return EXIT_OK
+
+
+def cmd_ls_repos(args: argparse.Namespace) -> int:
+    import pynder.db as dbu
+    db = _open_read(args)
+    try:
+        _emit(args, (
+            {"id": repo_id, "description": description, "path": path}
+            for repo_id, description, path in dbu.iter_of_repository(db)
+        ))
+    finally:
+        db.close()
+    return EXIT_OK
+
+
+def cmd_ls_dir(args: argparse.Namespace) -> int:
+    import pynder.db as dbu
+    db = _open_read(args)
+    try:
+        repo = dbu.repository_by_id(db, args.id)
+        if repo is None:
+            raise CommandError(f"Repository not found: {args.id}")
+        path = os.path.abspath(args.path) if args.path else repo[2]
+        subdirectories, files = dbu.directory_listing(db, args.id, path)
+    finally:
+        db.close()
+    _emit(args, [
+        *({"type": "dir", "md5": None, "name": name} for name in subdirectories),
+        *({"type": "file", "md5": md5, "name": name} for md5, name in files),
+    ])
+    return EXIT_OK
+
+
+def cmd_repo_add(args: argparse.Namespace) -> int:
+    from pynder.bloom import known_hashes
+    import pynder.task as task
+    path = os.path.abspath(args.path)
+    if not os.path.isdir(path):
+        raise CommandError(f"Not a directory: {path}")
+    db = _open_write(args)
+    try:
+        repo = task.add_repo(db, path, args.description or "", args.allow_duplicate)
+        if repo is None:
+            raise CommandError(f"A repository with path {path} already exists")
+        record = {"id": repo, "path": path}
+        if not args.no_scan:
+            snapshot = f"{_db_path(args)}.bloom"
+            known = known_hashes(db, snapshot)
+            scanned = []
+            added = task.scan_and_add_directory(db, path, workers=args.workers, report=scanned.append,
+                                                verify=args.verify, known=known, repository=repo,
+                                                resumable=True, progress=_progress(args))
+            known.save(snapshot)
+            record.update(added=added, **_stats_record(scanned[0]))
+    finally:
+        db.close()
+    _emit(args, [record])
+    return EXIT_OK
+
+
+def cmd_repo_rescan(args: argparse.Namespace) -> int:
+    from pynder.bloom import known_hashes
+    import pynder.task as task
+    db = _open_write(args)
+    try:
+        snapshot = f"{_db_path(args)}.bloom"
+        known = known_hashes(db, snapshot)
+        try:
+            summary = task.rescan_repo(db, args.id, workers=args.workers, verify=args.verify, known=known)
+        except ValueError as e:
+            raise CommandError(str(e))
+        known.save(snapshot)
+    finally:
+        db.close()
+    _emit(args, [{
+        "id": args.id,
+        "added": len(summary.added),
+        "modified": len(summary.modified),
+        "moved": len(summary.moved),
+        "deleted": len(summary.deleted),
+        "unchanged": summary.unchanged,
+        **_stats_record(summary.stats),
+    }])
+    return EXIT_OK
+
+
+def cmd_dupes(args: argparse.Namespace) -> int:
+    import pynder.task as task
+    db = _open_write(args)
+    try:
+        try:
+            groups = task.find_duplicates(db, args.id, workers=args.workers, verify=args.verify)
+        except ValueError as e:
+            raise CommandError(str(e))
+    finally:
+        db.close()
+    _emit(args, ({"md5": md5, "paths": paths} for md5, paths in groups.items()))
+    return EXIT_OK
+
+
+def cmd_merge(args: argparse.Namespace) -> int:
+    import pynder.task as task
+    db = _open_write(args)
+    try:
+        try:
+            added = task.merge_db(db, os.path.expanduser(args.path), incremental=not args.full)
+        except ValueError as e:
+            raise CommandError(str(e))
+    finally:
+        db.close()
+    _emit(args, [{"path": args.path, **added}])
+    return EXIT_OK
+
+
+def cmd_search(args: argparse.Namespace) -> int:
+    import pynder.db as dbu
+    db = _open_read(args)
+    try:
+        results = dbu.search(db, " ".join(args.words), limit=args.limit, offset=args.offset)
+    finally:
+        db.close()
+    _emit(args, (
+        {"id_repo": id_repo, "md5": md5, "path": path, "title": title}
+        for id_repo, md5, path, title in results
+    ))
+    return EXIT_OK
+
+
+def cmd_shell(args: argparse.Namespace) -> int:
+    from pynder.pynder import main
+    main(_db_path(args))
+    return EXIT_OK
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="pynder", description="A file organizer.")
+    parser.add_argument("--db", default=os.environ.get("PYNDER_DB", DEFAULT_DB),
+                        help="the database file (default: $PYNDER_DB or %(default)s)")
+    parser.add_argument("--format", choices=("text", "json", "ndjson"), default="text",
+                        help="output format (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", metavar="command", required=True)
+
+    workers = argparse.ArgumentParser(add_help=False)
+    workers.add_argument("--workers", type=int, help="hashing workers (default: CPU count)")
+    workers.add_argument("--verify", action="store_true", help="hash every file ignoring the stat cache")
+    workers.add_argument("--progress", action="store_true", help="print progress and ETA on stderr")
+
+    scan = commands.add_parser("scan", parents=[workers], help="hash a directory and add its files")
+    scan.add_argument("path")
+    scan.set_defaults(run=cmd_scan)
+
+    resume = commands.add_parser("resume", parents=[workers], help="continue interrupted scans")
+    resume.add_argument("id", type=int, nargs="?", help="the scan job (default: every unfinished one)")
+    resume.set_defaults(run=cmd_resume)
+
+    worker = commands.add_parser("worker", help="hash a shard of a directory into a results file, without the DB")
+    worker.add_argument("path")
+    worker.add_argument("-o", "--output", required=True, help="the results file to write")
+    worker.add_argument("--shard", type=_shard, default=(0, 1), metavar="I/N",
+                        help="only hash the files whose path falls in the I-th of N shards (default: all)")
+    worker.add_argument("--subtree", action="append", default=[],
+                        help="only walk this directory relative to the path (may be repeated)")
+    worker.add_argument("--workers", type=int, help="hashing workers (default: CPU count)")
+    worker.set_defaults(run=cmd_worker)
+
+    collect = commands.add_parser("collect", help="add the files of results files written by workers")
+    collect.add_argument("results", nargs="+")
+    collect.add_argument("--repo", type=int, help="also link the files to this repository")
+    collect.add_argument("--root", help="the directory scanned by the workers, as seen from here")
+    collect.add_argument("--cache", action="store_true",
+                         help="store the stat signatures in the stat cache (only if the workers ran on this host)")
+    collect.set_defaults(run=cmd_collect)
+
+    ls = commands.add_parser("ls", help="list files or repositories")
+    ls_commands = ls.add_subparsers(dest="what", metavar="what", required=True)
+    ls_files = ls_commands.add_parser("files", help="list the md5 of every file")
+    ls_files.add_argument("--limit", type=int, help="list at most this many files, in md5 order")
+    ls_files.add_argument("--after", help="list the files following this md5")
+    ls_files.set_defaults(run=cmd_ls_files)
+    ls_repos = ls_commands.add_parser("repos", help="list the repositories")
+    ls_repos.set_defaults(run=cmd_ls_repos)
+    ls_dir = ls_commands.add_parser("dir", help="list a directory of a repository")
+    ls_dir.add_argument("id", type=int)
+    ls_dir.add_argument("path", nargs="?", help="the directory (default: the path of the repository)")
+    ls_dir.set_defaults(run=cmd_ls_dir)
+
+    repo = commands.add_parser("repo", help="manage repositories")
+    repo_commands = repo.add_subparsers(dest="action", metavar="action", required=True)
+    repo_add = repo_commands.add_parser("add", parents=[workers], help="add a repository and scan it")
+    repo_add.add_argument("path")
+    repo_add.add_argument("-d", "--description", help="description of the repository")
+    repo_add.add_argument("--allow-duplicate", action="store_true", help="add it even if the path exists")
+    repo_add.add_argument("--no-scan", action="store_true", help="only record the repository")
+    repo_add.set_defaults(run=cmd_repo_add)
+    repo_rescan = repo_commands.add_parser("rescan", parents=[workers], help="update a repository")
+    repo_rescan.add_argument("id", type=int)
+    repo_rescan.set_defaults(run=cmd_repo_rescan)
+
+    dupes = commands.add_parser("dupes", parents=[workers], help="find duplicated files in a repository")
+    dupes.add_argument("id", type=int)
+    dupes.set_defaults(run=cmd_dupes)
+
+    merge = commands.add_parser("merge", help="merge the files and repositories of another database")
+    merge.add_argument("path")
+    merge.add_argument("--full", action="store_true", help="read every row, not only those added since the last merge")
+    merge.set_defaults(run=cmd_merge)
+
+    search = commands.add_parser("search", help="full-text search of paths and publications")
+    search.add_argument("words", nargs="+")
+    search.add_argument("--limit", type=int, default=20)
+    search.add_argument("--offset", type=int, default=0)
+    search.set_defaults(run=cmd_search)
+
+    shell = commands.add_parser("shell", help="start the interactive console")
+    shell.set_defaults(run=cmd_shell)
+    return parser
+
+
+def main(argv: list[str]=None) -> int:
+    args = build_parser().parse_args(argv)
+    try:
+        return args.run(args)
+    except CommandError as e:
+        print(f"pynder: {e}", file=sys.stderr)
+        return EXIT_ERROR
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+    except BrokenPipeError:
+        # The reader went away (e.g. `| head`), stop quietly
+        sys.stderr.close()
+        return EXIT_OK
+    except Exception as e:
+        print(f"pynder: {type(e).__name__}: {e}", file=sys.stderr)
+        return EXIT_ERROR
@@ -14,20 +14,183 @@
 # ==========================================================================
 
 """Database management helper functions."""
+from collections.abc import Callable, Iterable, Iterator
+import itertools
+import os
 import sqlite3
+from typing import TYPE_CHECKING
+
+import pynder.stats as perf
+
+if TYPE_CHECKING:
+    from pynder.bloom import BloomFilter
+
+# Number of rows written in each transaction by the bulk functions
+DEFAULT_BATCH_SIZE = 5000
+
+# Rows fetched at a time by the iterator functions
+DEFAULT_ARRAYSIZE = 1000
+
+# Number of prepared statements kept by each connection (sqlite3 defaults to 128)
+STATEMENT_CACHE_SIZE = 512
+
+# PRAGMA settings applied by `connect()`, cache_size is in KiB when negative
+CONNECTION_PROFILES = {
+    "interactive": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "foreign_keys": "ON",
+    },
+    "bulk-ingest": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -512 * 1024,
+        "mmap_size": 1024 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "foreign_keys": "OFF",
+    },
+    "read-only": {
+        "query_only": "ON",
+        "cache_size": -64 * 1024,
+        "mmap_size": 1024 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "foreign_keys": "OFF",
+    },
+}
+
+# The schema creation script, all its statements are no-ops on existing objects
+SCHEMA_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sql", "schema.sql")
+
+# Version of the schema created by `SCHEMA_SCRIPT`, stored in `PRAGMA user_version`
+SCHEMA_VERSION = 3
+
+# Values bound at a time by the queries matching a list of digests
+_IN_CHUNK = 500
+
+def connect(path: str, profile: str="interactive") -> sqlite3.Connection:
+    """Opens a connection tuned with one of the `CONNECTION_PROFILES`.
+
+    - "interactive": WAL journal with normal sync, a moderate page cache
+      and foreign keys enforced. The default for the REPL.
+    - "bulk-ingest": same durability but a much larger page cache and mmap
+      window and no foreign key checks, for scans writing many rows.
+    - "read-only": opens the file in read-only mode (it must exist) and
+      refuses any write, for listings and reports.
+
+    Every profile also raises the size of the prepared statement cache.
+
+    Args:
+        path (str): The path of the database file.
+        profile (str, optional): The name of the profile. Defaults to "interactive".
+
+    Returns:
+        sqlite3.Connection: The configured connection.
+    """
+    if profile not in CONNECTION_PROFILES:
+        raise ValueError(f"Unknown connection profile: {profile}")
+    if profile == "read-only":
+        db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, cached_statements=STATEMENT_CACHE_SIZE)
+    else:
+        db = sqlite3.connect(path, cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma, value in CONNECTION_PROFILES[profile].items():
+        db.execute(f"PRAGMA {pragma}={value};")
+    return db
+
+def _commit(db: sqlite3.Connection, stage: str, start: float | None, rows: int=1):
+    """Commits, accounting the write started at `start` when instrumentation is enabled."""
+    db.commit()
+    if start is not None:
+        perf.count("db.commits")
+        perf.record(stage, start, items=rows)
+
+def _blob(md5: str | bytes) -> bytes:
+    # Digests already in their raw form are bound as they are
+    return md5 if isinstance(md5, bytes) else bytes.fromhex(md5)
+
+def _hex(blob: bytes) -> str:
+    return blob.hex()
+
+def _select_in(db: sqlite3.Connection, sql: str, md5s: Iterable[str]) -> Iterator[tuple]:
+    """Runs `sql`, whose `{}` is replaced by a list of parameters, for every chunk of `md5s`."""
+    blobs = [_blob(md5) for md5 in md5s]
+    for i in range(0, len(blobs), _IN_CHUNK):
+        chunk = blobs[i:i + _IN_CHUNK]
+        yield from db.execute(sql.format(", ".join("?" * len(chunk))), chunk)
+
+def _join_sql(head: str, tail: str) -> str:
+    """The SQL expression joining two path expressions like `os.path.join` does on POSIX."""
+    return (f"CASE WHEN {head} = '' THEN {tail} WHEN substr({head}, -1) = '/' THEN {head} || {tail} "
+            f"ELSE {head} || '/' || {tail} END")
+
+def _split_directory(path: str) -> list[str]:
+    """Splits a directory path into the names of its 'directory' rows, from the top one down."""
+    path = path.rstrip(os.sep) or path
+    names = []
+    while True:
+        head, tail = os.path.split(path)
+        if not tail:
+            # "/" for absolute paths, "" for relative ones
+            names.append(head)
+            break
+        names.append(tail)
+        path = head
+    names.reverse()
+    return names
+
+def _tree_sql(seed: str) -> str:
+    """A recursive `tree(id, path)` CTE of the directories below those selected by `seed`."""
+    return f"""WITH RECURSIVE tree("id", "path") AS (
+        {seed}
+        UNION ALL
+        SELECT d.id, {_join_sql("tree.path", "d.name")} FROM directory AS d JOIN tree ON d.parent = tree.id
+    )"""
 
 def has_table(db: sqlite3.Connection, table: str) -> bool:
     result = db.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table}';")
     table_exists = result.fetchone() is not None
     return table_exists
 
+def _columns(db: sqlite3.Connection, table: str) -> dict[str, str]:
+    """The declared type of each column of a table, by name."""
+    return {name: type for _, name, type, *_ in db.execute(f'PRAGMA table_info("{table}");')}
+
 def has_schema(cur) -> bool:
     cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='file';")
     table_exists = cur.fetchone() is not None
     return table_exists
 
-def file_exists(db: sqlite3.Connection, md5: str) -> bool:
-    return False
+def file_exists(db: sqlite3.Connection, md5: str, known: "BloomFilter"=None) -> bool:
+    if known is not None and md5 not in known:
+        if perf.enabled:
+            perf.count("db.bloom_negatives")
+        return False
+    result = db.execute("SELECT 1 FROM file WHERE md5=?;", (_blob(md5), ))
+    return result.fetchone() is not None
+
+def files_exist(db: sqlite3.Connection, md5s: Iterable[str], known: "BloomFilter"=None) -> set[str]:
+    """Tells which of many md5's are already in the 'file' table.
+
+    The hashes are sent a few hundred per query, so checking thousands of
+    files costs a handful of round trips.
+
+    Args:
+        db (sqlite3.Connection): The DB to run the query on.
+        md5s (Iterable[str]): The hashes to look for.
+        known (BloomFilter, optional): Filter of the hashes in the DB, only its positives are
+            looked up. Defaults to None.
+
+    Returns:
+        set[str]: The subset of `md5s` found in the 'file' table.
+    """
+    if known is not None:
+        md5s = [md5 for md5 in md5s if md5 in known]
+        if not md5s:
+            return set()
+    result = _select_in(db, "SELECT md5 FROM file WHERE md5 IN ({});", md5s)
+    return {_hex(row[0]) for row in result}
 
 def repository_by_path(db: sqlite3.Connection, path: str) -> list[tuple]:
     """Returns all repositories matching the given path.
@@ -39,7 +202,8 @@ def repository_by_path(db: sqlite3.Connection, path: str) -> list[tuple]:
     Returns:
         list[tuple]: The list of tuples matching the given path on the given DB.
     """
-    return []
+    result = db.execute("SELECT * FROM repository WHERE path=?;", (path, ))
+    return result.fetchall()
 
 def create_schema(db: sqlite3.Connection, script: str=None):
     """Creates a schema, if not already existing.
@@ -56,25 +220,619 @@ def create_schema(db: sqlite3.Connection, script: str=None):
         return
     cur = db.cursor()
     if not script:
-        script = open("./sql/schema.sql").read()
-    cur.executescript(script)
-    
-def add_file(db: sqlite3.Connection, md5: str, publication: int=None, repository: int=None, path: str=None):
-    if (file_exists(md5)):
-        return 0
-    cur = db.cursor()
-    cur.execute(
-        "INSERT INTO file VALUES (?, ?);",
-        (md5, publication)
+        script = open(SCHEMA_SCRIPT).read()
+        cur.executescript(script)
+        set_schema_version(db, SCHEMA_VERSION)
+    else:
+        cur.executescript(script)
+
+def schema_version(db: sqlite3.Connection) -> int:
+    return db.execute("PRAGMA user_version;").fetchone()[0]
+
+def set_schema_version(db: sqlite3.Connection, version: int):
+    db.execute(f"PRAGMA user_version={int(version)};")
+    db.commit()
+
+def _to_blob(value):
+    # Values that are not hex (never written by this module) are kept as they are
+    if isinstance(value, str):
+        try:
+            return bytes.fromhex(value)
+        except ValueError:
+            return value
+    return value
+
+def _defer_search(db: sqlite3.Connection) -> int:
+    """Suspends the per-row search index trigger for the current transaction.
+
+    Returns:
+        int: The last 'repository_file' rowid, rows inserted past it are indexed by `_index_deferred`.
+    """
+    last = db.execute("SELECT IFNULL(MAX(rowid), 0) FROM repository_file;").fetchone()[0]
+    db.execute("INSERT INTO search_deferred VALUES (?);", (last, ))
+    return last
+
+def _index_deferred(db: sqlite3.Connection, last: int):
+    """Indexes the 'repository_file' rows past `last` with a single statement and resumes the trigger."""
+    # Other triggers may have indexed some of them already, e.g. when their publication got an author
+    db.execute("DELETE FROM search_index WHERE rowid > ?;", (last, ))
+    db.execute(
+        """INSERT INTO search_index (rowid, id_repo, id_file, path, title, publisher, isbn, authors)
+        SELECT * FROM search_document WHERE id > ?;""",
+        (last, )
     )
+    db.execute("DELETE FROM search_deferred;")
+
+def _drop_search_objects(db: sqlite3.Connection):
+    """Drops the views, triggers and index reading the tables replaced by a migration.
+
+    The schema script creates them again and `upgrade_schema` refills the index.
+    """
+    db.execute("DROP VIEW IF EXISTS search_document;")
+    db.execute("DROP VIEW IF EXISTS repository_file_with_path;")
+    for name, in db.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND name LIKE 'search_%';").fetchall():
+        db.execute(f'DROP TRIGGER "{name}";')
+    db.execute("DROP TABLE IF EXISTS search_index;")
+    db.commit()
+
+def _migrate_binary_hashes(db: sqlite3.Connection, batch_size: int):
+    """Version 1: digests stored as BLOB instead of hex text, 'file' without rowid.
+
+    Each table is copied into a new one converting the digests, a batch
+    of rows per transaction, then swapped with the old one. An interrupted
+    migration is run again skipping the tables already swapped, those
+    whose digests are declared as BLOB.
+    """
+    tables = {
+        "file": (
+            """CREATE TABLE "file_new" (
+                "md5"	BLOB NOT NULL,
+                "publication"	int,
+                PRIMARY KEY("md5"),
+                FOREIGN KEY("publication") REFERENCES "publication"("id")
+            ) WITHOUT ROWID;""",
+            ("md5", "publication"), 0, False
+        ),
+        "repository_file": (
+            """CREATE TABLE "repository_file_new" (
+                "id_repo"	INT NOT NULL,
+                "id_file"	BLOB NOT NULL,
+                "path"		VARCHAR(256),
+                PRIMARY KEY("id_repo","id_file", "path"),
+                FOREIGN KEY("id_repo") REFERENCES "repository"("id"),
+                FOREIGN KEY("id_file") REFERENCES "file"("md5")
+            );""",
+            ("id_repo", "id_file", "path"), 1, True
+        ),
+        "stat_cache": (
+            """CREATE TABLE "stat_cache_new" (
+                "device"	INT NOT NULL,
+                "inode"	INT NOT NULL,
+                "size"	INT NOT NULL,
+                "mtime_ns"	INT NOT NULL,
+                "md5"	BLOB NOT NULL,
+                PRIMARY KEY("device","inode")
+            );""",
+            ("device", "inode", "size", "mtime_ns", "md5"), 4, False
+        ),
+        "file_chunk": (
+            """CREATE TABLE "file_chunk_new" (
+                "id_file"	BLOB NOT NULL,
+                "offset"	INT NOT NULL,
+                "length"	INT NOT NULL,
+                "chunk"	INTEGER NOT NULL,
+                PRIMARY KEY("id_file","offset"),
+                FOREIGN KEY("id_file") REFERENCES "file"("md5")
+            );""",
+            ("id_file", "offset", "length", "chunk"), 0, False
+        ),
+    }
+    _drop_search_objects(db)
+    for table, (create, columns, digest, keep_rowid) in tables.items():
+        if not has_table(db, table) or _columns(db, table).get(columns[digest], "").upper() == "BLOB":
+            continue
+        db.execute(f'DROP TABLE IF EXISTS "{table}_new";')
+        db.execute(create)
+        # The rowid of 'repository_file' is the key of its search document
+        names = ("rowid", *columns) if keep_rowid else columns
+        digest += 1 if keep_rowid else 0
+        insert = f'INSERT INTO "{table}_new" ({", ".join(names)}) VALUES ({", ".join("?" * len(names))});'
+        cur = db.execute(f'SELECT rowid, {", ".join(columns)} FROM "{table}" ORDER BY rowid;')
+        cur.arraysize = batch_size
+        while rows := cur.fetchmany():
+            converted = []
+            for row in rows:
+                row = list(row if keep_rowid else row[1:])
+                row[digest] = _to_blob(row[digest])
+                converted.append(row)
+            db.executemany(insert, converted)
+            db.commit()
+        db.execute("BEGIN;")
+        db.execute(f'DROP TABLE "{table}";')
+        db.execute(f'ALTER TABLE "{table}_new" RENAME TO "{table}";')
+        db.commit()
+
+def _migrate_directories(db: sqlite3.Connection, batch_size: int):
+    """Version 2: 'repository_file' paths split into a 'directory' row and a name.
+
+    The tuples are copied, keeping their rowid, into a new table linking
+    them to the 'directory' rows of their paths, a batch of rows per
+    transaction, then the new table replaces the old one. An interrupted
+    migration is started again from scratch, unless the new table already
+    replaced the old one.
+    """
+    if has_table(db, "repository_file") and "id_dir" in _columns(db, "repository_file"):
+        return
+    _drop_search_objects(db)
+    db.execute('DROP TABLE IF EXISTS "repository_file_new";')
+    db.execute('DROP TABLE IF EXISTS "directory";')
+    db.execute("""CREATE TABLE "directory" (
+        "id"	INTEGER PRIMARY KEY,
+        "id_repo"	INT NOT NULL,
+        "parent"	INT,
+        "name"	TEXT NOT NULL,
+        UNIQUE("parent","name"),
+        FOREIGN KEY("id_repo") REFERENCES "repository"("id"),
+        FOREIGN KEY("parent") REFERENCES "directory"("id")
+    );""")
+    db.execute("""CREATE UNIQUE INDEX "directory_top" ON "directory"("id_repo","name") WHERE "parent" IS NULL;""")
+    db.execute("""CREATE TABLE "repository_file_new" (
+        "id_repo"	INT NOT NULL,
+        "id_file"	BLOB NOT NULL,
+        "id_dir"	INT NOT NULL,
+        "name"	TEXT NOT NULL,
+        PRIMARY KEY("id_repo","id_file","id_dir","name"),
+        FOREIGN KEY("id_repo") REFERENCES "repository"("id"),
+        FOREIGN KEY("id_file") REFERENCES "file"("md5"),
+        FOREIGN KEY("id_dir") REFERENCES "directory"("id")
+    );""")
+    db.commit()
+    if not has_table(db, "repository_file"):
+        db.execute('ALTER TABLE "repository_file_new" RENAME TO "repository_file";')
+        db.commit()
+        return
+    # Directory ids of each repository, by path
+    directories = {}
+    cur = db.execute("SELECT rowid, id_repo, id_file, path FROM repository_file ORDER BY rowid;")
+    cur.arraysize = batch_size
+    while rows := cur.fetchmany():
+        converted = []
+        for rowid, repository, blob, path in rows:
+            head, name = os.path.split(path or "")
+            directory = directory_id(db, repository, head, True, directories.setdefault(repository, {}))
+            converted.append((rowid, repository, blob, directory, name))
+        db.executemany(
+            'INSERT OR IGNORE INTO "repository_file_new" (rowid, id_repo, id_file, id_dir, name) VALUES (?, ?, ?, ?, ?);',
+            converted
+        )
+        db.commit()
+    db.execute("BEGIN;")
+    db.execute('DROP TABLE "repository_file";')
+    db.execute('ALTER TABLE "repository_file_new" RENAME TO "repository_file";')
+    db.commit()
+
+# Migrations in order, the one at index `i` brings a DB from version `i` to `i + 1`
+def _migrate_deferred_search(db: sqlite3.Connection, batch_size: int):
+    """Version 3: the search index trigger of 'repository_file' skips the rows of bulk writes.
+
+    The old trigger is dropped, the schema script creates the new one.
+    """
+    db.execute('DROP TRIGGER IF EXISTS "search_repository_file_insert";')
+    db.commit()
+
+MIGRATIONS = [
+    _migrate_binary_hashes,
+    _migrate_directories,
+    _migrate_deferred_search,
+]
+
+def upgrade_schema(db: sqlite3.Connection, batch_size: int=DEFAULT_BATCH_SIZE):
+    """Brings an existing schema to `SCHEMA_VERSION`.
+
+    First the `MIGRATIONS` past the version stored in `PRAGMA user_version`
+    are run, each converting the existing data in place and recording the
+    version it reached. Then the schema script is run again: its statements
+    only create the tables, indexes, views and triggers that are missing.
+    If the search index is among them, it is filled with the existing files.
+
+    Args:
+        db (sqlite3.Connection): A connection to the database.
+        batch_size (int, optional): Rows converted per transaction by the migrations.
+            Defaults to `DEFAULT_BATCH_SIZE`.
+    """
+    version = schema_version(db)
+    if version < SCHEMA_VERSION:
+        foreign_keys = db.execute("PRAGMA foreign_keys;").fetchone()[0]
+        # Tables are dropped and renamed, which foreign key enforcement would refuse
+        db.execute("PRAGMA foreign_keys=OFF;")
+        try:
+            for migrate in MIGRATIONS[version:]:
+                migrate(db, batch_size)
+                version += 1
+                set_schema_version(db, version)
+        finally:
+            db.execute(f"PRAGMA foreign_keys={foreign_keys};")
+    has_search = has_table(db, "search_index")
+    db.executescript(open(SCHEMA_SCRIPT).read())
+    if not has_search:
+        rebuild_search_index(db)
+
+def directory_id(db: sqlite3.Connection, repository: int, path: str, create: bool=False,
+                 cache: dict[str, int]=None) -> int | None:
+    """Returns the id of the 'directory' row of a directory of a repository.
+
+    The path is looked up one name at a time, starting from its top
+    directory, each step a lookup on the `(parent, name)` index.
+
+    Args:
+        db (sqlite3.Connection): A connection to the database.
+        repository (int): The id of the repository.
+        path (str): The path of the directory.
+        create (bool, optional): Add the missing directories, without committing. Defaults to False.
+        cache (dict[str, int], optional): Ids of directories of the same repository by path, used and
+            updated in place to skip the lookups. Defaults to None.
+
+    Returns:
+        int: The id of the directory, `None` if it is not in the database and `create` is not set.
+    """
+    if cache is not None and path in cache:
+        return cache[path]
+    parent = None
+    current = None
+    for name in _split_directory(path):
+        current = name if current is None else os.path.join(current, name)
+        if cache is not None and current in cache:
+            parent = cache[current]
+            continue
+        if parent is None:
+            row = db.execute(
+                "SELECT id FROM directory WHERE id_repo=? AND parent IS NULL AND name=?;", (repository, name)
+            ).fetchone()
+        else:
+            row = db.execute("SELECT id FROM directory WHERE parent=? AND name=?;", (parent, name)).fetchone()
+        if row is None:
+            if not create:
+                return None
+            row = (db.execute(
+                "INSERT INTO directory (id_repo, parent, name) VALUES (?, ?, ?);", (repository, parent, name)
+            ).lastrowid, )
+        parent = row[0]
+        if cache is not None:
+            cache[current] = parent
+    if cache is not None:
+        cache[path] = parent
+    return parent
+
+def _file_links(db: sqlite3.Connection, repository: int, rows: Iterable[tuple[bytes, str]],
+                directories: dict[str, int]) -> list[tuple]:
+    """The 'repository_file' tuples of `(digest, path)` rows, adding the directories they need."""
+    links = []
+    for blob, path in rows:
+        # A missing path is linked with an empty name, as `_migrate_directories` does
+        head, name = os.path.split(path or "")
+        links.append((repository, blob, directory_id(db, repository, head, True, directories), name))
+    return links
+
+def add_file(db: sqlite3.Connection, md5: str, publication: int=None, repository: int=None, path: str=None,
+             known: "BloomFilter"=None):
+    """Adds a file, linking it to `repository` at `path` even if its md5 already exists.
+
+    Returns:
+        int: The number of rows added to the 'file' table, 0 if the md5 was already there.
+    """
+    start = perf.clock() if perf.enabled else None
+    cur = db.cursor()
+    added = 0
+    if not file_exists(db, md5, known):
+        cur.execute(
+            "INSERT INTO file VALUES (?, ?);",
+            (_blob(md5), publication)
+        )
+        added = cur.rowcount
     if repository:
         cur.execute(
-            "INSERT INTO repository_file VALUES(?, ?, ?);",
-            (repository, md5, path)
+            "INSERT OR IGNORE INTO repository_file VALUES(?, ?, ?, ?);",
+            _file_links(db, repository, [(_blob(md5), path)], {})[0]
         )
-    db.commit()
+    _commit(db, "db.add_file", start)
+    if known is not None and added:
+        known.add(md5)
+        known.rows += 1
+    return added
+
+def _new_files(db: sqlite3.Connection, blobs: list[bytes], known: "BloomFilter"=None) -> list[bytes]:
+    """The digests of `blobs` to insert into 'file', skipping those known to be there.
+
+    Without a filter every digest is a candidate. With one, its negatives
+    are new for sure and inserted without asking the DB, only its
+    positives are looked up, a few hundred per query, and those found are
+    not inserted again.
+    """
+    if known is None:
+        return blobs
+    new = []
+    positives = []
+    for blob in blobs:
+        (positives if blob.hex() in known else new).append(blob)
+    if perf.enabled:
+        perf.count("db.bloom_negatives", len(new))
+    existing = {row[0] for row in _select_in(db, "SELECT md5 FROM file WHERE md5 IN ({});", positives)}
+    missing = [blob for blob in positives if blob not in existing]
+    if perf.enabled:
+        perf.count("db.bloom_known_skipped", len(positives) - len(missing))
+    new.extend(missing)
+    return new
+
+def _insert_files(db: sqlite3.Connection, batch: list[tuple[str, str]], repository: int=None,
+                  directories: dict[str, int]=None, known: "BloomFilter"=None) -> tuple[int, int]:
+    """Inserts `(md5, path)` rows without committing, returns the 'file' and 'repository_file' rows added.
+
+    With a `known` filter, only the digests it may hold are looked up, see `_new_files`.
+    """
+    blobs = [_blob(md5) for md5, _ in batch]
+    cur = db.executemany(
+        "INSERT OR IGNORE INTO file (md5) VALUES (?);",
+        ((blob, ) for blob in _new_files(db, blobs, known))
+    )
+    files_added = cur.rowcount
+    links_added = 0
+    if repository:
+        links = _file_links(db, repository, ((blob, path) for blob, (_, path) in zip(blobs, batch)),
+                            {} if directories is None else directories)
+        last = _defer_search(db)
+        cur = db.executemany("INSERT OR IGNORE INTO repository_file VALUES (?, ?, ?, ?);", links)
+        links_added = cur.rowcount
+        _index_deferred(db, last)
+    return files_added, links_added
+
+def add_files(db: sqlite3.Connection, rows: Iterable[tuple[str, str]], repository: int=None,
+              batch_size: int=DEFAULT_BATCH_SIZE, on_batch: Callable[[int, int], None]=None,
+              known: "BloomFilter"=None) -> int:
+    """Adds many files to the database in large transactions.
+
+    Rows are consumed lazily and written `batch_size` at a time, each batch
+    with a single `executemany` per table and a single commit. Files whose
+    md5 already exists are ignored, as are `repository_file` tuples already
+    present, so the function can be safely run again on the same rows.
+    The new tuples are added to the search index by one statement per
+    batch instead of the per-row trigger.
+
+    Args:
+        db (sqlite3.Connection): A connection to the database.
+        rows (Iterable[tuple[str, str]]): The `(md5, path)` pairs to add, the md5 as hex or raw bytes.
+        repository (int, optional): If given, rows are also linked to this repository. Defaults to None.
+        batch_size (int, optional): Rows per transaction. Defaults to `DEFAULT_BATCH_SIZE`.
+        on_batch (Callable[[int, int], None], optional): Called after each commit with the number of
+            'file' and 'repository_file' rows added by the batch. Defaults to None.
+        known (BloomFilter, optional): Filter of the hashes in the DB, updated after each commit.
+            Defaults to None.
+
+    Returns:
+        int: The total number of rows added to the 'file' table.
+    """
+    rows = iter(rows)
+    total = 0
+    # Directory ids resolved by the previous batches
+    directories = {}
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        start = perf.clock() if perf.enabled else None
+        try:
+            files_added, links_added = _insert_files(db, batch, repository, directories, known)
+        except BaseException:
+            db.rollback()
+            raise
+        _commit(db, "db.add_files", start, len(batch))
+        if known is not None:
+            known.update(md5 if isinstance(md5, str) else md5.hex() for md5, _ in batch)
+            known.rows += files_added
+        total += files_added
+        if on_batch:
+            on_batch(files_added, links_added)
+    return total
+
+def files_of_repository(db: sqlite3.Connection, repository: int, prefix: str=None) -> Iterator[tuple[str, str]]:
+    """Yields the `(md5, path)` pairs linked to a repository.
+
+    Args:
+        db (sqlite3.Connection): The DB to run the query on.
+        repository (int): The id of the repository.
+        prefix (str, optional): Only paths inside this directory are returned. Defaults to None (all).
+
+    Yields:
+        tuple[str, str]: The md5 and path of each 'repository_file' tuple.
+    """
+    if prefix is None:
+        seed = "SELECT id, name FROM directory WHERE id_repo=:repository AND parent IS NULL"
+        params = {"repository": repository}
+    else:
+        # Only the subtree of the prefix is visited, one index range per directory
+        top = directory_id(db, repository, prefix)
+        if top is None:
+            return
+        seed = "SELECT :top, :prefix"
+        params = {"top": top, "prefix": os.path.join(*_split_directory(prefix))}
+    cur = db.execute(
+        f"""{_tree_sql(seed)}
+        SELECT rf.id_file, {_join_sql("tree.path", "rf.name")} FROM tree JOIN repository_file AS rf ON rf.id_dir = tree.id;""",
+        params
+    )
+    cur.arraysize = DEFAULT_ARRAYSIZE
+    while rows := cur.fetchmany():
+        for blob, path in rows:
+            yield _hex(blob), path
+
+def apply_repository_changes(db: sqlite3.Connection, repository: int, removed: Iterable[str],
+                             added: Iterable[tuple[str, str]], known: "BloomFilter"=None) -> None:
+    """Removes and adds paths of a repository in a single transaction.
+
+    All the 'repository_file' tuples of the `removed` paths are deleted,
+    then the `added` `(md5, path)` pairs are inserted, creating the 'file'
+    tuples they need. Nothing is written if any statement fails.
+
+    Args:
+        db (sqlite3.Connection): A connection to the database.
+        repository (int): The id of the repository.
+        removed (Iterable[str]): Paths no longer holding the content recorded for them.
+        added (Iterable[tuple[str, str]]): New `(md5, path)` pairs of the repository.
+        known (BloomFilter, optional): Filter of the hashes in the DB, updated after the commit.
+            Defaults to None.
+    """
+    added = list(added)
+    start = perf.clock() if perf.enabled else None
+    directories = {}
+    try:
+        unlinked = []
+        for path in removed:
+            head, name = os.path.split(path)
+            directory = directory_id(db, repository, head, cache=directories)
+            if directory is not None:
+                unlinked.append((repository, directory, name))
+        db.executemany("DELETE FROM repository_file WHERE id_repo=? AND id_dir=? AND name=?;", unlinked)
+        files_added = db.executemany(
+            "INSERT OR IGNORE INTO file (md5) VALUES (?);",
+            ((blob, ) for blob in _new_files(db, [_blob(md5) for md5, _ in added], known))
+        ).rowcount
+        links = _file_links(db, repository, ((_blob(md5), path) for md5, path in added), directories)
+        last = _defer_search(db)
+        db.executemany("INSERT OR IGNORE INTO repository_file VALUES (?, ?, ?, ?);", links)
+        _index_deferred(db, last)
+    except BaseException:
+        db.rollback()
+        raise
+    _commit(db, "db.apply_repository_changes", start, len(added))
+    if known is not None:
+        known.update(md5 for md5, _ in added)
+        known.rows += files_added
+
+def directory_listing(db: sqlite3.Connection, repository: int, path: str) -> tuple[list[str], list[tuple[str, str]]]:
+    """Lists a directory of a repository, without descending into its subdirectories.
+
+    Args:
+        db (sqlite3.Connection): The DB to run the query on.
+        repository (int): The id of the repository.
+        path (str): The path of the directory.
+
+    Returns:
+        tuple[list[str], list[tuple[str, str]]]: The names of the subdirectories and the `(md5, name)`
+            pairs of the files, both sorted by name. Both are empty if the directory is unknown.
+    """
+    top = directory_id(db, repository, path)
+    if top is None:
+        return [], []
+    subdirectories = [name for name, in db.execute("SELECT name FROM directory WHERE parent=? ORDER BY name;", (top, ))]
+    files = [
+        (_hex(blob), name)
+        for blob, name in db.execute("SELECT id_file, name FROM repository_file WHERE id_dir=? ORDER BY name;", (top, ))
+    ]
+    return subdirectories, files
+
+def duplicates_by_repository(db: sqlite3.Connection) -> list[tuple[int, int, int]]:
+    """Summarizes the duplicated files of each repository.
+
+    A file is duplicated in a repository when more than one path of the
+    repository is linked to the same md5 in 'repository_file'.
+
+    Args:
+        db (sqlite3.Connection): The DB to run the query on.
+
+    Returns:
+        list[tuple[int, int, int]]: For each repository with duplicates, its id, the number of
+            distinct contents duplicated and the number of redundant copies.
+    """
+    result = db.execute(
+        """SELECT id_repo, COUNT(*), SUM(copies - 1) FROM (
+            SELECT id_repo, id_file, COUNT(*) AS copies FROM repository_file
+            GROUP BY id_repo, id_file HAVING COUNT(*) > 1
+        ) GROUP BY id_repo ORDER BY id_repo;"""
+    )
+    return result.fetchall()
+
+def chunked_files(db: sqlite3.Connection, md5s: Iterable[str]) -> set[str]:
+    """Tells which of the given md5's already have their chunks indexed."""
+    result = _select_in(db, "SELECT DISTINCT id_file FROM file_chunk WHERE id_file IN ({});", md5s)
+    return {_hex(row[0]) for row in result}
+
+def add_chunks(db: sqlite3.Connection, chunks: dict[str, list[tuple[int, int, int]]]) -> int:
+    """Stores the content-defined chunks of some files, replacing previous ones.
+
+    Args:
+        db (sqlite3.Connection): A connection to the database.
+        chunks (dict[str, list[tuple[int, int, int]]]): Maps each md5 to the
+            `(offset, length, chunk hash)` of its chunks, as given by `fs.chunk_file`.
+
+    Returns:
+        int: The number of chunk rows written.
+    """
+    start = perf.clock() if perf.enabled else None
+    db.executemany("DELETE FROM file_chunk WHERE id_file=?;", ((_blob(md5), ) for md5 in chunks))
+    cur = db.executemany(
+        "INSERT INTO file_chunk VALUES (?, ?, ?, ?);",
+        ((_blob(md5), offset, length, chunk) for md5, rows in chunks.items() for offset, length, chunk in rows)
+    )
+    _commit(db, "db.add_chunks", start, max(cur.rowcount, 0))
     return cur.rowcount
 
+def similar_files(db: sqlite3.Connection, md5: str, threshold: float=0.5) -> list[tuple[str, float]]:
+    """Finds the files sharing at least a fraction of the content of a file.
+
+    Only the chunk index is used: the candidates are the files with one of
+    the chunks of `md5`, found through the index on the chunk hash.
+
+    Args:
+        db (sqlite3.Connection): The DB to run the query on.
+        md5 (str): The file to compare, its chunks must have been indexed.
+        threshold (float, optional): Minimum fraction of the bytes of `md5` shared. Defaults to 0.5.
+
+    Returns:
+        list[tuple[str, float]]: The md5 of each similar file and the fraction shared, most similar first.
+    """
+    result = db.execute(
+        """SELECT id_file, SUM(length) * 1.0 / (SELECT SUM(length) FROM file_chunk WHERE id_file=:md5) AS shared
+        FROM (
+            SELECT DISTINCT other.id_file, other.chunk, other.length
+            FROM file_chunk AS mine JOIN file_chunk AS other ON other.chunk = mine.chunk
+            WHERE mine.id_file = :md5 AND other.id_file != :md5
+        )
+        GROUP BY id_file HAVING shared >= :threshold ORDER BY shared DESC;""",
+        {"md5": _blob(md5), "threshold": threshold}
+    )
+    return [(_hex(blob), shared) for blob, shared in result]
+
+def reclaimable_bytes(db: sqlite3.Connection) -> list[tuple[int, int, int]]:
+    """Computes, for each repository, how many bytes are stored more than once.
+
+    Every path of the repository counts for the whole size of its file,
+    while each distinct chunk is counted once: the difference is what
+    chunk level deduplication would save. Only indexed files are counted.
+
+    Args:
+        db (sqlite3.Connection): The DB to run the query on.
+
+    Returns:
+        list[tuple[int, int, int]]: The id of each repository, its total bytes and its reclaimable bytes.
+    """
+    result = db.execute(
+        """SELECT total.id_repo, total.bytes, total.bytes - IFNULL(uniq.bytes, 0) FROM (
+            SELECT rf.id_repo, SUM(fc.length) AS bytes
+            FROM repository_file AS rf JOIN file_chunk AS fc ON fc.id_file = rf.id_file
+            GROUP BY rf.id_repo
+        ) AS total LEFT JOIN (
+            SELECT id_repo, SUM(length) AS bytes FROM (
+                SELECT DISTINCT rf.id_repo, fc.chunk, fc.length
+                FROM repository_file AS rf JOIN file_chunk AS fc ON fc.id_file = rf.id_file
+            ) GROUP BY id_repo
+        ) AS uniq ON uniq.id_repo = total.id_repo
+        ORDER BY total.id_repo;"""
+    )
+    return result.fetchall()
+
+def repository_by_id(db: sqlite3.Connection, id: int) -> tuple | None:
+    result = db.execute("SELECT * FROM repository WHERE id=?;", (id, ))
+    return result.fetchone()
+
 def add_repository(db: sqlite3.Connection, path: str, description: str) -> int:
     """Adds a new repository to the give database.
     
@@ -100,18 +858,385 @@ def add_repository(db: sqlite3.Connection, path: str, description: str) -> int:
     Returns:
         int: The id used as key of the newly inserted repository.
     """
+    start = perf.clock() if perf.enabled else None
     cur = db.cursor()
     cur.execute(
         "INSERT INTO repository (description, path) VALUES (?, ?);",
         (description, path)
     )
+    _commit(db, "db.add_repository", start)
+    return cur.lastrowid
+
+def cached_hash(db: sqlite3.Connection, signature: tuple) -> str | None:
+    """Returns the cached digest of a file if its stat signature is unchanged.
+
+    Args:
+        db (sqlite3.Connection): The DB to run the query on.
+        signature (tuple): The `(device, inode, size, mtime_ns)` of the file.
+
+    Returns:
+        str | None: The md5 stored for the signature, `None` if the file is unknown or changed.
+    """
+    result = db.execute(
+        "SELECT md5 FROM stat_cache WHERE device=? AND inode=? AND size=? AND mtime_ns=?;",
+        tuple(signature)
+    )
+    row = result.fetchone()
+    return _hex(row[0]) if row else None
+
+def cache_hashes(db: sqlite3.Connection, entries: Iterable[tuple[tuple, str]]) -> int:
+    """Stores the digests of freshly hashed files in the stat cache.
+
+    Args:
+        db (sqlite3.Connection): A connection to the database.
+        entries (Iterable[tuple[tuple, str]]): Pairs of `(device, inode, size, mtime_ns)` signature and md5.
+
+    Returns:
+        int: The number of cache rows written.
+    """
+    start = perf.clock() if perf.enabled else None
+    cur = db.executemany(
+        "INSERT OR REPLACE INTO stat_cache VALUES (?, ?, ?, ?, ?);",
+        ((*signature, _blob(md5)) for signature, md5 in entries)
+    )
+    _commit(db, "db.cache_hashes", start, max(cur.rowcount, 0))
+    return cur.rowcount
+
+# Statements of `merge_database`, run in this order with the attached DB named 'src'
+_MERGE_STATEMENTS = [
+    # Every repository of the source becomes a new repository here, mapped once and for all
+    ("repository", """INSERT INTO merge_map (source, kind, source_id, target_id)
+        SELECT :source, 'repository', r.id,
+            (SELECT IFNULL(MAX(id), 0) FROM main.repository) + row_number() OVER (ORDER BY r.id)
+        FROM src.repository AS r
+        WHERE NOT EXISTS (
+            SELECT 1 FROM merge_map AS m WHERE m.source = :source AND m.kind = 'repository' AND m.source_id = r.id
+        );""", """INSERT OR IGNORE INTO main.repository (id, description, path)
+        SELECT m.target_id, r.description, r.path
+        FROM src.repository AS r JOIN merge_map AS m
+            ON m.source = :source AND m.kind = 'repository' AND m.source_id = r.id;"""),
+    # Publications with the same isbn and authors with the same name are the same row
+    ("publication", """INSERT INTO merge_map (source, kind, source_id, target_id)
+        SELECT :source, 'publication', p.id, IFNULL(
+            (SELECT t.id FROM main.publication AS t WHERE p.isbn IS NOT NULL AND t.isbn = p.isbn LIMIT 1),
+            (SELECT IFNULL(MAX(id), 0) FROM main.publication) + row_number() OVER (ORDER BY p.id))
+        FROM src.publication AS p
+        WHERE NOT EXISTS (
+            SELECT 1 FROM merge_map AS m WHERE m.source = :source AND m.kind = 'publication' AND m.source_id = p.id
+        );""", """INSERT OR IGNORE INTO main.publication (id, isbn, title, year, edition, publisher, verified)
+        SELECT m.target_id, p.isbn, p.title, p.year, p.edition, p.publisher, p.verified
+        FROM src.publication AS p JOIN merge_map AS m
+            ON m.source = :source AND m.kind = 'publication' AND m.source_id = p.id;"""),
+    ("author", """INSERT INTO merge_map (source, kind, source_id, target_id)
+        SELECT :source, 'author', a.id, IFNULL(
+            (SELECT t.id FROM main.author AS t WHERE t.first_name = a.first_name AND t.last_name = a.last_name
+                AND t.middle_name IS a.middle_name LIMIT 1),
+            (SELECT IFNULL(MAX(id), 0) FROM main.author) + row_number() OVER (ORDER BY a.id))
+        FROM src.author AS a
+        WHERE NOT EXISTS (
+            SELECT 1 FROM merge_map AS m WHERE m.source = :source AND m.kind = 'author' AND m.source_id = a.id
+        );""", """INSERT OR IGNORE INTO main.author (id, first_name, middle_name, last_name)
+        SELECT m.target_id, a.first_name, a.middle_name, a.last_name
+        FROM src.author AS a JOIN merge_map AS m
+            ON m.source = :source AND m.kind = 'author' AND m.source_id = a.id;"""),
+    ("author_pub", None, """INSERT OR IGNORE INTO main.author_pub (id_author, id_pub)
+        SELECT ma.target_id, mp.target_id
+        FROM src.author_pub AS ap
+        JOIN merge_map AS ma ON ma.source = :source AND ma.kind = 'author' AND ma.source_id = ap.id_author
+        JOIN merge_map AS mp ON mp.source = :source AND mp.kind = 'publication' AND mp.source_id = ap.id_pub
+        WHERE ap.rowid > :last_author_pub AND ap.rowid <= :max_author_pub;"""),
+    # Contents are keyed by their digest, those already here are skipped
+    ("file", None, """INSERT OR IGNORE INTO main.file (md5, publication)
+        SELECT f.md5, mp.target_id
+        FROM src.file AS f
+        LEFT JOIN merge_map AS mp ON mp.source = :source AND mp.kind = 'publication' AND mp.source_id = f.publication
+        WHERE :incremental = 0 OR f.md5 IN (
+            SELECT id_file FROM src.repository_file
+            WHERE rowid > :last_repository_file AND rowid <= :max_repository_file
+        );"""),
+    # Directories belong to the repositories mapped above, so they are always new here
+    ("directory", """INSERT INTO merge_map (source, kind, source_id, target_id)
+        SELECT :source, 'directory', d.id,
+            (SELECT IFNULL(MAX(id), 0) FROM main.directory) + row_number() OVER (ORDER BY d.id)
+        FROM src.directory AS d
+        WHERE NOT EXISTS (
+            SELECT 1 FROM merge_map AS m WHERE m.source = :source AND m.kind = 'directory' AND m.source_id = d.id
+        );""", """INSERT OR IGNORE INTO main.directory (id, id_repo, parent, name)
+        SELECT m.target_id, mr.target_id, mp.target_id, d.name
+        FROM src.directory AS d
+        JOIN merge_map AS m ON m.source = :source AND m.kind = 'directory' AND m.source_id = d.id
+        JOIN merge_map AS mr ON mr.source = :source AND mr.kind = 'repository' AND mr.source_id = d.id_repo
+        LEFT JOIN merge_map AS mp ON mp.source = :source AND mp.kind = 'directory' AND mp.source_id = d.parent;"""),
+    ("repository_file", None, """INSERT OR IGNORE INTO main.repository_file (id_repo, id_file, id_dir, name)
+        SELECT m.target_id, rf.id_file, md.target_id, rf.name
+        FROM src.repository_file AS rf
+        JOIN merge_map AS m ON m.source = :source AND m.kind = 'repository' AND m.source_id = rf.id_repo
+        JOIN merge_map AS md ON md.source = :source AND md.kind = 'directory' AND md.source_id = rf.id_dir
+        WHERE rf.rowid > :last_repository_file AND rf.rowid <= :max_repository_file;"""),
+]
+
+def merge_database(db: sqlite3.Connection, path: str, incremental: bool=True) -> dict[str, int]:
+    """Merges into `db` the files, repositories and publications of another pynder DB.
+
+    The other DB is attached and every table is merged with a few
+    `INSERT ... SELECT` statements, in a single transaction:
+
+    - each repository of the other DB is added as a new repository, its
+      id remapped and the mapping kept in 'merge_map', so that merging the
+      same DB again doesn't add it twice;
+    - publications with the same isbn, and authors with the same name,
+      are mapped to the existing rows, the others are added;
+    - the directories of the merged repositories are added, their ids
+      remapped like those of the repositories;
+    - 'file' and 'repository_file' rows, keyed by digest, are added
+      unless already present.
+
+    In incremental mode only the 'repository_file' and 'author_pub' rows
+    added since the last merge from the same DB are read, along with the
+    files they link. Rows are told apart by rowid, so one replaced at the
+    very end of its table may be missed: a full merge, which also picks up
+    the files not linked to any repository, catches up and is safe to
+    repeat. The stat cache and chunk index are not merged, and Bloom
+    filters of the known hashes go stale.
+
+    Args:
+        db (sqlite3.Connection): A connection to the target database.
+        path (str): The path of the DB to merge, its schema must be at `SCHEMA_VERSION`.
+        incremental (bool, optional): Only merge the rows added since the last merge. Defaults to True.
+
+    Returns:
+        dict[str, int]: The number of rows added to each table.
+    """
+    start = perf.clock() if perf.enabled else None
+    source = os.path.realpath(path)
+    db.commit()
+    db.execute("ATTACH DATABASE ? AS src;", (source, ))
+    try:
+        version = db.execute("PRAGMA src.user_version;").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            raise ValueError(f"Can't merge {source}: schema version {version}, expected {SCHEMA_VERSION}")
+        last = db.execute(
+            "SELECT last_repository_file, last_author_pub FROM merge_log WHERE source=?;", (source, )
+        ).fetchone()
+        # The first merge from a DB is always a full one
+        incremental = incremental and last is not None
+        if not incremental:
+            last = (0, 0)
+        params = {
+            "source": source,
+            "incremental": int(incremental),
+            "last_repository_file": last[0],
+            "last_author_pub": last[1],
+            "max_repository_file": db.execute("SELECT IFNULL(MAX(rowid), 0) FROM src.repository_file;").fetchone()[0],
+            "max_author_pub": db.execute("SELECT IFNULL(MAX(rowid), 0) FROM src.author_pub;").fetchone()[0],
+        }
+        added = {}
+        try:
+            db.execute("BEGIN;")
+            last = _defer_search(db)
+            for table, mapping, merge in _MERGE_STATEMENTS:
+                if mapping is not None:
+                    db.execute(mapping, params)
+                added[table] = db.execute(merge, params).rowcount
+            _index_deferred(db, last)
+            db.execute(
+                """INSERT OR REPLACE INTO merge_log (source, merged_at, last_repository_file, last_author_pub)
+                VALUES (:source, datetime('now'), :max_repository_file, :max_author_pub);""",
+                params
+            )
+        except BaseException:
+            db.rollback()
+            raise
+        _commit(db, "db.merge_database", start, sum(added.values()))
+    finally:
+        db.execute("DETACH DATABASE src;")
+    return added
+
+def create_scan_job(db: sqlite3.Connection, path: str, repository: int=None) -> int:
+    """Records a new resumable scan of `path`, whose only pending directory is `path` itself.
+
+    Returns:
+        int: The id of the job.
+    """
+    cur = db.execute(
+        """INSERT INTO scan_job (path, id_repo, status, started_at, updated_at)
+        VALUES (?, ?, 'running', datetime('now'), datetime('now'));""",
+        (path, repository)
+    )
+    db.execute("INSERT INTO scan_job_directory VALUES (?, ?);", (cur.lastrowid, path))
     db.commit()
     return cur.lastrowid
 
+def scan_job(db: sqlite3.Connection, job: int) -> tuple | None:
+    """Returns the `(id, path, id_repo, status, started_at, updated_at, directories, files, bytes, seconds)` of a job."""
+    return db.execute("SELECT * FROM scan_job WHERE id=?;", (job, )).fetchone()
+
+def unfinished_scan_jobs(db: sqlite3.Connection) -> list[tuple]:
+    """Returns the jobs not done yet, with the number of their pending directories, oldest first."""
+    result = db.execute(
+        """SELECT j.*, (SELECT COUNT(*) FROM scan_job_directory AS d WHERE d.id_job = j.id)
+        FROM scan_job AS j WHERE j.status != 'done' ORDER BY j.id;"""
+    )
+    return result.fetchall()
+
+def pending_directories(db: sqlite3.Connection, job: int, limit: int=DEFAULT_ARRAYSIZE) -> list[str]:
+    result = db.execute(
+        "SELECT path FROM scan_job_directory WHERE id_job=? ORDER BY path LIMIT ?;", (job, limit)
+    )
+    return [row[0] for row in result]
+
+def count_pending_directories(db: sqlite3.Connection, job: int) -> int:
+    return db.execute("SELECT COUNT(*) FROM scan_job_directory WHERE id_job=?;", (job, )).fetchone()[0]
+
+def checkpoint_scan_job(db: sqlite3.Connection, job: int, rows: list[tuple[str, str]], done: Iterable[str],
+                        found: Iterable[str], nbytes: int=0, seconds: float=0.0,
+                        known: "BloomFilter"=None) -> int:
+    """Writes a batch of a scan together with the progress it makes, in one transaction.
+
+    The `(md5, path)` rows are added as `add_files` does (linked to the
+    repository of the job, if any), the `done` directories are removed
+    from the pending ones and the `found` subdirectories added. Either
+    all of it is written or none, so a job interrupted at any point
+    resumes from a consistent state.
+
+    Args:
+        db (sqlite3.Connection): A connection to the database.
+        job (int): The id of the job.
+        rows (list[tuple[str, str]]): The files of the `done` directories.
+        done (Iterable[str]): Directories whose files are all in `rows`.
+        found (Iterable[str]): Subdirectories still to be scanned.
+        nbytes (int, optional): Bytes hashed for the batch. Defaults to 0.
+        seconds (float, optional): Time spent on the batch. Defaults to 0.0.
+        known (BloomFilter, optional): Filter of the hashes in the DB, updated after the commit.
+            Defaults to None.
+
+    Returns:
+        int: The number of rows added to the 'file' table.
+    """
+    start = perf.clock() if perf.enabled else None
+    done = list(done)
+    repository = db.execute("SELECT id_repo FROM scan_job WHERE id=?;", (job, )).fetchone()[0]
+    try:
+        files_added, _ = _insert_files(db, rows, repository, known=known)
+        db.executemany("DELETE FROM scan_job_directory WHERE id_job=? AND path=?;", ((job, path) for path in done))
+        db.executemany("INSERT OR IGNORE INTO scan_job_directory VALUES (?, ?);", ((job, path) for path in found))
+        db.execute(
+            """UPDATE scan_job SET updated_at=datetime('now'), directories=directories + ?, files=files + ?,
+                bytes=bytes + ?, seconds=seconds + ? WHERE id=?;""",
+            (len(done), len(rows), nbytes, seconds, job)
+        )
+    except BaseException:
+        db.rollback()
+        raise
+    _commit(db, "db.checkpoint_scan_job", start, len(rows))
+    if known is not None:
+        known.update(md5 for md5, _ in rows)
+        known.rows += files_added
+    return files_added
+
+def finish_scan_job(db: sqlite3.Connection, job: int, status: str="done"):
+    db.execute("UPDATE scan_job SET status=?, updated_at=datetime('now') WHERE id=?;", (status, job))
+    db.commit()
+
+def rebuild_search_index(db: sqlite3.Connection):
+    """Fills the full-text index from scratch, it is otherwise kept up to date by triggers and bulk writes."""
+    db.execute("DELETE FROM search_index;")
+    db.execute(
+        """INSERT INTO search_index (rowid, id_repo, id_file, path, title, publisher, isbn, authors)
+        SELECT * FROM search_document;"""
+    )
+    db.execute("INSERT INTO search_index (search_index) VALUES ('optimize');")
+    db.commit()
+
+def _search_query(text: str) -> str:
+    # Each word is quoted, so that user input can't be read as FTS5 syntax,
+    # and the last one is matched as a prefix for search-as-you-type.
+    words = ['"' + word.replace('"', '""') + '"' for word in text.split()]
+    if words:
+        words[-1] += "*"
+    return " ".join(words)
+
+def search(db: sqlite3.Connection, text: str, limit: int=20, offset: int=0) -> list[tuple]:
+    """Searches files by path, title, publisher, isbn and author names.
+
+    Every word of `text` must appear in one of the indexed columns (path
+    components are words too), the last word may be a prefix. Results are
+    ranked by relevance (bm25), titles weighting more than paths.
+
+    Args:
+        db (sqlite3.Connection): The DB to run the query on.
+        text (str): The words to look for.
+        limit (int, optional): Maximum number of results. Defaults to 20.
+        offset (int, optional): Number of results to skip, for pagination. Defaults to 0.
+
+    Returns:
+        list[tuple]: The `(id_repo, md5, path, title)` of each match, best first.
+    """
+    query = _search_query(text)
+    if not query:
+        return []
+    result = db.execute(
+        """SELECT id_repo, id_file, path, title FROM search_index
+        WHERE search_index MATCH ? ORDER BY bm25(search_index, 0, 0, 1.0, 5.0, 2.0, 5.0, 3.0)
+        LIMIT ? OFFSET ?;""",
+        (query, limit, offset)
+    )
+    return result.fetchall()
+
 def list_of_files(db: sqlite3.Connection) -> list:
     result = db.execute(f"SELECT md5 FROM file;")
-    return [row[0] for row in result]
+    return [_hex(row[0]) for row in result]
+
+def iter_of_files(db: sqlite3.Connection, arraysize: int=DEFAULT_ARRAYSIZE) -> Iterator[str]:
+    """Lazily yields the md5 of every file, fetching `arraysize` rows at a time."""
+    cur = db.execute("SELECT md5 FROM file;")
+    cur.arraysize = arraysize
+    while rows := cur.fetchmany():
+        for row in rows:
+            yield _hex(row[0])
+
+def page_of_files(db: sqlite3.Connection, after: str=None, limit: int=100) -> list[str]:
+    """Returns a page of md5's in ascending order.
+
+    Pages are selected by key rather than by offset: the next page is
+    obtained passing as `after` the last md5 of the current one, which
+    makes every page equally cheap no matter how deep in the table.
+
+    Args:
+        db (sqlite3.Connection): The DB to run the query on.
+        after (str, optional): The md5 the page starts after. Defaults to None (first page).
+        limit (int, optional): Maximum size of the page. Defaults to 100.
+
+    Returns:
+        list[str]: The md5's of the page, an empty list past the last page.
+    """
+    if after is None:
+        result = db.execute("SELECT md5 FROM file ORDER BY md5 LIMIT ?;", (limit, ))
+    else:
+        result = db.execute("SELECT md5 FROM file WHERE md5 > ? ORDER BY md5 LIMIT ?;", (_blob(after), limit))
+    return [_hex(row[0]) for row in result]
+
+def count_files(db: sqlite3.Connection) -> int:
+    return db.execute("SELECT COUNT(*) FROM file;").fetchone()[0]
 
 def list_of_repository(db: sqlite3.Connection) -> list:
     result = db.execute(f"SELECT * FROM repository")
-    return result.fetchall()
\ No newline at end of file
+    return result.fetchall()
+
+def iter_of_repository(db: sqlite3.Connection, arraysize: int=DEFAULT_ARRAYSIZE) -> Iterator[tuple]:
+    """Lazily yields every repository tuple, fetching `arraysize` rows at a time."""
+    cur = db.execute("SELECT * FROM repository;")
+    cur.arraysize = arraysize
+    while rows := cur.fetchmany():
+        yield from rows
+
+def page_of_repository(db: sqlite3.Connection, after: int=None, limit: int=100) -> list[tuple]:
+    """Returns a page of repositories ordered by id, see `page_of_files`."""
+    result = db.execute(
+        "SELECT * FROM repository WHERE id > ? ORDER BY id LIMIT ?;",
+        (after if after is not None else -1, limit)
+    )
+    return result.fetchall()
+
+def count_repository(db: sqlite3.Connection) -> int:
+    return db.execute("SELECT COUNT(*) FROM repository;").fetchone()[0]
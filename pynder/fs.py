@@ -14,36 +14,680 @@
 # ==========================================================================
 
 """Utility function to interact with the file system."""
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+import fnmatch
 import hashlib
+import mmap
 import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+import pynder.db as dbu
+from pynder.resultset import ScanResultSet
+import pynder.stats as perf
+
+def _matches(entry: os.DirEntry, relative: str, patterns: Iterable[str]) -> bool:
+    return any(fnmatch.fnmatch(entry.name, p) or fnmatch.fnmatch(relative, p) for p in patterns)
+
+
+def walk_files(path: str, include: Iterable[str]=None, exclude: Iterable[str]=None, max_depth: int=None,
+               follow_symlinks: bool=False, skip_hidden: bool=False, skip_dirs: Iterable[str]=(),
+               onerror: Callable[[OSError], None]=None) -> Iterator[os.DirEntry]:
+    """Lazily yields the files found under a directory.
+
+    The tree is visited with an explicit stack, so its depth is not bound
+    by the recursion limit, and each directory is read with `os.scandir`
+    one entry at a time. The yielded `os.DirEntry` objects cache their
+    stat results, which saves a system call per file on most platforms.
+
+    Glob patterns are matched against both the entry name and its path
+    relative to `path` (e.g. `*.pdf` or `books/*`). Excluded directories
+    are not visited at all.
+
+    Args:
+        path (str): The root directory.
+        include (Iterable[str], optional): Only files matching one of these patterns are yielded. Defaults to None (all).
+        exclude (Iterable[str], optional): Files and directories matching these patterns are skipped. Defaults to None.
+        max_depth (int, optional): Deepest level visited, `0` only lists `path`. Defaults to None (unbounded).
+        follow_symlinks (bool, optional): Follow symbolic links to files and directories. Defaults to False.
+        skip_hidden (bool, optional): Skip files and directories whose name starts with a dot. Defaults to False.
+        skip_dirs (Iterable[str], optional): Names of directories never visited (e.g. ".git"). Defaults to ().
+        onerror (Callable[[OSError], None], optional): Called with errors raised listing a directory
+            instead of raising them. Defaults to None (raise).
+
+    Yields:
+        os.DirEntry: An entry for each regular file.
+    """
+    include = list(include) if include else None
+    exclude = list(exclude) if exclude else []
+    skip_dirs = set(skip_dirs)
+    visited = set()
+    if follow_symlinks:
+        st = os.stat(path)
+        visited.add((st.st_dev, st.st_ino))
+    stack = [(path, "", 0)]
+    while stack:
+        current, prefix, depth = stack.pop()
+        subdirs = []
+        start = perf.clock() if perf.enabled else None
+        files = 0
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if skip_hidden and entry.name.startswith("."):
+                        continue
+                    relative = prefix + entry.name
+                    if exclude and _matches(entry, relative, exclude):
+                        continue
+                    try:
+                        if entry.is_dir(follow_symlinks=follow_symlinks):
+                            if entry.name in skip_dirs or (max_depth is not None and depth >= max_depth):
+                                continue
+                            if follow_symlinks:
+                                st = entry.stat()
+                                if (st.st_dev, st.st_ino) in visited:
+                                    continue
+                                visited.add((st.st_dev, st.st_ino))
+                            subdirs.append((entry.path, relative + "/"))
+                        elif entry.is_file(follow_symlinks=follow_symlinks):
+                            if include is None or _matches(entry, relative, include):
+                                files += 1
+                                if start is None:
+                                    yield entry
+                                else:
+                                    # Time spent by the consumer is not walking time
+                                    paused = perf.clock()
+                                    yield entry
+                                    start += perf.clock() - paused
+                    except OSError as e:
+                        if onerror is None:
+                            raise
+                        onerror(e)
+        except OSError as e:
+            if onerror is None:
+                raise
+            onerror(e)
+        if start is not None:
+            perf.record("fs.walk_files", start, items=files)
+        # Reversed so that subdirectories are visited in listing order
+        stack.extend((d, relative, depth + 1) for d, relative in reversed(subdirs))
+
+
+def list_directory(path: str, skip_hidden: bool=False, skip_dirs: Iterable[str]=(),
+                   onerror: Callable[[OSError], None]=None) -> tuple[list[os.DirEntry], list[str]]:
+    """Lists a single directory, without following symbolic links.
+
+    Args:
+        path (str): The directory.
+        skip_hidden (bool, optional): Skip files and directories whose name starts with a dot. Defaults to False.
+        skip_dirs (Iterable[str], optional): Names of directories left out (e.g. ".git"). Defaults to ().
+        onerror (Callable[[OSError], None], optional): Called with errors raised listing the directory
+            instead of raising them, the directory then looks empty. Defaults to None (raise).
+
+    Returns:
+        tuple[list[os.DirEntry], list[str]]: The regular files and the paths of the subdirectories.
+    """
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if skip_hidden and entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in skip_dirs:
+                            subdirs.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append(entry)
+                except OSError as e:
+                    if onerror is None:
+                        raise
+                    onerror(e)
+    except OSError as e:
+        if onerror is None:
+            raise
+        onerror(e)
+    return files, subdirs
+
 
 def for_each_file(path, operation, recursive=True):
-    dirs = []
-    for item in os.scandir(path):
-        if item.is_dir():
-            dirs.append(item.path)
-        if item.is_file(follow_symlinks=False):
-            operation(item.path)
-    if recursive:
-        for d in dirs:
-            for_each_file(d, operation, recursive)
-
-
-def hash_file(path: str, algorithm: str="md5") -> str:
+    for entry in walk_files(path, max_depth=None if recursive else 0):
+        operation(entry.path)
+
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# Files at least this large are hashed from a memory map, see `hash_file_multi`
+DEFAULT_MMAP_THRESHOLD = 16 * 1024 * 1024
+
+
+def _advise(fd: int, advice: str):
+    """Passes a `posix_fadvise` hint for the whole file, where supported."""
+    if hasattr(os, "posix_fadvise") and hasattr(os, advice):
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+
+def _hash_mapped(f, size: int, hashes: list, buffer_size: int) -> bool:
+    """Feeds `hashes` from a read-only map of `f`, returns `False` if the file can't be mapped."""
+    try:
+        mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return False
+    with mapped:
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mapped) as view:
+            for offset in range(0, size, buffer_size):
+                with view[offset:offset + buffer_size] as chunk:
+                    for h in hashes:
+                        h.update(chunk)
+    return True
+
+
+def hash_file_multi(path: str, algorithms: tuple[str, ...]=("md5",), buffer_size: int=DEFAULT_BUFFER_SIZE,
+                    mmap_threshold: int | None=DEFAULT_MMAP_THRESHOLD) -> dict[str, str]:
+    """Computes several digests of a file reading its content only once.
+
+    The file is streamed through a single preallocated buffer of
+    `buffer_size` bytes (filled with `readinto`), each chunk being fed to
+    all the requested hash objects. Memory usage is therefore bounded by
+    the buffer size regardless of the size of the file.
+
+    Files of at least `mmap_threshold` bytes are instead memory mapped and
+    hashed through `memoryview` slices of the map, with no copy into
+    Python objects. The kernel is told the file is read sequentially and,
+    once hashed, that its pages are no longer needed, so large scans don't
+    evict the rest of the page cache. If the file can't be mapped (e.g. on
+    some network file systems) it is read with the buffer.
+
+    Args:
+        path (str): The path of the file to hash.
+        algorithms (tuple[str, ...], optional): Names of the `hashlib` algorithms to compute. Defaults to ("md5",).
+        buffer_size (int, optional): Size in bytes of the read buffer. Defaults to `DEFAULT_BUFFER_SIZE`.
+        mmap_threshold (int | None, optional): Minimum size of mapped files, `None` never maps.
+            Defaults to `DEFAULT_MMAP_THRESHOLD`.
+
+    Returns:
+        dict[str, str]: Maps each algorithm name to the hex digest of the file.
+    """
     if not os.path.isfile(path):
         raise IOError(f'File not found: ${path}')
-    content = None
-    with open(path, 'rb') as f:
-        content = f.read()
-    if not content:
-        raise Exception('Unable to read file content')
+    if buffer_size <= 0:
+        raise ValueError(f'Invalid buffer size: {buffer_size}')
+    start = perf.clock() if perf.enabled else None
+    hashes = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    total = 0
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        large = mmap_threshold is not None and size >= mmap_threshold
+        if large:
+            _advise(f.fileno(), "POSIX_FADV_SEQUENTIAL")
+        if large and size > 0 and _hash_mapped(f, size, list(hashes.values()), buffer_size):
+            total = size
+        else:
+            buffer = bytearray(buffer_size)
+            view = memoryview(buffer)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                chunk = view[:n]
+                for h in hashes.values():
+                    h.update(chunk)
+                total += n
+        if large:
+            _advise(f.fileno(), "POSIX_FADV_DONTNEED")
+    if start is not None:
+        perf.record("fs.hash_file", start, nbytes=total)
+    return {algorithm: h.hexdigest() for algorithm, h in hashes.items()}
+
+
+def hash_file(path: str, algorithm: str="md5", buffer_size: int=DEFAULT_BUFFER_SIZE,
+              mmap_threshold: int | None=DEFAULT_MMAP_THRESHOLD) -> str:
+    return hash_file_multi(path, (algorithm,), buffer_size, mmap_threshold)[algorithm]
+
+
+class FileSignature(NamedTuple):
+    """The stat fields telling whether a file may have changed since it was hashed."""
+    device: int
+    inode: int
+    size: int
+    mtime_ns: int
+
+    @classmethod
+    def from_stat(cls, st: os.stat_result) -> "FileSignature":
+        return cls(st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class HashResult(NamedTuple):
+    """The outcome of hashing a single file."""
+    digest: str
+    path: str
+    size: int
+    signature: FileSignature = None
+    cached: bool = False
+
+
+@dataclass
+class ScanStats:
+    """Throughput counters filled by `hash_files`.
+
+    `files` counts every result while `bytes` only counts the content
+    actually read, files answered by the cache are counted in `cached`.
+    Paths that could not be listed are collected in `skipped` when `skip`
+    is passed as the `onerror` of `walk_files` or `list_directory`.
+    """
+    files: int = 0
+    bytes: int = 0
+    cached: int = 0
+    seconds: float = 0.0
+    skipped: list[str] = field(default_factory=list)
+
+    def skip(self, error: OSError):
+        """Records the path of a listing error instead of raising it."""
+        self.skipped.append(os.fsdecode(error.filename) if error.filename is not None else str(error))
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.bytes / (1024 * 1024) / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.files} file(s) ({self.cached} cached), {self.bytes / (1024 * 1024):.1f} MB in {self.seconds:.2f}s "
+            f"({self.files_per_second:.1f} files/s, {self.mb_per_second:.1f} MB/s)"
+            + (f", {len(self.skipped)} path(s) skipped" if self.skipped else "")
+        )
+
+
+def iter_files(path: str, max_queued: int=1024, **walk_options) -> Iterator[os.DirEntry]:
+    """Yields the files under `path` walking the tree in the background.
+
+    The directory is walked by `walk_files` in a producer thread which
+    also fetches the stat of each entry and pushes it into a queue holding
+    at most `max_queued` items. When the consumer falls behind, the
+    producer blocks, so the walk never runs too far ahead of the hashing.
+    Closing the generator early stops the producer. Files disappearing
+    before they can be stat'ed are skipped.
+
+    Args:
+        path (str): The directory to walk.
+        max_queued (int, optional): Maximum number of entries waiting to be consumed. Defaults to 1024.
+        **walk_options: Filters forwarded to `walk_files`.
+
+    Yields:
+        os.DirEntry: The entry of each file found, its stat already cached.
+    """
+    entries = queue.Queue(maxsize=max_queued)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                entries.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for entry in walk_files(path, **walk_options):
+                try:
+                    entry.stat()
+                except OSError:
+                    continue
+                if not put(entry):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+
+    producer = threading.Thread(target=produce, name="pynder-walk", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = entries.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+def _path_of(item: str | os.DirEntry) -> str:
+    return item.path if isinstance(item, os.DirEntry) else item
+
+
+def _hash_job(path: str, signature: FileSignature, algorithm: str, buffer_size: int) -> HashResult:
+    digest = hash_file(path, algorithm, buffer_size)
+    return HashResult(digest, path, signature.size, signature)
+
+
+def hash_files(paths: Iterable[str | os.DirEntry], workers: int=None, algorithm: str="md5", processes: bool=False,
+               max_pending: int=None, buffer_size: int=DEFAULT_BUFFER_SIZE, stats: ScanStats=None,
+               cache: Callable[[FileSignature], str | None]=None) -> Iterator[HashResult]:
+    """Hashes many files concurrently, yielding results as they complete.
+
+    Paths (or `os.DirEntry` objects, whose cached stat is then reused) are
+    pulled lazily from `paths` and submitted to a pool of
+    `workers` threads (or processes when `processes` is `True`). At most
+    `max_pending` files are in flight at any time: once the limit is hit
+    no more paths are consumed until some result has been yielded, which
+    keeps memory bounded for arbitrarily large trees. Results are yielded
+    in completion order, not in the order of `paths`.
+
+    Threads are usually enough since `hashlib` releases the GIL while
+    hashing large buffers; processes may help with many small files.
+
+    When `cache` is given it is called, from the calling thread, with the
+    `FileSignature` of each file: if it returns a digest the file is not
+    read at all and the result is yielded with `cached` set.
+
+    Args:
+        paths (Iterable[str | os.DirEntry]): The files to hash.
+        workers (int, optional): Size of the pool, `1` hashes serially. Defaults to None (CPU count).
+        algorithm (str, optional): The `hashlib` algorithm. Defaults to "md5".
+        processes (bool, optional): Use a process pool instead of threads. Defaults to False.
+        max_pending (int, optional): Maximum number of files in flight. Defaults to None (twice the workers).
+        buffer_size (int, optional): Read buffer used by each worker. Defaults to `DEFAULT_BUFFER_SIZE`.
+        stats (ScanStats, optional): If given, it is updated with files, bytes and elapsed time.
+        cache (Callable, optional): Returns the known digest for a signature, or `None`. Defaults to None.
+
+    Yields:
+        HashResult: The digest, path, size and signature of each file.
+    """
+    if stats is None:
+        stats = ScanStats()
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    start = time.perf_counter()
+
+    def account(result):
+        stats.files += 1
+        if result.cached:
+            stats.cached += 1
+        else:
+            stats.bytes += result.size
+        return result
+
+    def lookup(item):
+        if isinstance(item, os.DirEntry):
+            path, st = item.path, item.stat()
+        else:
+            path, st = item, os.stat(item)
+        signature = FileSignature.from_stat(st)
+        digest = cache(signature) if cache else None
+        if digest is None:
+            return signature, None
+        return signature, HashResult(digest, path, signature.size, signature, cached=True)
+
+    try:
+        if workers == 1:
+            for item in paths:
+                signature, result = lookup(item)
+                if result is None:
+                    result = _hash_job(_path_of(item), signature, algorithm, buffer_size)
+                yield account(result)
+            return
+        executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        executor = executor_class(max_workers=workers)
+        pending = set()
+        try:
+            for item in paths:
+                signature, result = lookup(item)
+                if result is not None:
+                    yield account(result)
+                    continue
+                pending.add(executor.submit(_hash_job, _path_of(item), signature, algorithm, buffer_size))
+                if len(pending) < max_pending:
+                    continue
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield account(future.result())
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield account(future.result())
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    finally:
+        stats.seconds += time.perf_counter() - start
+
+
+# Bytes read from each end of a file by `partial_hash`
+PARTIAL_HASH_SIZE = 4096
+
+
+def partial_hash(path: str, size: int, block_size: int=PARTIAL_HASH_SIZE, algorithm: str="md5") -> str:
+    """Hashes only the first and last `block_size` bytes of a file.
+
+    Two files with different partial hashes certainly differ, while equal
+    partial hashes only make them candidates for a full comparison. Files
+    not larger than two blocks are read entirely.
+
+    Args:
+        path (str): The path of the file.
+        size (int): The size of the file, as known from its stat.
+        block_size (int, optional): Bytes read at each end. Defaults to `PARTIAL_HASH_SIZE`.
+        algorithm (str, optional): The `hashlib` algorithm. Defaults to "md5".
+
+    Returns:
+        str: The hex digest of the head and tail of the file.
+    """
     h = hashlib.new(algorithm)
-    h.update(content)
+    with open(path, 'rb') as f:
+        h.update(f.read(block_size))
+        if size > 2 * block_size:
+            f.seek(size - block_size)
+        h.update(f.read(block_size))
     return h.hexdigest()
 
 
-def db_for_dir(dir_path):
-    files = []
-    for_each_file(dir_path, lambda x: files.append(
-        (hash_file(x), x)), recursive=True)
-    return files
\ No newline at end of file
+def find_duplicates(paths: Iterable[str | os.DirEntry], workers: int=None, block_size: int=PARTIAL_HASH_SIZE,
+                    min_size: int=1, stats: ScanStats=None,
+                    cache: Callable[[FileSignature], str | None]=None) -> Iterator[list[HashResult]]:
+    """Finds groups of files with identical content reading as little as possible.
+
+    Files are first grouped by size, which only needs their stat. Files
+    with a unique size cannot have duplicates and are never opened. The
+    remaining candidates are split by `partial_hash` and only those still
+    sharing size and partial hash are fully hashed by `hash_files`.
+
+    Args:
+        paths (Iterable[str | os.DirEntry]): The files to compare.
+        workers (int, optional): Number of hashing workers. Defaults to None (CPU count).
+        block_size (int, optional): Bytes read at each end by the partial hash. Defaults to `PARTIAL_HASH_SIZE`.
+        min_size (int, optional): Smaller files are ignored. Defaults to 1 (skip empty files).
+        stats (ScanStats, optional): Updated with the bytes read by both hashing stages.
+        cache (Callable, optional): Stat cache lookup forwarded to `hash_files`. Defaults to None.
+
+    Yields:
+        list[HashResult]: Each group of two or more files with the same digest.
+    """
+    if stats is None:
+        stats = ScanStats()
+    by_size = {}
+    for item in paths:
+        st = item.stat() if isinstance(item, os.DirEntry) else os.stat(item)
+        if st.st_size < min_size:
+            continue
+        by_size.setdefault(st.st_size, []).append(_path_of(item))
+    candidates = [(path, size) for size, group in by_size.items() if len(group) > 1 for path in group]
+    del by_size
+
+    start = time.perf_counter()
+    by_partial = {}
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        digests = executor.map(lambda c: partial_hash(c[0], c[1], block_size), candidates)
+        for (path, size), digest in zip(candidates, digests):
+            by_partial.setdefault((size, digest), []).append(path)
+            stats.bytes += min(size, 2 * block_size)
+    stats.seconds += time.perf_counter() - start
+    survivors = (path for group in by_partial.values() if len(group) > 1 for path in group)
+
+    by_digest = {}
+    for result in hash_files(survivors, workers=workers, stats=stats, cache=cache):
+        by_digest.setdefault(result.digest, []).append(result)
+    for group in by_digest.values():
+        if len(group) > 1:
+            yield group
+
+
+# Content-defined chunking parameters, see `chunk_file`
+CHUNK_MIN_SIZE = 2 * 1024
+CHUNK_AVG_SIZE = 8 * 1024
+CHUNK_MAX_SIZE = 64 * 1024
+
+_MASK64 = (1 << 64) - 1
+
+# Random 64 bit values for each byte value, fixed so that chunk boundaries are stable
+_GEAR = [int.from_bytes(hashlib.blake2b(bytes([b]), digest_size=8).digest(), "big") for b in range(256)]
+
+
+def _chunk_masks(avg_size: int) -> tuple[int, int]:
+    # Normalized chunking: harder to cut before the average size, easier after.
+    # High bits are used as they depend on the last 64 bytes, not only the last one.
+    bits = max(avg_size.bit_length() - 1, 3)
+    strict = ((1 << (bits + 2)) - 1) << (64 - bits - 2)
+    loose = ((1 << (bits - 2)) - 1) << (64 - bits + 2)
+    return strict, loose
+
+
+def _find_cut(data: memoryview, n: int, min_size: int, avg_size: int, strict: int, loose: int) -> int:
+    """Returns the length of the chunk starting at `data[0]`, `n` being the bytes available."""
+    if n <= min_size:
+        return n
+    h = 0
+    gear = _GEAR
+    normal = min(avg_size, n)
+    i = min_size
+    for b in data[min_size:normal]:
+        h = ((h << 1) + gear[b]) & _MASK64
+        i += 1
+        if not h & strict:
+            return i
+    for b in data[normal:n]:
+        h = ((h << 1) + gear[b]) & _MASK64
+        i += 1
+        if not h & loose:
+            return i
+    return n
+
+
+def chunk_hash(chunk: bytes | memoryview) -> int:
+    """Returns a signed 64 bit hash of a chunk, compact enough to be an SQLite integer."""
+    return int.from_bytes(hashlib.blake2b(chunk, digest_size=8).digest(), "big", signed=True)
+
+
+def chunk_file(path: str, min_size: int=CHUNK_MIN_SIZE, avg_size: int=CHUNK_AVG_SIZE,
+               max_size: int=CHUNK_MAX_SIZE) -> Iterator[tuple[int, int, int]]:
+    """Splits a file in content-defined chunks.
+
+    Boundaries are placed where a rolling gear hash of the content matches
+    a mask (FastCDC with normalized chunking), so they only depend on the
+    bytes around them: inserting or removing data only changes the chunks
+    next to the edit and two files sharing a region share its chunks.
+
+    Chunking is done in pure Python and is far slower than hashing, which
+    is why it is an optional stage run by `task.index_chunks`.
+
+    Args:
+        path (str): The path of the file.
+        min_size (int, optional): Minimum chunk size. Defaults to `CHUNK_MIN_SIZE`.
+        avg_size (int, optional): Target average chunk size. Defaults to `CHUNK_AVG_SIZE`.
+        max_size (int, optional): Maximum chunk size. Defaults to `CHUNK_MAX_SIZE`.
+
+    Yields:
+        tuple[int, int, int]: The offset, length and `chunk_hash` of each chunk.
+    """
+    strict, loose = _chunk_masks(avg_size)
+    data = bytearray()
+    offset = 0
+    eof = False
+    with open(path, 'rb') as f:
+        while True:
+            if not eof and len(data) < max_size:
+                block = f.read(max(DEFAULT_BUFFER_SIZE, max_size))
+                eof = not block
+                data += block
+                continue
+            if not data:
+                break
+            with memoryview(data) as view:
+                n = min(len(data), max_size)
+                cut = _find_cut(view, n, min_size, avg_size, strict, loose)
+                yield offset, cut, chunk_hash(view[:cut])
+            del data[:cut]
+            offset += cut
+
+
+def _chunk_job(path: str) -> list[tuple[int, int, int]] | None:
+    try:
+        return list(chunk_file(path))
+    except OSError:
+        return None
+
+
+def chunk_files(paths: Iterable[str], workers: int=None) -> Iterator[list[tuple[int, int, int]] | None]:
+    """Chunks many files, in a process pool when `workers` is not `1`.
+
+    Chunking is CPU bound Python code, so threads would not run in
+    parallel. Results are yielded in the order of `paths`, `None` for the
+    files that could not be read.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from map(_chunk_job, paths)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(_chunk_job, paths, chunksize=8)
+
+
+def db_for_dir(dir_path, workers: int=None, db: sqlite3.Connection=None, verify: bool=False, **walk_options):
+    """Hashes all the files under a directory.
+
+    If a database is given, files whose stat signature matches an entry
+    of its stat cache are not read again, and the cache is refreshed with
+    the files that have been hashed. Setting `verify` hashes every file
+    regardless of the cache.
+
+    Args:
+        dir_path (str): The directory to scan.
+        workers (int, optional): Number of hashing workers. Defaults to None (CPU count).
+        db (sqlite3.Connection, optional): Database holding the stat cache. Defaults to None.
+        verify (bool, optional): Ignore cached digests. Defaults to False.
+        **walk_options: Filters forwarded to `walk_files`.
+
+    Returns:
+        ScanResultSet: The digest, path, size and mtime of every file, `tuples()` gives the
+            `(digest, path)` pairs.
+    """
+    cache = None
+    if db is not None and not verify:
+        cache = lambda signature: dbu.cached_hash(db, signature)
+    files = ScanResultSet()
+    fresh = []
+    for result in hash_files(iter_files(dir_path, **walk_options), workers=workers, cache=cache):
+        files.append(result.digest, result.path, result.size, result.signature.mtime_ns)
+        if not result.cached:
+            fresh.append((result.signature, result.digest))
+    if db is not None:
+        dbu.cache_hashes(db, fresh)
+    return files
@@ -17,50 +17,199 @@ import os
 import sqlite3
 import sys
 
-from db import list_of_files, list_of_repository, has_schema, create_schema
-from task import add_repo
+from pynder.db import connect, count_files, count_repository, duplicates_by_repository, page_of_files, page_of_repository, reclaimable_bytes, search, unfinished_scan_jobs, has_schema, create_schema, upgrade_schema
+from pynder.bloom import known_hashes
+from pynder.task import add_repo, find_duplicates, index_chunks, merge_db, rescan_repo, resume_scan, scan_and_add_directory
+import pynder.stats as perf
 
-def open_or_create_db(path: str, overwrite: bool = True) -> sqlite3.Connection:
-    connection = sqlite3.connect(path)
-    if (not has_schema(connection.cursor())) and overwrite:
-        create_schema(connection)
+def open_or_create_db(path: str, overwrite: bool = True, profile: str = "interactive") -> sqlite3.Connection:
+    connection = connect(path, profile)
+    if not has_schema(connection.cursor()):
+        if overwrite:
+            create_schema(connection)
+    else:
+        upgrade_schema(connection)
     return connection
 
-def main():
-    file = os.path.expanduser("~/.pynder.sqlite")
-    if (len(sys.argv) > 1):
-        file = sys.argv[1]
+def print_progress(progress):
+    print(f"      {progress}")
+
+def add_and_scan_repo(con: sqlite3.Connection, path: str, desc: str, known=None):
+    repo = add_repo(con, path, desc)
+    if repo is not None:
+        # The first scan is resumable, if interrupted it is continued by the 'resume' command
+        added = scan_and_add_directory(con, path, known=known, repository=repo, resumable=True,
+                                       progress=print_progress,
+                                       report=lambda stats: print(f"      Repository {repo}: {stats}"))
+        print(f"      {added} new file(s)")
+
+# Rows shown by the 'file' and 'repo' commands unless a page size is given
+DEFAULT_PAGE_SIZE = 20
+
+def main(file: str = None):
+    if file is None:
+        file = os.path.expanduser("~/.pynder.sqlite")
+        if (len(sys.argv) > 1):
+            file = sys.argv[1]
     print(f"Using file {file}")
     print()
     con = open_or_create_db(file)
+    # Filter of the known hashes, kept next to the DB between sessions
+    snapshot = f"{file}.bloom"
+    known = known_hashes(con, snapshot)
     running = True
+    page_size = DEFAULT_PAGE_SIZE
+    last_file = None
+    last_repo = None
+    last_query = None
+    search_offset = 0
     while running:
-        command = input(f"{os.path.basename(file)}> ")
+        words = input(f"{os.path.basename(file)}> ").split()
+        command = words[0] if words else ""
+        args = words[1:]
         if command.lower() == 'help' or command.lower() == 'h':
             print()
             print("  Available commands")
             print("  ------------------")
             print("     q | quit  --> Exit the program")
             print("     h | help  --> Show this message")
-            print("     f | file  --> Show file table")
-            print("     r | repo  --> Show repository table")
+            print("     f | file  --> Show file table (first page, 'f next' or 'f <n>' with n rows per page)")
+            print("     r | repo  --> Show repository table (first page, 'r next' or 'r <n>' with n rows per page)")
+            print("     s | search--> Full-text search of paths and publications ('s <words>', 's next')")
             print("     addrepo   --> Scan directory 'd' and adds to repo")
+            print("     resume    --> Continue an interrupted scan")
+            print("     rescan    --> Update the files of a repository with the changes on disk")
+            print("     watch     --> Keep all repositories in sync until Ctrl-C is pressed")
+            print("     dupes     --> Find duplicated files in a repository and show duplicates per repository")
+            print("     merge     --> Merge another database ('merge full' reads all its rows again)")
+            print("     chunks    --> Index the chunks of a repository and show reclaimable bytes per repository")
+            print("     stats     --> Show per-stage counters ('stats on', 'stats off', 'stats reset')")
+            print("     profile   --> Like addrepo, under cProfile and tracemalloc")
             print()
         elif command.lower() == 'quit' or command.lower() == 'q':
             print("     Bye Bye...\n")
             running = False
+            known.save(snapshot)
         elif command.lower() == 'file' or command.lower() == 'f':
-            records = list_of_files(con)
+            if args and args[0].isdigit():
+                page_size = int(args[0])
+            if not args or args[0] != 'next':
+                last_file = None
+            records = page_of_files(con, after=last_file, limit=page_size)
             for record in records:
                 print("      ", record)
-            print(f"      {len(records)} Total record(s)")
+            if records:
+                last_file = records[-1]
+            print(f"      {count_files(con)} Total record(s)")
         elif command.lower() == 'repo' or command.lower() == 'r':
-            records = list_of_repository(con)
-            print(f"      {len(records)} Total repositories")
-        elif command.lower() == 'addrepo':
+            if args and args[0].isdigit():
+                page_size = int(args[0])
+            if not args or args[0] != 'next':
+                last_repo = None
+            records = page_of_repository(con, after=last_repo, limit=page_size)
+            for record in records:
+                print("      ", record)
+            if records:
+                last_repo = records[-1][0]
+            print(f"      {count_repository(con)} Total repositories")
+        elif command.lower() == 'search' or command.lower() == 's':
+            if args and args != ['next']:
+                last_query = " ".join(args)
+                search_offset = 0
+            elif args and last_query is not None:
+                search_offset += page_size
+            if last_query is None:
+                print("      Usage: search <words>")
+                continue
+            records = search(con, last_query, limit=page_size, offset=search_offset)
+            for record in records:
+                print("      ", record)
+            print(f"      {len(records)} result(s) from {search_offset + 1}")
+        elif command.lower() == 'addrepo' or command.lower() == 'profile':
             path = input(f"      Directory: ")
             desc = input(f"      Description: ")
-            add_repo(con, os.path.abspath(path), desc)
+            if command.lower() == 'profile':
+                _, report = perf.profile(add_and_scan_repo, con, os.path.abspath(path), desc, known)
+                print(report)
+            else:
+                try:
+                    add_and_scan_repo(con, os.path.abspath(path), desc, known)
+                except KeyboardInterrupt:
+                    print("\n      Interrupted, type 'resume' to continue")
+        elif command.lower() == 'merge':
+            path = input(f"      Database: ")
+            try:
+                added = merge_db(con, os.path.expanduser(path), incremental=not (args and args[0] == 'full'))
+            except ValueError as e:
+                print(f"      {e}")
+                continue
+            for table, count in added.items():
+                print(f"      {table}: {count} row(s) added")
+        elif command.lower() == 'chunks':
+            repo = input(f"      Repository id: ")
+            try:
+                print(f"      {index_chunks(con, int(repo))} file(s) indexed")
+            except ValueError as e:
+                print(f"      {e}")
+                continue
+            for id_repo, total, reclaimable in reclaimable_bytes(con):
+                print(f"      Repository {id_repo}: {reclaimable / (1024 * 1024):.1f} MB reclaimable "
+                      f"out of {total / (1024 * 1024):.1f} MB")
+        elif command.lower() == 'stats':
+            if args and args[0] in ('on', 'off'):
+                perf.enable(args[0] == 'on')
+            elif args and args[0] == 'reset':
+                perf.reset()
+            print(f"      Instrumentation {'enabled' if perf.enabled else 'disabled'}")
+            for line in perf.report():
+                print("      ", line)
+        elif command.lower() == 'resume':
+            jobs = unfinished_scan_jobs(con)
+            for job_id, path, id_repo, status, started_at, updated_at, directories, files, nbytes, seconds, pending in jobs:
+                print(f"      Job {job_id}: {path} (repository {id_repo}), started {started_at}, "
+                      f"{files} file(s) in {directories} directories done, {pending} pending")
+            if not jobs:
+                print("      No interrupted scan")
+                continue
+            job = input(f"      Job id: ")
+            try:
+                added = resume_scan(con, int(job), known=known, progress=print_progress)
+                print(f"      {added} new file(s)")
+            except ValueError as e:
+                print(f"      {e}")
+            except KeyboardInterrupt:
+                print("\n      Interrupted, type 'resume' to continue")
+        elif command.lower() == 'rescan':
+            repo = input(f"      Repository id: ")
+            try:
+                summary = rescan_repo(con, int(repo), known=known)
+            except ValueError as e:
+                print(f"      {e}")
+                continue
+            print(f"      {summary} ({summary.stats})")
+        elif command.lower() == 'watch':
+            from pynder.watch import Watcher
+            watcher = Watcher(con, report=lambda message: print(f"      {message}"))
+            print(f"      Watching {watcher.watch_repositories()} directories, press Ctrl-C to stop")
+            try:
+                watcher.run()
+            except KeyboardInterrupt:
+                print()
+            finally:
+                watcher.close()
+        elif command.lower() == 'dupes':
+            repo = input(f"      Repository id: ")
+            try:
+                groups = find_duplicates(con, int(repo), report=lambda stats: print(f"      {stats}"))
+            except ValueError as e:
+                print(f"      {e}")
+                continue
+            for md5, paths in groups.items():
+                print("      ", md5)
+                for path in paths:
+                    print("          ", path)
+            for id_repo, contents, copies in duplicates_by_repository(con):
+                print(f"      Repository {id_repo}: {contents} duplicated file(s), {copies} redundant copies")
         else:
             print(f"      Command '{command}' not recognized, type 'h' for help.")
     con.close()
@@ -0,0 +1,257 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+
+"""A compact, columnar container for the results of a scan.
+
+A list of `(hexdigest, path)` tuples costs well over a hundred bytes per
+file in object headers alone. `ScanResultSet` keeps each column in a
+single buffer instead: the raw digests back to back in a `bytearray`,
+sizes and mtimes in `array('q')`, and the encoded paths concatenated in
+one `bytearray` with their end offsets in another `array('q')`. A file
+then takes 40 bytes (for md5 digests) plus its encoded path.
+
+Records are only built as Python objects when they are read, and bulk
+inserts pass the raw digests straight to SQLite. Sorting and grouping
+first distribute the row indices in buckets by the leading bytes of
+their digest, then sort one bucket at a time, so only the digest slices
+of a single bucket exist at once.
+"""
+from array import array
+from collections.abc import Iterable, Iterator, Sequence
+import os
+import sqlite3
+from typing import TYPE_CHECKING, NamedTuple
+
+import pynder.db as dbu
+
+if TYPE_CHECKING:
+    from pynder.bloom import BloomFilter
+
+# Size of the md5 digests stored by default
+DEFAULT_DIGEST_SIZE = 16
+
+# Leading digest bytes used to bucket the rows before sorting them
+_BUCKET_BYTES = 2
+
+
+class ScanResult(NamedTuple):
+    """A file of a `ScanResultSet`."""
+    digest: str
+    path: str
+    size: int
+    mtime_ns: int
+
+
+class ScanResultSet(Sequence):
+    """The digest, path, size and mtime of many files, stored by column.
+
+    Indexing returns a `ScanResult`, slicing returns a new set holding
+    copies of the selected rows. `tuples()` is a view of the rows as the
+    `(digest, path)` pairs formerly returned by `fs.db_for_dir`.
+    """
+
+    def __init__(self, digest_size: int=DEFAULT_DIGEST_SIZE):
+        self.digest_size = digest_size
+        self.digests = bytearray()
+        self.sizes = array("q")
+        self.mtimes = array("q")
+        self.paths = bytearray()
+        # End of each path in `paths`, the first one starts at 0
+        self.offsets = array("q")
+
+    @classmethod
+    def from_results(cls, results: Iterable, digest_size: int=DEFAULT_DIGEST_SIZE) -> "ScanResultSet":
+        """Builds a set from `fs.HashResult`s, or any object with the same attributes."""
+        result_set = cls(digest_size)
+        for result in results:
+            mtime_ns = result.signature.mtime_ns if result.signature is not None else 0
+            result_set.append(result.digest, result.path, result.size, mtime_ns)
+        return result_set
+
+    def append(self, digest: str | bytes, path: str, size: int=0, mtime_ns: int=0):
+        if isinstance(digest, str):
+            digest = bytes.fromhex(digest)
+        if len(digest) != self.digest_size:
+            raise ValueError(f"Expected a digest of {self.digest_size} bytes, got {len(digest)}")
+        self.digests += digest
+        self.sizes.append(size)
+        self.mtimes.append(mtime_ns)
+        self.paths += os.fsencode(path)
+        self.offsets.append(len(self.paths))
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def _index(self, i: int) -> int:
+        return range(len(self))[i]
+
+    def digest(self, i: int) -> bytes:
+        """The raw digest of the `i`-th file."""
+        i = self._index(i)
+        return bytes(self.digests[i * self.digest_size:(i + 1) * self.digest_size])
+
+    def path(self, i: int) -> str:
+        i = self._index(i)
+        start = self.offsets[i - 1] if i > 0 else 0
+        return os.fsdecode(bytes(self.paths[start:self.offsets[i]]))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                return self._slice(start, max(start, stop))
+            return self.take(range(start, stop, step))
+        i = self._index(i)
+        return ScanResult(self.digest(i).hex(), self.path(i), self.sizes[i], self.mtimes[i])
+
+    def __iter__(self) -> Iterator[ScanResult]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def _slice(self, start: int, stop: int) -> "ScanResultSet":
+        result_set = ScanResultSet(self.digest_size)
+        result_set.digests = self.digests[start * self.digest_size:stop * self.digest_size]
+        result_set.sizes = self.sizes[start:stop]
+        result_set.mtimes = self.mtimes[start:stop]
+        base = self.offsets[start - 1] if start > 0 else 0
+        end = self.offsets[stop - 1] if stop > 0 else 0
+        result_set.paths = self.paths[base:end]
+        result_set.offsets = array("q", (offset - base for offset in self.offsets[start:stop]))
+        return result_set
+
+    def take(self, indices: Iterable[int]) -> "ScanResultSet":
+        """Returns a new set with the rows at `indices`, in their order."""
+        result_set = ScanResultSet(self.digest_size)
+        digests = memoryview(self.digests)
+        paths = memoryview(self.paths)
+        size = self.digest_size
+        for i in indices:
+            i = self._index(i)
+            start = self.offsets[i - 1] if i > 0 else 0
+            result_set.digests += digests[i * size:(i + 1) * size]
+            result_set.sizes.append(self.sizes[i])
+            result_set.mtimes.append(self.mtimes[i])
+            result_set.paths += paths[start:self.offsets[i]]
+            result_set.offsets.append(len(result_set.paths))
+        return result_set
+
+    @property
+    def nbytes(self) -> int:
+        """The bytes taken by the buffers of the set."""
+        return (len(self.digests) + len(self.paths)
+                + (len(self.sizes) + len(self.mtimes) + len(self.offsets)) * self.sizes.itemsize)
+
+    def _sorted_buckets(self) -> Iterator[list[int]]:
+        """Yields the row indices in digest order, one bucket of digests sharing their leading bytes at a time.
+
+        Uniformly distributed digests spread evenly over the 256 or 65536
+        buckets, so keys are only built for the rows of the bucket being
+        sorted, while the indices of all the rows wait in arrays of 8 bytes
+        per row.
+        """
+        digests = self.digests
+        size = self.digest_size
+        count = len(self)
+        # At least 256 rows per bucket on average, a single bucket for small sets
+        prefix = min(size, _BUCKET_BYTES, max(0, (count.bit_length() - 1) // 8 - 1))
+        buckets = [array("q") for _ in range(256 ** prefix)]
+        # The leading bytes of every digest, as strided copies of `count` bytes
+        high = digests[0::size] if prefix == 2 else bytes(count)
+        low = digests[prefix - 1::size] if prefix else bytes(count)
+        for i, (h, l) in enumerate(zip(high, low)):
+            buckets[h << 8 | l].append(i)
+        del high, low
+        for b in range(len(buckets)):
+            bucket, buckets[b] = buckets[b], None
+            if bucket:
+                # Stable, so ties keep their current order
+                yield sorted(bucket, key=lambda i: digests[i * size:(i + 1) * size])
+
+    def argsort(self) -> array:
+        """Returns the indices of the rows in digest order, ties in their current order."""
+        indices = array("q")
+        for bucket in self._sorted_buckets():
+            indices.extend(bucket)
+        return indices
+
+    def sorted(self) -> "ScanResultSet":
+        """Returns a new set with the rows in digest order."""
+        return self.take(self.argsort())
+
+    def groups(self, min_count: int=1) -> Iterator[tuple[str, array]]:
+        """Yields each digest with the indices of its rows, in digest order.
+
+        Args:
+            min_count (int, optional): Skip the digests of fewer rows, 2 yields the duplicates only.
+                Defaults to 1.
+
+        Yields:
+            tuple[str, array]: The hex digest and the indices of the rows holding it.
+        """
+        digests = self.digests
+        size = self.digest_size
+        for bucket in self._sorted_buckets():
+            group = array("q")
+            current = None
+            for i in bucket:
+                digest = digests[i * size:(i + 1) * size]
+                if digest != current:
+                    if len(group) >= min_count and current is not None:
+                        yield current.hex(), group
+                    current, group = digest, array("q")
+                group.append(i)
+            if current is not None and len(group) >= min_count:
+                yield current.hex(), group
+
+    def duplicates(self) -> dict[str, list[str]]:
+        """Returns the paths of each digest held by more than one row."""
+        return {digest: [self.path(i) for i in group] for digest, group in self.groups(min_count=2)}
+
+    def tuples(self) -> "TupleView":
+        """The rows as `(digest, path)` pairs, without copying them."""
+        return TupleView(self)
+
+    def rows(self) -> Iterator[tuple[bytes, str]]:
+        """Yields the `(raw digest, path)` of each row, as taken by `db.add_files`."""
+        for i in range(len(self)):
+            yield self.digest(i), self.path(i)
+
+    def insert(self, db: sqlite3.Connection, repository: int=None, batch_size: int=dbu.DEFAULT_BATCH_SIZE,
+               known: "BloomFilter"=None) -> int:
+        """Adds the files to the database with `db.add_files`, the digests bound as they are stored.
+
+        Returns:
+            int: The total number of rows added to the 'file' table.
+        """
+        return dbu.add_files(db, self.rows(), repository=repository, batch_size=batch_size, known=known)
+
+
+class TupleView(Sequence):
+    """A read-only view of a `ScanResultSet` as a sequence of `(hexdigest, path)` tuples."""
+
+    def __init__(self, result_set: ScanResultSet):
+        self.result_set = result_set
+
+    def __len__(self) -> int:
+        return len(self.result_set)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(len(self))[i]]
+        return self.result_set.digest(i).hex(), self.result_set.path(i)
+
+    def __iter__(self) -> Iterator[tuple[str, str]]:
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,209 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+
+"""Sharded scans run by workers without access to the DB.
+
+A worker hashes one shard of a directory and writes what it found to a
+results file: the digest, size, stat signature and path (relative to the
+scanned root) of each file. Workers only need the files and `pynder`,
+so they can be started on many hosts at once (e.g. with `ssh`), and the
+coordinator then loads every results file into the DB in bulk with
+`task.merge_shards`.
+
+A shard is either a list of subtrees of the root, or the files whose
+relative path hashes to `shard` modulo `shards`, or both. With the hash
+partition each worker still walks the whole tree, but only reads the
+files of its own shard, which is where the time goes.
+
+Results files are a short header followed by one fixed size record and
+the encoded path per file, and end with a trailer holding the number of
+records. They are written under a temporary name and renamed when
+complete, and a file without its trailer is rejected, so the results of
+a worker that died are never loaded in part.
+"""
+from collections.abc import Callable, Iterable, Iterator
+import hashlib
+import os
+import struct
+from typing import NamedTuple
+
+import pynder.fs as fs
+
+_MAGIC = b"PYSR"
+_END = b"PEND"
+_VERSION = 1
+# Magic, version, shard, shards, digest size and length of the encoded root
+_HEADER = struct.Struct("<4sHIIHI")
+# Size, device, inode, mtime_ns and length of the encoded path, followed by the digest
+_RECORD = struct.Struct("<QQQqH")
+_TRAILER = struct.Struct("<4sQ")
+
+
+class ShardRecord(NamedTuple):
+    """A file found by a worker, its path relative to the scanned root."""
+    digest: str
+    path: str
+    size: int
+    signature: fs.FileSignature
+
+
+class ShardResults(NamedTuple):
+    """The header of a results file."""
+    root: str
+    shard: int
+    shards: int
+    files: int
+
+
+def _encode(path: str) -> bytes:
+    return os.fsencode(path)
+
+
+def _decode(data: bytes) -> str:
+    return os.fsdecode(data)
+
+
+def shard_of(relative: str, shards: int) -> int:
+    """Returns the shard of a path relative to the scanned root, the same on every host."""
+    digest = hashlib.blake2b(_encode(relative), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % shards
+
+
+def shard_files(root: str, shard: int=0, shards: int=1, subtrees: Iterable[str]=(),
+                **walk_options) -> Iterator[os.DirEntry]:
+    """Yields the files of a shard of `root`.
+
+    Args:
+        root (str): The scanned directory.
+        shard (int, optional): The shard, from 0 to `shards - 1`. Defaults to 0.
+        shards (int, optional): Number of hash partitions of the paths. Defaults to 1 (every file).
+        subtrees (Iterable[str], optional): Directories relative to `root` to walk instead of the
+            whole of it. Defaults to () (the whole tree).
+        **walk_options: Filters forwarded to `fs.walk_files`.
+
+    Yields:
+        os.DirEntry: The entry of each file of the shard.
+    """
+    if not 0 <= shard < shards:
+        raise ValueError(f"Shard {shard} out of range for {shards} shard(s)")
+    for top in [os.path.join(root, subtree) for subtree in subtrees] or [root]:
+        for entry in fs.iter_files(top, **walk_options):
+            if shards == 1 or shard_of(os.path.relpath(entry.path, root), shards) == shard:
+                yield entry
+
+
+def write_results(path: str, root: str, results: Iterable[fs.HashResult], shard: int=0, shards: int=1) -> int:
+    """Writes hashed files to a results file, atomically replacing an older one.
+
+    Args:
+        path (str): The results file.
+        root (str): The scanned directory, paths are written relative to it.
+        results (Iterable[fs.HashResult]): The hashed files, consumed lazily.
+        shard (int, optional): The shard the results belong to. Defaults to 0.
+        shards (int, optional): Number of shards of the scan. Defaults to 1.
+
+    Returns:
+        int: The number of files written.
+    """
+    root = os.path.abspath(root)
+    encoded_root = _encode(root)
+    temp = f"{path}.tmp"
+    count = 0
+    digest_size = None
+    with open(temp, "wb") as f:
+        for result in results:
+            digest = bytes.fromhex(result.digest)
+            if digest_size is None:
+                # The header is written once the digest size is known
+                digest_size = len(digest)
+                f.write(_HEADER.pack(_MAGIC, _VERSION, shard, shards, digest_size, len(encoded_root)))
+                f.write(encoded_root)
+            relative = _encode(os.path.relpath(result.path, root))
+            signature = result.signature or fs.FileSignature(0, 0, result.size, 0)
+            f.write(_RECORD.pack(result.size, signature.device, signature.inode, signature.mtime_ns, len(relative)))
+            f.write(digest)
+            f.write(relative)
+            count += 1
+        if digest_size is None:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, shard, shards, 0, len(encoded_root)))
+            f.write(encoded_root)
+        f.write(_TRAILER.pack(_END, count))
+    os.replace(temp, path)
+    return count
+
+
+def _read_exactly(f, size: int, path: str) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        raise ValueError(f"Truncated results file: {path}")
+    return data
+
+
+def read_header(path: str) -> ShardResults:
+    """Reads the header and trailer of a results file, raising `ValueError` if it is not a complete one."""
+    with open(path, "rb") as f:
+        magic, version, shard, shards, _, root_size = _HEADER.unpack(_read_exactly(f, _HEADER.size, path))
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"Not a results file: {path}")
+        root = _decode(_read_exactly(f, root_size, path))
+        f.seek(-_TRAILER.size, os.SEEK_END)
+        end, files = _TRAILER.unpack(_read_exactly(f, _TRAILER.size, path))
+    if end != _END:
+        raise ValueError(f"Truncated results file: {path}")
+    return ShardResults(root, shard, shards, files)
+
+
+def read_results(path: str) -> Iterator[ShardRecord]:
+    """Yields the files of a results file, in the order they were written.
+
+    The header and trailer are checked before the first record is
+    yielded, see `read_header`.
+    """
+    header = read_header(path)
+    with open(path, "rb") as f:
+        _, _, _, _, digest_size, root_size = _HEADER.unpack(f.read(_HEADER.size))
+        f.seek(root_size, os.SEEK_CUR)
+        for _ in range(header.files):
+            size, device, inode, mtime_ns, path_size = _RECORD.unpack(_read_exactly(f, _RECORD.size, path))
+            digest = _read_exactly(f, digest_size, path).hex()
+            relative = _decode(_read_exactly(f, path_size, path))
+            yield ShardRecord(digest, relative, size, fs.FileSignature(device, inode, size, mtime_ns))
+
+
+def scan_shard(root: str, output: str, shard: int=0, shards: int=1, subtrees: Iterable[str]=(),
+               workers: int=None, report: Callable[[fs.ScanStats], None]=None, **walk_options) -> int:
+    """Hashes a shard of a directory and writes its results file, without touching any DB.
+
+    Args:
+        root (str): The scanned directory.
+        output (str): The results file to write.
+        shard (int, optional): The shard, from 0 to `shards - 1`. Defaults to 0.
+        shards (int, optional): Number of hash partitions of the paths. Defaults to 1 (every file).
+        subtrees (Iterable[str], optional): Directories relative to `root` to walk. Defaults to () (all).
+        workers (int, optional): Number of hashing workers. Defaults to None (CPU count).
+        report (Callable, optional): Called with the `fs.ScanStats` once the scan ends.
+        **walk_options: Filters forwarded to `fs.walk_files`, unreadable directories are skipped
+            and reported in `stats.skipped` unless an `onerror` is given.
+
+    Returns:
+        int: The number of files written.
+    """
+    stats = fs.ScanStats()
+    walk_options.setdefault("onerror", stats.skip)
+    entries = shard_files(root, shard, shards, subtrees, **walk_options)
+    count = write_results(output, root, fs.hash_files(entries, workers=workers, stats=stats), shard, shards)
+    if report:
+        report(stats)
+    return count
@@ -0,0 +1,146 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+
+"""Lightweight counters and latency histograms of the hot paths.
+
+Instrumentation is disabled by default. Instrumented code checks the
+module level `enabled` flag before doing anything else, so that the cost
+when disabled is a single attribute lookup:
+
+    start = stats.clock() if stats.enabled else None
+    ...
+    if start is not None:
+        stats.record("fs.hash_file", start, nbytes=size)
+
+Work done in worker processes is not collected, only threads are.
+"""
+from collections.abc import Callable
+import threading
+import time
+
+enabled = False
+
+clock = time.perf_counter
+
+_lock = threading.Lock()
+
+
+class Stage:
+    """Counters and a log2 latency histogram (in microseconds) of a stage."""
+    __slots__ = ("calls", "items", "bytes", "seconds", "buckets")
+
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.buckets = [0] * 40
+
+    def add(self, seconds: float, items: int, nbytes: int):
+        self.calls += 1
+        self.items += items
+        self.bytes += nbytes
+        self.seconds += seconds
+        bucket = min(int(seconds * 1e6).bit_length(), len(self.buckets) - 1)
+        self.buckets[bucket] += 1
+
+    def percentile(self, p: float) -> float:
+        """Returns the upper bound in seconds of the bucket holding the `p` percentile."""
+        threshold = self.calls * p / 100
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= threshold:
+                return (1 << bucket) / 1e6
+        return 0.0
+
+    def __str__(self) -> str:
+        rate = ""
+        if self.seconds > 0:
+            rate = f", {self.items / self.seconds:.1f} items/s, {self.bytes / (1024 * 1024) / self.seconds:.1f} MB/s"
+        return (
+            f"{self.calls} call(s), {self.items} item(s), {self.bytes / (1024 * 1024):.1f} MB "
+            f"in {self.seconds:.3f}s{rate}, p50 <= {self.percentile(50) * 1e3:.3f}ms, "
+            f"p95 <= {self.percentile(95) * 1e3:.3f}ms"
+        )
+
+
+stages: dict[str, Stage] = {}
+counters: dict[str, int] = {}
+
+
+def enable(flag: bool=True):
+    global enabled
+    enabled = flag
+
+
+def reset():
+    with _lock:
+        stages.clear()
+        counters.clear()
+
+
+def record(stage: str, start: float, items: int=1, nbytes: int=0):
+    """Accounts a run of `stage` started at `start` (a `clock()` value)."""
+    elapsed = clock() - start
+    with _lock:
+        if stage not in stages:
+            stages[stage] = Stage()
+        stages[stage].add(elapsed, items, nbytes)
+
+
+def count(counter: str, value: int=1):
+    with _lock:
+        counters[counter] = counters.get(counter, 0) + value
+
+
+def report() -> list[str]:
+    """Returns one line per stage and counter collected so far."""
+    with _lock:
+        lines = [f"{name}: {stage}" for name, stage in sorted(stages.items())]
+        lines.extend(f"{name}: {value}" for name, value in sorted(counters.items()))
+    return lines
+
+
+def profile(function: Callable, *args, limit: int=20, memory: bool=True, **kwargs) -> tuple[object, str]:
+    """Runs `function` under cProfile (and tracemalloc when `memory` is set).
+
+    Returns:
+        tuple[object, str]: The result of the call and a printable report with
+            the `limit` most expensive functions and allocation sites.
+    """
+    # Imported here to keep them out of the start up time of every command
+    import cProfile
+    import io
+    import pstats
+    import tracemalloc
+
+    profiler = cProfile.Profile()
+    if memory:
+        tracemalloc.start()
+    try:
+        result = profiler.runcall(function, *args, **kwargs)
+    finally:
+        snapshot = tracemalloc.take_snapshot() if memory else None
+        if memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+    if snapshot is not None:
+        out.write(f"Peak traced memory: {peak / (1024 * 1024):.1f} MB\n")
+        for line in snapshot.statistics("lineno")[:limit]:
+            out.write(f"{line}\n")
+    return result, out.getvalue()
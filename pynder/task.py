@@ -15,11 +15,23 @@
 
 """Tasks performed by the software."""
 from collections.abc import Callable
+from dataclasses import dataclass, field
+import itertools
+import os
 import sqlite3
+import time
 
+from pynder.bloom import BloomFilter
 import pynder.db as dbu
+import pynder.fs as fs
+import pynder.shard as shard
+import pynder.stats as perf
 
-def scan_and_add_directory(db: sqlite3.Connection, path: str, f_condition: Callable[[str], bool]) -> int:
+def scan_and_add_directory(db: sqlite3.Connection, path: str, f_condition: Callable[[str], bool]=None,
+                           workers: int=None, report: Callable[[fs.ScanStats], None]=None,
+                           verify: bool=False, batch_size: int=dbu.DEFAULT_BATCH_SIZE,
+                           known: BloomFilter=None, repository: int=None, resumable: bool=False,
+                           progress: Callable[["ScanProgress"], None]=None) -> int:
     """Scans a directory adding files passing a given condition.
     
     Starts at the directory indicated by `path` and recursively considers
@@ -28,15 +40,408 @@ def scan_and_add_directory(db: sqlite3.Connection, path: str, f_condition: Calla
     `True`. If such callable is not indicated, each file is processed and
     added to the database.
 
+    Files are hashed in parallel by `fs.hash_files` while the directory is
+    being walked, the database is written from the calling thread only, in
+    transactions of `batch_size` files through `db.add_files`.
+    Files whose `(device, inode, size, mtime_ns)` signature is found in the
+    stat cache are not read again, unless `verify` is set.
+    Directories that can't be listed are skipped and their paths collected
+    in the `skipped` list of the stats given to `report`.
+
+    A `resumable` scan is recorded as a job in the 'scan_job' table and
+    proceeds by whole directories instead: each transaction writes the
+    files of some directories together with the progress of the job, so
+    if the scan is interrupted `resume_scan` continues from the last
+    commit without listing or hashing finished directories again.
+
     Args:
         db (sqlite3.Connection): The target database
         path (str): The path of the scanned directory
         f_condition (Callable: A callable that indicates whether to consider or not a file.
+        workers (int, optional): Number of hashing workers. Defaults to None (CPU count).
+        report (Callable, optional): Called with the `fs.ScanStats` (files/s, MB/s) once the scan ends.
+        verify (bool, optional): Hash every file ignoring the stat cache. Defaults to False.
+        batch_size (int, optional): Files written per transaction. Defaults to `db.DEFAULT_BATCH_SIZE`.
+        known (BloomFilter, optional): Filter of the hashes in the DB, kept up to date. Defaults to None.
+        repository (int, optional): If given, files are also linked to this repository. Defaults to None.
+        resumable (bool, optional): Record the scan as a resumable job. Defaults to False.
+        progress (Callable, optional): Called with a `ScanProgress` after each transaction of a
+            resumable scan. Defaults to None.
         
     Returns:
         int: The total number of rows added to the 'file' table.
     """
-    pass
+    if resumable:
+        job = dbu.create_scan_job(db, path, repository)
+        return resume_scan(db, job, f_condition, workers, report, verify, batch_size, known, progress)
+    stats = fs.ScanStats()
+    paths = fs.iter_files(path, onerror=stats.skip)
+    if f_condition:
+        paths = (entry for entry in paths if f_condition(entry.path))
+    cache = None
+    if not verify:
+        cache = lambda signature: dbu.cached_hash(db, signature)
+    fresh = []
+
+    def rows():
+        for result in fs.hash_files(paths, workers=workers, stats=stats, cache=cache):
+            if not result.cached:
+                fresh.append((result.signature, result.digest))
+            yield result.digest, result.path
+
+    def flush_cache(files_added, links_added):
+        dbu.cache_hashes(db, fresh)
+        fresh.clear()
+
+    added = dbu.add_files(db, rows(), repository=repository, batch_size=batch_size, on_batch=flush_cache, known=known)
+    if report:
+        report(stats)
+    return added
+
+@dataclass
+class ScanProgress:
+    """Progress of a resumable scan, counting the work of every run of the job."""
+    job: int
+    directories: int
+    pending: int
+    files: int
+    bytes: int
+    seconds: float
+
+    @property
+    def eta(self) -> float | None:
+        """Estimated seconds left, assuming pending directories hold as many files as the finished ones."""
+        if not self.directories or not self.files or self.seconds <= 0:
+            return None
+        return self.pending * (self.files / self.directories) / (self.files / self.seconds)
+
+    def __str__(self) -> str:
+        eta = self.eta
+        return (
+            f"Job {self.job}: {self.directories} directories done, {self.pending} pending, {self.files} file(s), "
+            f"{self.bytes / (1024 * 1024):.1f} MB in {self.seconds:.1f}s"
+            + (f", about {eta:.0f}s left" if eta is not None else "")
+        )
+
+def resume_scan(db: sqlite3.Connection, job: int, f_condition: Callable[[str], bool]=None, workers: int=None,
+                report: Callable[[fs.ScanStats], None]=None, verify: bool=False,
+                batch_size: int=dbu.DEFAULT_BATCH_SIZE, known: BloomFilter=None,
+                progress: Callable[[ScanProgress], None]=None) -> int:
+    """Runs a resumable scan job until no directory is left, see `scan_and_add_directory`.
+
+    Pending directories are taken from the job depth first. Each one is
+    listed, its subdirectories become pending and its files are hashed;
+    once about `batch_size` files are collected they are written with
+    `db.checkpoint_scan_job`, which marks their directories done in the
+    same transaction. A directory is never split, so a batch holds at
+    least one whole directory. The condition is not stored with the job:
+    pass the same `f_condition` when resuming.
+
+    Args:
+        db (sqlite3.Connection): The target database.
+        job (int): The id of the job, as returned by `db.create_scan_job`.
+        f_condition (Callable, optional): A callable that indicates whether to consider or not a file.
+        workers (int, optional): Number of hashing workers. Defaults to None (CPU count).
+        report (Callable, optional): Called with the `fs.ScanStats` of this run once the job ends.
+        verify (bool, optional): Hash every file ignoring the stat cache. Defaults to False.
+        batch_size (int, optional): Files written per transaction. Defaults to `db.DEFAULT_BATCH_SIZE`.
+        known (BloomFilter, optional): Filter of the hashes in the DB, kept up to date. Defaults to None.
+        progress (Callable, optional): Called with a `ScanProgress` after each transaction.
+
+    Returns:
+        int: The number of rows added to the 'file' table by this run.
+    """
+    if dbu.scan_job(db, job) is None:
+        raise ValueError(f"Scan job not found: {job}")
+    cache = None
+    if not verify:
+        cache = lambda signature: dbu.cached_hash(db, signature)
+    stats = fs.ScanStats()
+    added = 0
+    while stack := dbu.pending_directories(db, job):
+        start = time.perf_counter()
+        read = stats.bytes
+        entries = []
+        done = []
+        found = []
+        while stack and len(entries) < batch_size:
+            directory = stack.pop()
+            # Unreadable directories are marked done as well, `report` lists them
+            files, subdirs = fs.list_directory(directory, onerror=stats.skip)
+            done.append(directory)
+            found.extend(subdirs)
+            stack.extend(reversed(subdirs))
+            entries.extend(entry for entry in files if f_condition is None or f_condition(entry.path))
+        rows = []
+        fresh = []
+        for result in fs.hash_files(entries, workers=workers, stats=stats, cache=cache):
+            rows.append((result.digest, result.path))
+            if not result.cached:
+                fresh.append((result.signature, result.digest))
+        finished = set(done)
+        added += dbu.checkpoint_scan_job(
+            db, job, rows, done, [path for path in found if path not in finished],
+            nbytes=stats.bytes - read, seconds=time.perf_counter() - start, known=known
+        )
+        dbu.cache_hashes(db, fresh)
+        if progress:
+            _, _, _, _, _, _, directories, files, nbytes, seconds = dbu.scan_job(db, job)
+            progress(ScanProgress(job, directories, dbu.count_pending_directories(db, job), files, nbytes, seconds))
+    dbu.finish_scan_job(db, job)
+    if report:
+        report(stats)
+    return added
+
+def find_duplicates(db: sqlite3.Connection, repository: int, workers: int=None, verify: bool=False,
+                    report: Callable[[fs.ScanStats], None]=None) -> dict[str, list[str]]:
+    """Finds the files with the same content inside a repository.
+
+    The directory of the repository is scanned with `fs.find_duplicates`,
+    which only fully hashes files sharing size and partial hash with some
+    other file. Each duplicated file found is linked to the repository in
+    the 'repository_file' table, so that `db.duplicates_by_repository`
+    reports it.
+
+    Args:
+        db (sqlite3.Connection): The target database.
+        repository (int): The id of the repository to scan.
+        workers (int, optional): Number of hashing workers. Defaults to None (CPU count).
+        verify (bool, optional): Hash every candidate ignoring the stat cache. Defaults to False.
+        report (Callable, optional): Called with the `fs.ScanStats` once the scan ends.
+
+    Returns:
+        dict[str, list[str]]: Maps the md5 of each duplicated content to its paths.
+    """
+    repo = dbu.repository_by_id(db, repository)
+    if repo is None:
+        raise ValueError(f"Repository not found: {repository}")
+    cache = None
+    if not verify:
+        cache = lambda signature: dbu.cached_hash(db, signature)
+    stats = fs.ScanStats()
+    duplicates = {}
+    fresh = []
+    for group in fs.find_duplicates(fs.iter_files(repo[2], onerror=stats.skip), workers=workers, stats=stats,
+                                    cache=cache):
+        duplicates[group[0].digest] = [result.path for result in group]
+        fresh.extend((result.signature, result.digest) for result in group if not result.cached)
+    dbu.add_files(
+        db,
+        ((md5, path) for md5, paths in duplicates.items() for path in paths),
+        repository=repository
+    )
+    dbu.cache_hashes(db, fresh)
+    if report:
+        report(stats)
+    return duplicates
+
+@dataclass
+class RescanSummary:
+    """What `rescan_repo` found changed in a repository."""
+    added: list[str] = field(default_factory=list)
+    modified: list[str] = field(default_factory=list)
+    moved: list[tuple[str, str]] = field(default_factory=list)
+    deleted: list[str] = field(default_factory=list)
+    unchanged: int = 0
+    stats: fs.ScanStats = field(default_factory=fs.ScanStats)
+
+    def __str__(self) -> str:
+        return (
+            f"{len(self.added)} added, {len(self.modified)} modified, {len(self.moved)} moved, "
+            f"{len(self.deleted)} deleted, {self.unchanged} unchanged"
+        )
+
+def rescan_repo(db: sqlite3.Connection, repository: int, subdir: str=None, workers: int=None,
+                verify: bool=False, known: BloomFilter=None) -> RescanSummary:
+    """Brings the files recorded for a repository up to date with its directory.
+
+    The directory tree is walked and compared with the 'repository_file'
+    tuples of the repository. Files whose stat signature is in the stat
+    cache are not read, so only new or changed files are hashed; a file
+    that was renamed keeps its inode and mtime and is therefore recognized
+    without hashing. Paths that disappeared and reappeared elsewhere with
+    the same content are reported as moves.
+
+    All the differences are applied in a single transaction. Running it on
+    a repository with no recorded files performs its initial scan.
+    Directories that can't be listed are reported in `stats.skipped` and
+    the files recorded under them are left untouched.
+
+    Args:
+        db (sqlite3.Connection): The target database.
+        repository (int): The id of the repository.
+        subdir (str, optional): Only rescan this directory of the repository. Defaults to None (all).
+        workers (int, optional): Number of hashing workers. Defaults to None (CPU count).
+        verify (bool, optional): Hash every file ignoring the stat cache. Defaults to False.
+        known (BloomFilter, optional): Filter of the hashes in the DB, kept up to date. Defaults to None.
+
+    Returns:
+        RescanSummary: The paths added, modified, moved and deleted.
+    """
+    start = perf.clock() if perf.enabled else None
+    repo = dbu.repository_by_id(db, repository)
+    if repo is None:
+        raise ValueError(f"Repository not found: {repository}")
+    root = subdir or repo[2]
+    stored = {}
+    for md5, path in dbu.files_of_repository(db, repository, prefix=subdir):
+        stored.setdefault(path, set()).add(md5)
+
+    cache = None
+    if not verify:
+        cache = lambda signature: dbu.cached_hash(db, signature)
+    summary = RescanSummary()
+    current = {}
+    fresh = []
+    walk = fs.iter_files(root, onerror=summary.stats.skip)
+    for result in fs.hash_files(walk, workers=workers, stats=summary.stats, cache=cache):
+        current[result.path] = result.digest
+        if not result.cached:
+            fresh.append((result.signature, result.digest))
+
+    removed = []
+    added = []
+    for path, md5 in current.items():
+        recorded = stored.get(path)
+        if recorded is None:
+            added.append((md5, path))
+        elif recorded == {md5}:
+            summary.unchanged += 1
+        else:
+            summary.modified.append(path)
+            removed.append(path)
+            added.append((md5, path))
+    # Files under paths that could not be listed are kept as they are
+    skipped = set(summary.stats.skipped)
+    prefixes = tuple(os.path.join(path, "") for path in skipped)
+    missing = {path for path in stored.keys() - current.keys() if path not in skipped and not path.startswith(prefixes)}
+    gone = {}
+    for path in missing:
+        removed.append(path)
+        for md5 in stored[path]:
+            gone.setdefault(md5, []).append(path)
+    for md5, path in added:
+        if path in stored:
+            continue
+        if gone.get(md5):
+            summary.moved.append((gone[md5].pop(), path))
+        else:
+            summary.added.append(path)
+    moved_from = {source for source, _ in summary.moved}
+    summary.deleted = [path for path in missing if path not in moved_from]
+
+    dbu.apply_repository_changes(db, repository, removed, added, known=known)
+    dbu.cache_hashes(db, fresh)
+    if start is not None:
+        perf.record("task.rescan_repo", start, items=len(current), nbytes=summary.stats.bytes)
+    return summary
+
+def index_chunks(db: sqlite3.Connection, repository: int, workers: int=None,
+                 batch_size: int=100) -> int:
+    """Indexes the content-defined chunks of the files of a repository.
+
+    Each distinct content is chunked once by `fs.chunk_file` and contents
+    already indexed are skipped, so the task can be run again after a
+    rescan. Files that can't be read are skipped.
+
+    Args:
+        db (sqlite3.Connection): The target database.
+        repository (int): The id of the repository.
+        workers (int, optional): Number of chunking processes, `1` chunks serially. Defaults to None (CPU count).
+        batch_size (int, optional): Files whose chunks are written per transaction. Defaults to 100.
+
+    Returns:
+        int: The number of files indexed.
+    """
+    paths = {}
+    for md5, path in dbu.files_of_repository(db, repository):
+        paths.setdefault(md5, path)
+    pending = []
+    md5s = list(paths)
+    for i in range(0, len(md5s), dbu.DEFAULT_BATCH_SIZE):
+        batch = md5s[i:i + dbu.DEFAULT_BATCH_SIZE]
+        known = dbu.chunked_files(db, batch)
+        pending.extend(md5 for md5 in batch if md5 not in known)
+    results = fs.chunk_files([paths[md5] for md5 in pending], workers=workers)
+    pairs = ((md5, chunks) for md5, chunks in zip(pending, results) if chunks is not None)
+    indexed = 0
+    while batch := dict(itertools.islice(pairs, batch_size)):
+        dbu.add_chunks(db, batch)
+        indexed += len(batch)
+    return indexed
+
+def merge_db(db: sqlite3.Connection, path: str, incremental: bool=True) -> dict[str, int]:
+    """Merges another pynder DB into `db`, see `db.merge_database`.
+
+    The other DB is first brought to the current schema version, which
+    converts it in place if it was created by an older version.
+
+    Args:
+        db (sqlite3.Connection): The target database.
+        path (str): The path of the DB to merge.
+        incremental (bool, optional): Only merge the rows added since the last merge. Defaults to True.
+
+    Returns:
+        dict[str, int]: The number of rows added to each table.
+    """
+    if not os.path.isfile(path):
+        raise ValueError(f"Database not found: {path}")
+    other = dbu.connect(path, "bulk-ingest")
+    try:
+        if not dbu.has_schema(other.cursor()):
+            raise ValueError(f"Not a pynder database: {path}")
+        dbu.upgrade_schema(other)
+    finally:
+        other.close()
+    return dbu.merge_database(db, path, incremental)
+
+def merge_shards(db: sqlite3.Connection, paths: list[str], repository: int=None, root: str=None,
+                 cache: bool=False, batch_size: int=dbu.DEFAULT_BATCH_SIZE, known: BloomFilter=None) -> int:
+    """Adds the files of the results files written by `shard.scan_shard` workers.
+
+    Every file is checked before any row is written, so a missing or
+    truncated results file leaves the DB untouched. Rows are then written
+    in bulk by `db.add_files`.
+
+    The stat signatures of the workers are only stored in the stat cache
+    if `cache` is set: device numbers are only meaningful on the host that
+    took them, so this is only right when the workers ran on this host.
+
+    Args:
+        db (sqlite3.Connection): The target database.
+        paths (list[str]): The results files.
+        repository (int, optional): If given, files are also linked to this repository. Defaults to None.
+        root (str, optional): The directory the workers scanned, as seen from this host. Defaults to
+            None (the root recorded by each worker).
+        cache (bool, optional): Store the signatures in the stat cache. Defaults to False.
+        batch_size (int, optional): Files written per transaction. Defaults to `db.DEFAULT_BATCH_SIZE`.
+        known (BloomFilter, optional): Filter of the hashes in the DB, kept up to date. Defaults to None.
+
+    Returns:
+        int: The total number of rows added to the 'file' table.
+    """
+    headers = []
+    for path in paths:
+        if not os.path.isfile(path):
+            raise ValueError(f"Results file not found: {path}")
+        headers.append(shard.read_header(path))
+    signatures = []
+
+    def rows():
+        for path, header in zip(paths, headers):
+            top = header.root if root is None else root
+            for record in shard.read_results(path):
+                absolute = os.path.join(top, record.path)
+                if cache:
+                    signatures.append((record.signature, record.digest))
+                yield record.digest, absolute
+
+    def flush_cache(files_added, links_added):
+        dbu.cache_hashes(db, signatures)
+        signatures.clear()
+
+    return dbu.add_files(db, rows(), repository=repository, batch_size=batch_size,
+                         on_batch=flush_cache if cache else None, known=known)
 
 def add_repo(db: sqlite3.Connection, path: str, desc: str, allow_duplicate: bool=False) -> int | None:
     """Adds a repository to the database.
@@ -57,11 +462,14 @@ def add_repo(db: sqlite3.Connection, path: str, desc: str, allow_duplicate: bool
     Returns:
         int: The id of the newly added repository, `None` if nothing is added.
     """
+    start = perf.clock() if perf.enabled else None
     # Checks the existence of the path
     repo = dbu.repository_by_path(db, path)
     if (len(repo) != 0) and (not allow_duplicate):
         return None
     # add repo
     newId = dbu.add_repository(db=db, path=path, description=desc)
+    if start is not None:
+        perf.record("task.add_repo", start)
     return newId
     
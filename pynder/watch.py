@@ -0,0 +1,276 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+
+"""Keeps repositories in sync with the file system using Linux inotify."""
+from collections.abc import Callable, Iterator
+import ctypes
+import ctypes.util
+import os
+import select
+import sqlite3
+import struct
+import threading
+import time
+
+import pynder.db as dbu
+import pynder.fs as fs
+import pynder.task as task
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Events requested for every watched directory
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+_EVENT = struct.Struct("iIII")
+
+# Seconds without events after which pending changes are written
+DEFAULT_DEBOUNCE = 1.0
+
+# Pending paths forcing a write even while events keep coming
+DEFAULT_MAX_PENDING = 1000
+
+
+class Inotify:
+    """A thin wrapper around an inotify file descriptor."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path: str, mask: int=WATCH_MASK) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def rm_watch(self, wd: int):
+        # Fails if the kernel already dropped the watch, which is what we asked for
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout: float=None) -> Iterator[tuple[int, int, int, str]]:
+        """Yields the `(wd, mask, cookie, name)` of the events available within `timeout` seconds."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = _EVENT.unpack_from(buffer, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            yield wd, mask, cookie, name
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _top_directories(paths: set[str]) -> list[str]:
+    """The paths not inside another one of `paths`, in tree order."""
+    tops = []
+    # Sorting by components puts every path right after the ones containing it
+    for path in sorted(paths, key=lambda path: path.split(os.sep)):
+        if not tops or not path.startswith(os.path.join(tops[-1], "")):
+            tops.append(path)
+    return tops
+
+
+class Watcher:
+    """Applies the changes notified by inotify to the repositories of a DB.
+
+    Every directory of every repository is watched. Events are coalesced
+    per path and written once no event arrived for `debounce` seconds (or
+    `max_pending` paths are waiting): touched files are hashed with
+    `fs.hash_file` and their 'repository_file' tuples replaced in a single
+    transaction per repository. Directories created or moved in are
+    rescanned with `task.rescan_repo`, the files of directories deleted or
+    moved out are removed. When the kernel queue overflows and events have
+    been lost, the directories that delivered events since the last write
+    are rescanned, or whole repositories if no event arrived before it.
+    """
+
+    def __init__(self, db: sqlite3.Connection, debounce: float=DEFAULT_DEBOUNCE,
+                 max_pending: int=DEFAULT_MAX_PENDING, report: Callable[[str], None]=None):
+        self.db = db
+        self.debounce = debounce
+        self.max_pending = max_pending
+        self.report = report
+        self.inotify = Inotify()
+        self.watches = {}
+        self.repositories = {}
+        self.changed = {}
+        self.rescans = set()
+        # Watched directories with events since the last write, rescanned on overflow
+        self.touched = set()
+        self.overflow = False
+        self.last_event = None
+
+    def watch_repositories(self) -> int:
+        """Watches the directories of every repository, returns the number of watches."""
+        for repo_id, _, path in dbu.iter_of_repository(self.db):
+            if path and os.path.isdir(path):
+                self.repositories[repo_id] = path
+                self._watch_tree(path)
+        return len(self.watches)
+
+    def _watch_tree(self, root: str):
+        for path, _, _ in os.walk(root):
+            try:
+                self.watches[self.inotify.add_watch(path)] = path
+            except OSError:
+                # The directory vanished or the watch limit is hit, a rescan will catch up
+                pass
+
+    def _unwatch_tree(self, root: str):
+        # A directory moved back in gets the same watch descriptor again from `_watch_tree`
+        for wd, path in list(self.watches.items()):
+            if path == root or path.startswith(os.path.join(root, "")):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def _repositories_of(self, path: str) -> list[int]:
+        return [
+            repo_id for repo_id, root in self.repositories.items()
+            if path == root or path.startswith(os.path.join(root, ""))
+        ]
+
+    def poll(self, timeout: float=None) -> int:
+        """Reads the events available within `timeout` seconds, writing changes when due.
+
+        Returns:
+            int: The number of events read.
+        """
+        count = 0
+        for wd, mask, _, name in self.inotify.read(timeout):
+            count += 1
+            if mask & IN_Q_OVERFLOW:
+                self.overflow = True
+                continue
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if directory is None or not name:
+                continue
+            self.touched.add(directory)
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+                elif mask & IN_MOVED_FROM:
+                    self._unwatch_tree(path)
+                self.rescans.add(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.changed[path] = False
+            else:
+                self.changed[path] = True
+        if count:
+            self.last_event = time.monotonic()
+        pending = len(self.changed) + len(self.rescans)
+        if self.overflow or pending >= self.max_pending or (
+                pending and time.monotonic() - self.last_event >= self.debounce):
+            self.flush()
+        return count
+
+    def flush(self):
+        """Writes the pending changes to the DB."""
+        # Pending changes are taken first, so that a failing write is not retried forever
+        changed, rescans, touched = self.changed, self.rescans, self.touched
+        self.changed, self.rescans, self.touched = {}, set(), set()
+        if self.overflow:
+            self.overflow = False
+            directories = touched | {os.path.dirname(path) for path in changed} | rescans
+            targets = _top_directories(directories) or list(self.repositories.values())
+            for path in targets:
+                self._notify(f"Queue overflow, rescanning {path}")
+                self._rescan(path)
+            return
+        removed = {}
+        added = {}
+        fresh = []
+        for path, exists in changed.items():
+            repositories = self._repositories_of(path)
+            for repo_id in repositories:
+                removed.setdefault(repo_id, []).append(path)
+            if not exists:
+                continue
+            try:
+                signature = fs.FileSignature.from_stat(os.stat(path))
+                md5 = dbu.cached_hash(self.db, signature)
+                if md5 is None:
+                    md5 = fs.hash_file(path)
+                    fresh.append((signature, md5))
+            except OSError:
+                # Deleted or replaced before we could read it, a later event follows
+                continue
+            for repo_id in repositories:
+                added.setdefault(repo_id, []).append((md5, path))
+        for repo_id, paths in removed.items():
+            dbu.apply_repository_changes(self.db, repo_id, paths, added.get(repo_id, []))
+            self._notify(f"Repository {repo_id}: {len(added.get(repo_id, []))} file(s) updated, "
+                         f"{len(paths) - len(added.get(repo_id, []))} removed")
+        dbu.cache_hashes(self.db, fresh)
+        for path in _top_directories(rescans):
+            self._rescan(path)
+
+    def _rescan(self, path: str):
+        """Rescans a directory in every repository holding it, dropping its files if it is gone."""
+        for repo_id in self._repositories_of(path):
+            if os.path.isdir(path):
+                subdir = None if path == self.repositories[repo_id] else path
+                self._notify(f"Repository {repo_id}, {path}: {task.rescan_repo(self.db, repo_id, subdir=subdir)}")
+            else:
+                paths = [file_path for _, file_path in dbu.files_of_repository(self.db, repo_id, prefix=path)]
+                dbu.apply_repository_changes(self.db, repo_id, paths, [])
+                self._notify(f"Repository {repo_id}, {path}: gone, {len(paths)} file(s) removed")
+
+    def _notify(self, message: str):
+        if self.report:
+            self.report(message)
+
+    def run(self, stop: threading.Event=None, interval: float=0.5):
+        """Watches until `stop` is set (or forever), writing pending changes before returning."""
+        if not self.watches:
+            self.watch_repositories()
+        try:
+            while stop is None or not stop.is_set():
+                self.poll(interval)
+        finally:
+            self.flush()
+
+    def close(self):
+        self.inotify.close()
@@ -8,12 +8,13 @@ CREATE TABLE IF NOT EXISTS "publication" (
 	"publisher"	VARCHAR(128),
 	"verified"	BOOLEAN NOT NULL DEFAULT False
 );
+-- Digests are stored as raw bytes (16 for md5), the db module converts them from and to hex
 CREATE TABLE IF NOT EXISTS "file" (
-	"md5"	CHAR(32) NOT NULL,
+	"md5"	BLOB NOT NULL,
 	"publication"	int,
 	PRIMARY KEY("md5"),
 	FOREIGN KEY("publication") REFERENCES "publication"("id")
-);
+) WITHOUT ROWID;
 CREATE TABLE IF NOT EXISTS "author" (
 	"id"	INTEGER PRIMARY KEY,
 	"first_name"	VARCHAR(64) NOT NULL,
@@ -44,13 +45,179 @@ CREATE TABLE IF NOT EXISTS "topic_pub" (
 	FOREIGN KEY("id_pub") REFERENCES "publication"("id"),
 	FOREIGN KEY("id_topic") REFERENCES "topic"("id")
 );
+-- Directories holding the files of each repository, as a tree of parent pointers
+CREATE TABLE IF NOT EXISTS "directory" (
+	"id"	INTEGER PRIMARY KEY,
+	"id_repo"	INT NOT NULL,
+	-- NULL for the top directory of a path, whose name is then "/" (absolute) or "" (relative)
+	"parent"	INT,
+	"name"	TEXT NOT NULL,
+	UNIQUE("parent","name"),
+	FOREIGN KEY("id_repo") REFERENCES "repository"("id"),
+	FOREIGN KEY("parent") REFERENCES "directory"("id")
+);
 CREATE TABLE IF NOT EXISTS "repository_file" (
 	"id_repo"	INT NOT NULL,
-	"id_file"	CHAR(32) NOT NULL,
-	"path"		VARCHAR(256),
+	"id_file"	BLOB NOT NULL,
+	-- The path of the file is the path of its directory joined with its name
+	"id_dir"	INT NOT NULL,
+	"name"	TEXT NOT NULL,
 	-- The primary key must be the whole tuple to model duplicated files in the same repo
-	PRIMARY KEY("id_repo","id_file", "path"),
+	PRIMARY KEY("id_repo","id_file","id_dir","name"),
 	FOREIGN KEY("id_repo") REFERENCES "repository"("id"),
+	FOREIGN KEY("id_file") REFERENCES "file"("md5"),
+	FOREIGN KEY("id_dir") REFERENCES "directory"("id")
+);
+CREATE TABLE IF NOT EXISTS "stat_cache" (
+	"device"	INT NOT NULL,
+	"inode"	INT NOT NULL,
+	"size"	INT NOT NULL,
+	"mtime_ns"	INT NOT NULL,
+	"md5"	BLOB NOT NULL,
+	-- Cached digest of the file last seen with this (device, inode), valid while size and mtime match
+	PRIMARY KEY("device","inode")
+);
+CREATE TABLE IF NOT EXISTS "file_chunk" (
+	"id_file"	BLOB NOT NULL,
+	"offset"	INT NOT NULL,
+	"length"	INT NOT NULL,
+	-- 64 bit hash of the content-defined chunk
+	"chunk"	INTEGER NOT NULL,
+	PRIMARY KEY("id_file","offset"),
 	FOREIGN KEY("id_file") REFERENCES "file"("md5")
 );
+-- Ids given in this DB to the rows merged from another one ('source' is the path of its file)
+CREATE TABLE IF NOT EXISTS "merge_map" (
+	"source"	TEXT NOT NULL,
+	"kind"	TEXT NOT NULL,
+	"source_id"	INT NOT NULL,
+	"target_id"	INT NOT NULL,
+	PRIMARY KEY("source","kind","source_id")
+) WITHOUT ROWID;
+-- Last merge from each source DB, rows past these rowids are merged by the next incremental merge
+CREATE TABLE IF NOT EXISTS "merge_log" (
+	"source"	TEXT NOT NULL,
+	"merged_at"	TEXT NOT NULL,
+	"last_repository_file"	INT NOT NULL,
+	"last_author_pub"	INT NOT NULL,
+	PRIMARY KEY("source")
+);
+-- Resumable scans, see task.scan_and_add_directory
+CREATE TABLE IF NOT EXISTS "scan_job" (
+	"id"	INTEGER PRIMARY KEY,
+	"path"	TEXT NOT NULL,
+	"id_repo"	INT,
+	"status"	TEXT NOT NULL,
+	"started_at"	TEXT NOT NULL,
+	"updated_at"	TEXT NOT NULL,
+	"directories"	INT NOT NULL DEFAULT 0,
+	"files"	INT NOT NULL DEFAULT 0,
+	"bytes"	INT NOT NULL DEFAULT 0,
+	"seconds"	REAL NOT NULL DEFAULT 0,
+	FOREIGN KEY("id_repo") REFERENCES "repository"("id")
+);
+-- Directories of a job still to be scanned, finished ones are removed along with the commit of their files
+CREATE TABLE IF NOT EXISTS "scan_job_directory" (
+	"id_job"	INT NOT NULL,
+	"path"	TEXT NOT NULL,
+	PRIMARY KEY("id_job","path"),
+	FOREIGN KEY("id_job") REFERENCES "scan_job"("id")
+) WITHOUT ROWID;
+-- Set by bulk writes for the length of their transaction, they then index the rows past "from_rowid" at once
+CREATE TABLE IF NOT EXISTS "search_deferred" (
+	"from_rowid"	INT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS "repository_path" ON "repository"("path");
+CREATE UNIQUE INDEX IF NOT EXISTS "directory_top" ON "directory"("id_repo","name") WHERE "parent" IS NULL;
+CREATE INDEX IF NOT EXISTS "repository_file_directory" ON "repository_file"("id_dir","name");
+CREATE INDEX IF NOT EXISTS "repository_file_file" ON "repository_file"("id_file");
+CREATE INDEX IF NOT EXISTS "file_chunk_chunk" ON "file_chunk"("chunk");
+-- The repository_file tuples with their full path, rebuilt walking up the directories
+CREATE VIEW IF NOT EXISTS "repository_file_with_path" AS
+	SELECT rf.rowid AS "id", rf.id_repo, rf.id_file, (
+		WITH RECURSIVE up("parent", "path") AS (
+			SELECT d.parent, CASE WHEN d.name = '' THEN rf.name WHEN substr(d.name, -1) = '/' THEN d.name || rf.name
+				ELSE d.name || '/' || rf.name END
+			FROM directory AS d WHERE d.id = rf.id_dir
+			UNION ALL
+			SELECT d.parent, CASE WHEN d.name = '' THEN up.path WHEN substr(d.name, -1) = '/' THEN d.name || up.path
+				ELSE d.name || '/' || up.path END
+			FROM directory AS d JOIN up ON d.id = up.parent
+		)
+		SELECT path FROM up WHERE parent IS NULL
+	) AS "path"
+	FROM repository_file AS rf;
+-- One search document per repository_file tuple, keyed by its rowid
+CREATE VIEW IF NOT EXISTS "search_document" AS
+	SELECT rf.id, rf.id_repo, lower(hex(rf.id_file)) AS "id_file", rf.path, p.title, p.publisher, p.isbn, (
+		SELECT group_concat(a.first_name || ' ' || IFNULL(a.middle_name || ' ', '') || a.last_name, ', ')
+		FROM author_pub AS ap JOIN author AS a ON a.id = ap.id_author
+		WHERE ap.id_pub = p.id
+	) AS "authors"
+	FROM repository_file_with_path AS rf
+	LEFT JOIN file AS f ON f.md5 = rf.id_file
+	LEFT JOIN publication AS p ON p.id = f.publication;
+CREATE VIRTUAL TABLE IF NOT EXISTS "search_index" USING fts5(
+	id_repo UNINDEXED, id_file UNINDEXED, path, title, publisher, isbn, authors,
+	tokenize = "unicode61 remove_diacritics 2", prefix = '2 3'
+);
+CREATE TRIGGER IF NOT EXISTS "search_repository_file_insert" AFTER INSERT ON "repository_file"
+	WHEN NOT EXISTS (SELECT 1 FROM search_deferred) BEGIN
+	INSERT INTO search_index (rowid, id_repo, id_file, path, title, publisher, isbn, authors)
+		SELECT * FROM search_document WHERE id = new.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS "search_repository_file_delete" AFTER DELETE ON "repository_file" BEGIN
+	DELETE FROM search_index WHERE rowid = old.rowid;
+END;
+CREATE TRIGGER IF NOT EXISTS "search_file_update" AFTER UPDATE OF "publication" ON "file" BEGIN
+	DELETE FROM search_index WHERE rowid IN (SELECT rowid FROM repository_file WHERE id_file = new.md5);
+	INSERT INTO search_index (rowid, id_repo, id_file, path, title, publisher, isbn, authors)
+		SELECT * FROM search_document WHERE id IN (SELECT rowid FROM repository_file WHERE id_file = new.md5);
+END;
+CREATE TRIGGER IF NOT EXISTS "search_publication_update" AFTER UPDATE ON "publication" BEGIN
+	DELETE FROM search_index WHERE rowid IN (
+		SELECT rf.rowid FROM repository_file AS rf JOIN file AS f ON f.md5 = rf.id_file WHERE f.publication = new.id);
+	INSERT INTO search_index (rowid, id_repo, id_file, path, title, publisher, isbn, authors)
+		SELECT * FROM search_document WHERE id IN (
+			SELECT rf.rowid FROM repository_file AS rf JOIN file AS f ON f.md5 = rf.id_file WHERE f.publication = new.id);
+END;
+CREATE TRIGGER IF NOT EXISTS "search_publication_delete" AFTER DELETE ON "publication" BEGIN
+	DELETE FROM search_index WHERE rowid IN (
+		SELECT rf.rowid FROM repository_file AS rf JOIN file AS f ON f.md5 = rf.id_file WHERE f.publication = old.id);
+	INSERT INTO search_index (rowid, id_repo, id_file, path, title, publisher, isbn, authors)
+		SELECT * FROM search_document WHERE id IN (
+			SELECT rf.rowid FROM repository_file AS rf JOIN file AS f ON f.md5 = rf.id_file WHERE f.publication = old.id);
+END;
+CREATE TRIGGER IF NOT EXISTS "search_author_pub_insert" AFTER INSERT ON "author_pub" BEGIN
+	DELETE FROM search_index WHERE rowid IN (
+		SELECT rf.rowid FROM repository_file AS rf JOIN file AS f ON f.md5 = rf.id_file WHERE f.publication = new.id_pub);
+	INSERT INTO search_index (rowid, id_repo, id_file, path, title, publisher, isbn, authors)
+		SELECT * FROM search_document WHERE id IN (
+			SELECT rf.rowid FROM repository_file AS rf JOIN file AS f ON f.md5 = rf.id_file WHERE f.publication = new.id_pub);
+END;
+CREATE TRIGGER IF NOT EXISTS "search_author_pub_delete" AFTER DELETE ON "author_pub" BEGIN
+	DELETE FROM search_index WHERE rowid IN (
+		SELECT rf.rowid FROM repository_file AS rf JOIN file AS f ON f.md5 = rf.id_file WHERE f.publication = old.id_pub);
+	INSERT INTO search_index (rowid, id_repo, id_file, path, title, publisher, isbn, authors)
+		SELECT * FROM search_document WHERE id IN (
+			SELECT rf.rowid FROM repository_file AS rf JOIN file AS f ON f.md5 = rf.id_file WHERE f.publication = old.id_pub);
+END;
+CREATE TRIGGER IF NOT EXISTS "search_author_update" AFTER UPDATE ON "author" BEGIN
+	DELETE FROM search_index WHERE rowid IN (
+		SELECT rf.rowid FROM repository_file AS rf JOIN file AS f ON f.md5 = rf.id_file
+		JOIN author_pub AS ap ON ap.id_pub = f.publication WHERE ap.id_author = new.id);
+	INSERT INTO search_index (rowid, id_repo, id_file, path, title, publisher, isbn, authors)
+		SELECT * FROM search_document WHERE id IN (
+			SELECT rf.rowid FROM repository_file AS rf JOIN file AS f ON f.md5 = rf.id_file
+			JOIN author_pub AS ap ON ap.id_pub = f.publication WHERE ap.id_author = new.id);
+END;
+CREATE TRIGGER IF NOT EXISTS "search_author_delete" AFTER DELETE ON "author" BEGIN
+	DELETE FROM search_index WHERE rowid IN (
+		SELECT rf.rowid FROM repository_file AS rf JOIN file AS f ON f.md5 = rf.id_file
+		JOIN author_pub AS ap ON ap.id_pub = f.publication WHERE ap.id_author = old.id);
+	INSERT INTO search_index (rowid, id_repo, id_file, path, title, publisher, isbn, authors)
+		SELECT * FROM search_document WHERE id IN (
+			SELECT rf.rowid FROM repository_file AS rf JOIN file AS f ON f.md5 = rf.id_file
+			JOIN author_pub AS ap ON ap.id_pub = f.publication WHERE ap.id_author = old.id);
+END;
 COMMIT;
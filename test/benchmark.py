@@ -0,0 +1,218 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+
+"""Benchmarks of the scanning and ingestion paths on a synthetic corpus.
+
+Run from the root project directory, e.g.
+
+    python test/benchmark.py --files 5000 --output bench.json
+    python test/benchmark.py --files 5000 --baseline bench.json --threshold 0.2
+
+With `--baseline`, the run fails (exit code 1) if any benchmark is slower
+than the baseline by more than `--threshold` (a fraction).
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from testing_util import create_corpus
+import pynder.db as dbu
+import pynder.fs as fs
+
+
+def measure(function, repeat: int) -> dict:
+    """Runs `function` `repeat` times, returning the timings in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {"median": statistics.median(timings), "min": min(timings), "runs": timings}
+
+
+def new_db(work_dir: str):
+    # An empty file is opened by SQLite as a new database
+    fd, path = tempfile.mkstemp(suffix=".sqlite", dir=work_dir)
+    os.close(fd)
+    db = dbu.connect(path, "bulk-ingest")
+    dbu.create_schema(db)
+    return db
+
+
+def run_benchmarks(corpus: str, work_dir: str, repeat: int, workers: int) -> dict:
+    paths = [entry.path for entry in fs.walk_files(corpus)]
+    scanned = fs.db_for_dir(corpus, workers=workers)
+    rows = scanned.tuples()
+    results = {}
+
+    results["for_each_file"] = measure(lambda: fs.for_each_file(corpus, lambda path: None), repeat)
+    results["hash_file"] = measure(lambda: [fs.hash_file(path) for path in paths], repeat)
+    results["db_for_dir.serial"] = measure(lambda: fs.db_for_dir(corpus, workers=1), repeat)
+    results["db_for_dir.parallel"] = measure(lambda: fs.db_for_dir(corpus, workers=workers), repeat)
+
+    cached_db = new_db(work_dir)
+    fs.db_for_dir(corpus, workers=workers, db=cached_db)
+    results["db_for_dir.cached"] = measure(lambda: fs.db_for_dir(corpus, workers=workers, db=cached_db), repeat)
+    cached_db.close()
+
+    def add_file():
+        db = new_db(work_dir)
+        repo = dbu.add_repository(db, corpus, "benchmark")
+        for md5, path in rows:
+            dbu.add_file(db, md5, repository=repo, path=path)
+        db.close()
+
+    def add_files():
+        db = new_db(work_dir)
+        repo = dbu.add_repository(db, corpus, "benchmark")
+        dbu.add_files(db, rows, repository=repo)
+        db.close()
+
+    def insert_result_set():
+        db = new_db(work_dir)
+        scanned.insert(db, repository=dbu.add_repository(db, corpus, "benchmark"))
+        db.close()
+
+    results["add_file"] = measure(add_file, repeat)
+    results["add_files"] = measure(add_files, repeat)
+    results["add_files.result_set"] = measure(insert_result_set, repeat)
+
+    db = new_db(work_dir)
+    dbu.add_files(db, rows, repository=dbu.add_repository(db, corpus, "benchmark"))
+    results["list_of_files"] = measure(lambda: dbu.list_of_files(db), repeat)
+    results["iter_of_files"] = measure(lambda: sum(1 for _ in dbu.iter_of_files(db)), repeat)
+
+    def pages():
+        page = dbu.page_of_files(db, limit=100)
+        while page:
+            page = dbu.page_of_files(db, after=page[-1], limit=100)
+
+    results["page_of_files"] = measure(pages, repeat)
+    db.close()
+    return results
+
+
+def hash_crossover(work_dir: str, sizes: list[int], repeat: int) -> dict:
+    """Times buffered and memory mapped hashing of files of the given sizes."""
+    results = {}
+    for size in sizes:
+        path = os.path.join(work_dir, f"crossover_{size}.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        results[f"hash_file.buffered.{size}"] = measure(lambda: fs.hash_file(path, mmap_threshold=None), repeat)
+        results[f"hash_file.mmap.{size}"] = measure(lambda: fs.hash_file(path, mmap_threshold=0), repeat)
+        os.remove(path)
+    return results
+
+
+def crossover(results: dict, sizes: list[int]) -> int | None:
+    """Returns the smallest size from which mapping is faster at every larger size."""
+    found = None
+    for size in reversed(sizes):
+        if results[f"hash_file.mmap.{size}"]["median"] >= results[f"hash_file.buffered.{size}"]["median"]:
+            break
+        found = size
+    return found
+
+
+def parse_size(text: str) -> int:
+    units = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+    if text[-1].upper() in units:
+        return int(float(text[:-1]) * units[text[-1].upper()])
+    return int(text)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """Returns a description of each benchmark slower than the baseline by more than `threshold`."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["median"]
+        after = result["median"]
+        if before > 0 and after > before * (1 + threshold):
+            regressions.append(f"{name}: {before:.4f}s -> {after:.4f}s (+{(after / before - 1) * 100:.1f}%)")
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=2000, help="files in the corpus")
+    parser.add_argument("--size-mu", type=float, default=9.0, help="mean of the log of file sizes")
+    parser.add_argument("--size-sigma", type=float, default=1.5, help="standard deviation of the log of file sizes")
+    parser.add_argument("--depth", type=int, default=3, help="levels of subdirectories")
+    parser.add_argument("--fanout", type=int, default=4, help="subdirectories per directory")
+    parser.add_argument("--duplicates", type=float, default=0.1, help="fraction of duplicated files")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the corpus generator")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="hashing workers")
+    parser.add_argument("--crossover-sizes", default="64K,1M,4M,16M,64M",
+                        help="comma separated file sizes timed with buffered and mapped hashing")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.1, help="tolerated slowdown against the baseline")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="pynder-bench-")
+    try:
+        corpus = os.path.join(work_dir, "corpus")
+        corpus_info = create_corpus(
+            corpus, files=args.files, size_mu=args.size_mu, size_sigma=args.size_sigma,
+            depth=args.depth, fanout=args.fanout, duplicate_ratio=args.duplicates, seed=args.seed
+        )
+        results = run_benchmarks(corpus, work_dir, args.repeat, args.workers)
+        sizes = [parse_size(size) for size in args.crossover_sizes.split(",") if size]
+        results.update(hash_crossover(work_dir, sizes, args.repeat))
+    finally:
+        shutil.rmtree(work_dir)
+
+    report = {
+        "corpus": corpus_info,
+        "parameters": vars(args),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    for name, result in results.items():
+        print(f"{name:28} {result['median']:10.4f}s  (min {result['min']:.4f}s)")
+    if sizes:
+        size = crossover(results, sizes)
+        report["mmap_crossover"] = size
+        print(f"Memory mapped hashing is faster from {size} bytes" if size else
+              "Memory mapped hashing is never faster on the sizes tried")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
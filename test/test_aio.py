@@ -0,0 +1,84 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+import asyncio
+import contextlib
+import glob
+import os
+import shutil
+import sqlite3
+import unittest
+
+from testing_util import random_file_name, create_testing_dir
+import pynder.aio as aio
+
+class AioTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dir_name = os.path.abspath(random_file_name())
+        self.db_name = random_file_name(ext="sqlite")
+        create_testing_dir(root_dir=self.dir_name)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dir_name)
+        for path in glob.glob(self.db_name + "*"):
+            os.remove(path)
+
+    def test_scan(self):
+        async def collect():
+            return [result async for result in aio.scan(self.dir_name, workers=2)]
+        results = asyncio.run(collect())
+        self.assertEqual(len(results), 5)
+        self.assertIn("ed076287532e86365e841e92bfc50d8c", [r.digest for r in results])
+
+    def test_scan_early_exit(self):
+        async def first():
+            async with contextlib.aclosing(aio.scan(self.dir_name, workers=1, max_queued=1)) as results:
+                async for result in results:
+                    return result
+        self.assertIsNotNone(asyncio.run(asyncio.wait_for(first(), timeout=10)))
+
+    def test_add_repo_async(self):
+        reports = []
+        repo = asyncio.run(aio.add_repo_async(
+            self.db_name, self.dir_name, "Async", workers=2, batch_size=2,
+            progress=lambda stats: reports.append(stats.files)
+        ))
+        self.assertIsNotNone(repo)
+        self.assertEqual(reports[-1], 5)
+        db = sqlite3.connect(self.db_name)
+        count = db.execute("SELECT COUNT(*) FROM repository_file WHERE id_repo=?;", (repo, )).fetchone()[0]
+        db.close()
+        self.assertEqual(count, 5)
+        again = asyncio.run(aio.add_repo_async(self.db_name, self.dir_name, "Async"))
+        self.assertIsNone(again, msg="Repository with existing path should not be added.")
+
+    def test_add_repo_async_cancel(self):
+        async def cancelled():
+            job = asyncio.create_task(aio.add_repo_async(
+                self.db_name, self.dir_name, "Async", workers=1,
+                progress=lambda stats: job.cancel()
+            ))
+            with self.assertRaises(asyncio.CancelledError):
+                await job
+        asyncio.run(asyncio.wait_for(cancelled(), timeout=10))
+
+    def test_writer_failure(self):
+        async def write():
+            async with aio.AsyncWriter(self.db_name, batch_size=1, max_queued=2) as writer:
+                for i in range(10):
+                    await writer.add(None, "not a digest", f"/tmp/{i}")
+
+        with self.assertRaises(ValueError, msg="A failed write should be raised, not wait forever."):
+            asyncio.run(asyncio.wait_for(write(), timeout=10))
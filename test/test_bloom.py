@@ -0,0 +1,100 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+import hashlib
+import os
+import shutil
+import sqlite3
+import unittest
+
+from testing_util import random_file_name, create_testing_dir, fill_testing_db
+import pynder.bloom as bloom
+import pynder.db as dbu
+import pynder.stats as perf
+import pynder.task as task
+
+def md5_of(i: int) -> str:
+    return hashlib.md5(str(i).encode()).hexdigest()
+
+class BloomTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dir_name = random_file_name()
+        self.snapshot = random_file_name(ext="bloom")
+        self.db = sqlite3.connect(":memory:")
+        create_testing_dir(root_dir=self.dir_name)
+        fill_testing_db(self.db)
+
+    def tearDown(self) -> None:
+        self.db.close()
+        shutil.rmtree(self.dir_name)
+        if os.path.exists(self.snapshot):
+            os.remove(self.snapshot)
+
+    def test_membership(self):
+        known = bloom.BloomFilter(10000)
+        known.update(md5_of(i) for i in range(10000))
+        self.assertTrue(all(md5_of(i) in known for i in range(10000)), msg="No false negatives allowed.")
+        false_positives = sum(md5_of(i) in known for i in range(10000, 20000))
+        self.assertLess(false_positives, 300, msg="False positive rate far above the configured 1%.")
+        self.assertLess(len(known.bits), 10000 * 2, msg="Should take less than 2 bytes per hash.")
+        self.assertFalse(known.full)
+
+    def test_snapshot(self):
+        known = bloom.known_hashes(self.db, self.snapshot)
+        self.assertTrue(os.path.exists(self.snapshot))
+        self.assertIn("aabbccddeeff0000", known)
+        task.scan_and_add_directory(self.db, self.dir_name, workers=1, known=known)
+        self.assertEqual(known.rows, self.db.execute("SELECT count(*) FROM file;").fetchone()[0])
+        known.save(self.snapshot)
+        loaded = bloom.known_hashes(self.db, self.snapshot)
+        self.assertEqual(loaded.bits, known.bits, msg="A current snapshot should be loaded as is.")
+        # A write the filter does not see makes the snapshot stale
+        self.db.execute("INSERT INTO file (md5) VALUES (?);", (bytes.fromhex(md5_of(-1)), ))
+        rebuilt = bloom.known_hashes(self.db, self.snapshot)
+        self.assertIn(md5_of(-1), rebuilt)
+        with open(self.snapshot, "wb") as f:
+            f.write(b"garbage")
+        self.assertIn(md5_of(-1), bloom.known_hashes(self.db, self.snapshot))
+
+    def test_db_functions(self):
+        known = bloom.from_db(self.db)
+        self.assertTrue(dbu.file_exists(self.db, "aabbccddeeff0000", known))
+        self.assertFalse(dbu.file_exists(self.db, md5_of(1), known))
+        self.assertEqual(dbu.add_file(self.db, md5_of(1), known=known), 1)
+        self.assertIn(md5_of(1), known)
+        self.assertEqual(dbu.files_exist(self.db, [md5_of(1), md5_of(2)], known), {md5_of(1)})
+        self.assertEqual(dbu.files_exist(self.db, [md5_of(3)], known), set())
+
+    def test_bulk_inserts(self):
+        known = bloom.from_db(self.db)
+        perf.reset()
+        perf.enable()
+        try:
+            rows = [(md5_of(i), f"/tmp/new{i}.txt") for i in range(5)] + [("aabbccddeeff0000", "/tmp/old.txt")]
+            self.assertEqual(dbu.add_files(self.db, rows, repository=1, known=known), 5)
+            self.assertEqual(perf.counters["db.bloom_negatives"], 5, msg="New files should not be looked up.")
+            self.assertEqual(perf.counters["db.bloom_known_skipped"], 1, msg="Known files should not be inserted.")
+            dbu.apply_repository_changes(self.db, 1, [], [(md5_of(0), "/tmp/copy.txt"), (md5_of(9), "/tmp/9.txt")],
+                                         known=known)
+            self.assertEqual(perf.counters["db.bloom_negatives"], 6)
+            self.assertEqual(perf.counters["db.bloom_known_skipped"], 2)
+        finally:
+            perf.enable(False)
+            perf.reset()
+        self.assertEqual(known.rows, self.db.execute("SELECT count(*) FROM file;").fetchone()[0])
+        self.assertIn(("aabbccddeeff0000", "/tmp/old.txt"), list(dbu.files_of_repository(self.db, 1)))
+
+if __name__ == '__main__':
+    unittest.main()
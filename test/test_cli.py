@@ -0,0 +1,91 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+import contextlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import unittest
+
+from testing_util import random_file_name, create_testing_dir
+import pynder.cli as cli
+
+class CliTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dir_name = os.path.abspath(random_file_name())
+        self.db_name = random_file_name(ext="sqlite")
+        create_testing_dir(root_dir=self.dir_name)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.dir_name)
+        for ext in ("", "-wal", "-shm", ".bloom"):
+            if os.path.exists(self.db_name + ext):
+                os.remove(self.db_name + ext)
+
+    def run_cli(self, *argv) -> tuple[int, str, str]:
+        out = io.StringIO()
+        err = io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            code = cli.main(["--db", self.db_name, *argv])
+        return code, out.getvalue(), err.getvalue()
+
+    def test_repo_add_and_list(self):
+        code, out, _ = self.run_cli("--format", "json", "repo", "add", self.dir_name, "-d", "test", "--workers", "1")
+        self.assertEqual(code, cli.EXIT_OK)
+        record = json.loads(out)[0]
+        self.assertEqual(record["id"], 1)
+        self.assertEqual(record["files"], 5)
+        code, _, err = self.run_cli("repo", "add", self.dir_name)
+        self.assertEqual(code, cli.EXIT_ERROR, msg="Adding the same path twice should fail.")
+        self.assertIn("already exists", err)
+        code, out, _ = self.run_cli("--format", "ndjson", "ls", "files")
+        self.assertEqual(len([json.loads(line) for line in out.splitlines()]), 4)
+        code, out, _ = self.run_cli("ls", "repos")
+        self.assertEqual(out, f"1\ttest\t{self.dir_name}\n")
+        code, out, _ = self.run_cli("--format", "json", "ls", "dir", "1")
+        self.assertEqual([(entry["type"], entry["name"]) for entry in json.loads(out)],
+                         [("dir", "subdir"), ("file", "file1.txt"), ("file", "file2.jpg"), ("file", "file3.txt"),
+                          ("file", "file4.txt")])
+        code, out, _ = self.run_cli("--format", "ndjson", "dupes", "1", "--workers", "1")
+        self.assertEqual(code, cli.EXIT_OK)
+        self.assertEqual(len(json.loads(out)["paths"]), 2)
+
+    def test_errors(self):
+        code, _, err = self.run_cli("ls", "files")
+        self.assertEqual(code, cli.EXIT_ERROR, msg="Listing a missing DB should fail.")
+        self.assertIn("not found", err)
+        code, _, _ = self.run_cli("scan", os.path.join(self.dir_name, "file1.txt"))
+        self.assertEqual(code, cli.EXIT_ERROR)
+        with self.assertRaises(SystemExit) as e, contextlib.redirect_stderr(io.StringIO()):
+            cli.main(["bogus"])
+        self.assertEqual(e.exception.code, cli.EXIT_USAGE)
+
+    def test_lazy_imports(self):
+        script = (
+            "import sys, pynder.cli as cli; "
+            f"cli.main(['--db', {self.db_name!r}, 'ls', 'files']); "
+            "print(' '.join(sorted(m for m in sys.modules if m.startswith('pynder'))))"
+        )
+        self.run_cli("scan", self.dir_name, "--workers", "1")
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        modules = result.stdout.splitlines()[-1].split()
+        self.assertNotIn("pynder.fs", modules, msg="Listing files should not import the scanning code.")
+        self.assertNotIn("pynder.task", modules)
+
+if __name__ == '__main__':
+    unittest.main()
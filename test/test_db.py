@@ -19,6 +19,21 @@ import unittest
 import testing_util as tu
 import pynder.db as db
 
+# The tables as created by version 0 of the schema, the one before migrations
+LEGACY_SCHEMA = """
+CREATE TABLE "publication" ("id" INTEGER PRIMARY KEY, "isbn" CHAR(13), "title" VARCHAR(128) NOT NULL, "year" INT,
+    "edition" VARCHAR(128), "publisher" VARCHAR(128), "verified" BOOLEAN NOT NULL DEFAULT False);
+CREATE TABLE "file" ("md5" CHAR(32) NOT NULL, "publication" int, PRIMARY KEY("md5"));
+CREATE TABLE "repository" ("id" INTEGER PRIMARY KEY, "description" TEXT, "path" VARCHAR(256));
+CREATE TABLE "repository_file" ("id_repo" INT NOT NULL, "id_file" CHAR(32) NOT NULL, "path" VARCHAR(256),
+    PRIMARY KEY("id_repo","id_file", "path"));
+CREATE TABLE "stat_cache" ("device" INT NOT NULL, "inode" INT NOT NULL, "size" INT NOT NULL,
+    "mtime_ns" INT NOT NULL, "md5" CHAR(32) NOT NULL, PRIMARY KEY("device","inode"));
+CREATE TABLE "file_chunk" ("id_file" CHAR(32) NOT NULL, "offset" INT NOT NULL, "length" INT NOT NULL,
+    "chunk" INTEGER NOT NULL, PRIMARY KEY("id_file","offset"));
+CREATE INDEX "repository_file_path" ON "repository_file"("path");
+"""
+
 class DbTest(unittest.TestCase):
 
     def setUp(self):
@@ -32,6 +47,24 @@ class DbTest(unittest.TestCase):
         self.db.close()
         os.remove(self.db_name)
 
+    def test_connect_profiles(self):
+        path = tu.random_file_name(ext="sqlite")
+        con = db.connect(path, "bulk-ingest")
+        mode = con.execute("PRAGMA journal_mode;").fetchone()[0]
+        self.assertEqual(mode.lower(), "wal")
+        db.create_schema(con)
+        con.close()
+        con = db.connect(path, "read-only")
+        self.assertTrue(db.has_table(con, "file"))
+        with self.assertRaises(sqlite3.OperationalError):
+            con.execute("INSERT INTO file VALUES ('abcd', NULL);")
+        con.close()
+        with self.assertRaises(ValueError):
+            db.connect(path, "turbo")
+        for ext in ("", "-wal", "-shm"):
+            if os.path.exists(path + ext):
+                os.remove(path + ext)
+
     def test_has_schema_empty_db(self):
         self.assertFalse(db.has_schema(
             self.db.cursor()),
@@ -84,6 +117,16 @@ class DbTest(unittest.TestCase):
             msg="Found unexpected row in 'file' table",
         )
 
+    def test_files_exist(self):
+        self.fillDb()
+        md5s = [record[0] for record in tu.TEST_FILE_RECORDS] + ["aabbccddeeff6767"]
+        self.assertEqual(
+            db.files_exist(self.db, md5s),
+            {record[0] for record in tu.TEST_FILE_RECORDS},
+            msg="Only the md5's in the 'file' table should be returned."
+        )
+        self.assertEqual(db.files_exist(self.db, []), set())
+
     def test_repository_by_path_found(self):
         self.fillDb()
         repo = (1, "Temp", "/tmp")
@@ -148,6 +191,7 @@ class DbTest(unittest.TestCase):
                 db.has_table(created, table),
                 msg=f"Table {table} not found after create schema."
             )
+        self.assertEqual(db.schema_version(created), db.SCHEMA_VERSION)
         created.close()
         os.remove(path)
 
@@ -156,7 +200,7 @@ class DbTest(unittest.TestCase):
         md5 = "abcd1234abcd1234"
         path = "/home/user/foo.txt"
         db.add_file(self.db, md5, path)
-        result = self.db.execute(f"SELECT * FROM file WHERE md5='{md5}';")
+        result = self.db.execute("SELECT * FROM file WHERE md5=?;", (bytes.fromhex(md5), ))
         first = result.fetchone()
         self.assertIsNotNone(
             first,
@@ -173,14 +217,14 @@ class DbTest(unittest.TestCase):
         md5 = "abcd1234abcd1234"
         path = "/tmp/foo.txt"
         db.add_file(self.db, md5, None, repository=1, path=path)
-        result = self.db.execute(f"SELECT * FROM file WHERE md5='{md5}';")
+        result = self.db.execute("SELECT * FROM file WHERE md5=?;", (bytes.fromhex(md5), ))
         first = result.fetchone()
         self.assertIsNotNone(
             first,
             msg="Fail to fetch any file record with md5 just inserted."
         )
         result = self.db.execute(
-            f"SELECT * FROM repository_file WHERE id_file='{md5}';")
+            "SELECT id_repo, lower(hex(id_file)), path FROM repository_file_with_path WHERE id_file=?;", (bytes.fromhex(md5), ))
         results = result.fetchall()
         self.assertIn(
             (1, md5, path),
@@ -188,6 +232,17 @@ class DbTest(unittest.TestCase):
             msg="Entry not found in 'repository_file' table."
         )
 
+    def test_add_file_without_path(self):
+        self.fillDb()
+        md5 = "abcd1234abcd1234"
+        self.assertEqual(db.add_file(self.db, md5, repository=1, path=None), 1)
+        self.assertEqual(
+            self.db.execute("SELECT id_repo, path FROM repository_file_with_path WHERE id_file=?;",
+                            (bytes.fromhex(md5), )).fetchall(),
+            [(1, "")],
+            msg="A file added without a path should still be linked to the repository."
+        )
+
     def test_add_file_existing(self):
         self.fillDb()
         md5, publication = tu.TEST_FILE_RECORDS[0]
@@ -197,6 +252,60 @@ class DbTest(unittest.TestCase):
             0,
             msg="Not 0 rows have been created after adding existing tuple."
         )
+        self.assertEqual(db.add_file(self.db, md5, repository=1, path="/tmp/again.txt"), 0)
+        self.assertIn(
+            (md5, "/tmp/again.txt"),
+            list(db.files_of_repository(self.db, 1)),
+            msg="An existing file should still be linked to the repository."
+        )
+
+    def test_add_files_ok(self):
+        self.fillDb()
+        batches = []
+        rows = [
+            ("12345678abcdabcd", "/tmp/a.txt"),
+            ("00000000000000aa", "/tmp/b.txt"),
+            ("00000000000000aa", "/tmp/c.txt"),
+            ("00000000000000bb", "/tmp/d.txt"),
+        ]
+        added = db.add_files(
+            self.db, rows, repository=1, batch_size=3,
+            on_batch=lambda files, links: batches.append((files, links))
+        )
+        self.assertEqual(added, 2, msg="Only the two new md5's should be added to 'file'.")
+        self.assertEqual(batches, [(1, 3), (1, 1)])
+        result = self.db.execute("SELECT id_repo, lower(hex(id_file)), path FROM repository_file_with_path WHERE id_repo=1;")
+        records = result.fetchall()
+        for md5, path in rows:
+            self.assertIn(
+                (1, md5, path),
+                records,
+                msg="Entry not found in 'repository_file' table."
+            )
+        self.assertEqual(db.add_files(self.db, rows, repository=1), 0)
+
+    def test_directories(self):
+        self.fillDb()
+        rows = [
+            ("00000000000000aa", "/tmp/books/a.pdf"),
+            ("00000000000000bb", "/tmp/books/ml/b.pdf"),
+            ("00000000000000cc", "/tmp/booksellers.txt"),
+        ]
+        db.add_files(self.db, rows, repository=2)
+        self.assertEqual(
+            self.db.execute("SELECT count(*) FROM directory WHERE id_repo=2;").fetchone()[0], 4,
+            msg="'/', 'tmp', 'books' and 'ml' should be stored once."
+        )
+        self.assertEqual(db.directory_listing(self.db, 2, "/tmp/books"), (["ml"], [("00000000000000aa", "a.pdf")]))
+        self.assertEqual(db.directory_listing(self.db, 2, "/tmp/missing"), ([], []))
+        self.assertEqual(
+            sorted(db.files_of_repository(self.db, 2, prefix="/tmp/books/")),
+            sorted(rows[:2]),
+            msg="Only the files inside the directory should be returned."
+        )
+        self.assertEqual(list(db.files_of_repository(self.db, 1, prefix="/tmp/books")), [])
+        self.assertEqual(db.directory_id(self.db, 2, "/tmp"), db.directory_id(self.db, 2, "/tmp/"))
+        self.assertIsNone(db.directory_id(self.db, 1, "/tmp"), msg="Each repository has its own directories.")
 
     def test_insert_repo_ok(self):
         self.fillDb()
@@ -230,6 +339,194 @@ class DbTest(unittest.TestCase):
             msg="Retrieved record doesn't match expected values."
         )
 
+    def test_cached_hash_ok(self):
+        self.fillDb()
+        db.cache_hashes(self.db, [((1, 42, 100, 123456789), "12345678abcdabcd")])
+        self.assertEqual(db.cached_hash(self.db, (1, 42, 100, 123456789)), "12345678abcdabcd")
+        self.assertIsNone(
+            db.cached_hash(self.db, (1, 42, 100, 123456790)),
+            msg="Changed mtime should miss the cache."
+        )
+        self.assertIsNone(db.cached_hash(self.db, (1, 43, 100, 123456789)))
+
+    def test_upgrade_schema_ok(self):
+        self.fillDb()
+        self.db.execute("DROP TABLE stat_cache;")
+        db.upgrade_schema(self.db)
+        self.assertTrue(
+            db.has_table(self.db, 'stat_cache'),
+            msg="Table 'stat_cache' not found after upgrade."
+        )
+
+    def test_upgrade_schema_indexes(self):
+        self.fillDb()
+        self.db.execute("DROP INDEX repository_path;")
+        db.upgrade_schema(self.db)
+        plan = self.db.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM repository WHERE path=?;", ("/tmp", )
+        ).fetchall()
+        self.assertIn("repository_path", " ".join(str(row[-1]) for row in plan))
+
+    def test_upgrade_schema_binary_hashes(self):
+        # A DB created before version 1, digests as hex text, 'file' with a rowid and full paths
+        self.db.executescript(LEGACY_SCHEMA)
+        md5s = ["00112233445566778899aabbccddeeff", "ffeeddccbbaa99887766554433221100", "0123456789abcdef0123456789abcdef"]
+        self.db.execute("INSERT INTO repository VALUES (1, 'Temp', '/tmp');")
+        for i, md5 in enumerate(md5s):
+            self.db.execute("INSERT INTO file VALUES (?, NULL);", (md5, ))
+            self.db.execute("INSERT INTO repository_file VALUES (1, ?, ?);", (md5, f"/tmp/file{i}.txt"))
+            self.db.execute("INSERT INTO stat_cache VALUES (1, ?, 10, 20, ?);", (i, md5))
+            self.db.execute("INSERT INTO file_chunk VALUES (?, 0, 10, ?);", (md5, i))
+        self.db.commit()
+        self.assertEqual(db.schema_version(self.db), 0)
+        db.upgrade_schema(self.db, batch_size=2)
+        self.assertEqual(db.schema_version(self.db), db.SCHEMA_VERSION)
+        for table, column in (("file", "md5"), ("repository_file", "id_file"), ("stat_cache", "md5"), ("file_chunk", "id_file")):
+            types = self.db.execute(f"SELECT DISTINCT typeof({column}) FROM {table};").fetchall()
+            self.assertEqual(types, [("blob", )], msg=f"Digests of '{table}' should be converted.")
+        with self.assertRaises(sqlite3.OperationalError, msg="'file' should be a WITHOUT ROWID table."):
+            self.db.execute("SELECT rowid FROM file;")
+        self.assertEqual(db.page_of_files(self.db), sorted(md5s))
+        self.assertEqual(sorted(db.files_of_repository(self.db, 1)), sorted((md5, f"/tmp/file{i}.txt") for i, md5 in enumerate(md5s)))
+        self.assertEqual(db.cached_hash(self.db, (1, 2, 10, 20)), md5s[2])
+        self.assertEqual(db.chunked_files(self.db, md5s), set(md5s))
+        self.assertEqual(db.search(self.db, "file1"), [(1, md5s[1], "/tmp/file1.txt", None)])
+        self.assertEqual(self.db.execute("SELECT count(*) FROM directory;").fetchone()[0], 2,
+                         msg="The paths should share the rows of their directories.")
+        db.add_files(self.db, [(md5s[0], "/tmp/copy.txt")], repository=1)
+        self.assertEqual(len(db.search(self.db, "copy")), 1, msg="Search triggers should be recreated.")
+        self.assertEqual(self.db.execute("PRAGMA foreign_key_check;").fetchall(), [])
+
+    def test_migrate_binary_hashes_twice(self):
+        self.db.executescript(LEGACY_SCHEMA)
+        md5 = "00112233445566778899aabbccddeeff"
+        self.db.execute("INSERT INTO file VALUES (?, NULL);", (md5, ))
+        self.db.execute("INSERT INTO stat_cache VALUES (1, 2, 10, 20, ?);", (md5, ))
+        self.db.commit()
+        db._migrate_binary_hashes(self.db, 2)
+        # As if interrupted after the swaps, before the version was recorded
+        db._migrate_binary_hashes(self.db, 2)
+        self.assertEqual(self.db.execute("SELECT md5 FROM file;").fetchall(), [(bytes.fromhex(md5), )])
+        self.assertEqual(self.db.execute("SELECT md5 FROM stat_cache;").fetchall(), [(bytes.fromhex(md5), )])
+
+    def test_upgrade_schema_twice(self):
+        self.db.executescript(LEGACY_SCHEMA)
+        md5 = "00112233445566778899aabbccddeeff"
+        self.db.execute("INSERT INTO repository VALUES (1, 'Temp', '/tmp');")
+        self.db.execute("INSERT INTO file VALUES (?, NULL);", (md5, ))
+        self.db.execute("INSERT INTO repository_file VALUES (1, ?, '/tmp/a/file.txt');", (md5, ))
+        self.db.commit()
+        db.upgrade_schema(self.db)
+        # As if the last migration was interrupted after its swap, before the version was recorded
+        for version in (1, 0):
+            db.set_schema_version(self.db, version)
+            db.upgrade_schema(self.db)
+            self.assertEqual(db.schema_version(self.db), db.SCHEMA_VERSION)
+            self.assertEqual(list(db.files_of_repository(self.db, 1)), [(md5, "/tmp/a/file.txt")])
+            self.assertEqual(db.search(self.db, "file"), [(1, md5, "/tmp/a/file.txt", None)])
+
+    def test_deferred_search(self):
+        self.fillDb()
+        # The trigger created by version 2, which indexed every row of bulk writes one at a time
+        self.db.executescript("""
+            DROP TRIGGER search_repository_file_insert;
+            CREATE TRIGGER search_repository_file_insert AFTER INSERT ON repository_file BEGIN
+                INSERT INTO search_index (rowid, id_repo, id_file, path, title, publisher, isbn, authors)
+                    SELECT * FROM search_document WHERE id = new.rowid;
+            END;
+        """)
+        db.set_schema_version(self.db, 2)
+        db.upgrade_schema(self.db)
+        trigger, = self.db.execute(
+            "SELECT sql FROM sqlite_master WHERE type='trigger' AND name='search_repository_file_insert';"
+        ).fetchone()
+        self.assertIn("search_deferred", trigger, msg="The upgrade should replace the trigger.")
+        db.add_files(self.db, [("00000000000000aa", "/tmp/bulk/a.txt"), ("00000000000000bb", "/tmp/bulk/b.txt")],
+                     repository=1)
+        db.apply_repository_changes(self.db, 1, ["/tmp/bulk/a.txt"], [("00000000000000cc", "/tmp/bulk/c.txt")])
+        db.add_file(self.db, "00000000000000dd", repository=1, path="/tmp/single/d.txt")
+        self.assertEqual(sorted(path for _, _, path, _ in db.search(self.db, "bulk")),
+                         ["/tmp/bulk/b.txt", "/tmp/bulk/c.txt"])
+        self.assertEqual(len(db.search(self.db, "single")), 1, msg="Single inserts should still be indexed.")
+        self.assertEqual(self.db.execute("SELECT count(*) FROM search_deferred;").fetchone()[0], 0)
+
+    def test_merge_database(self):
+        self.fillDb()
+        path = tu.random_file_name(ext="sqlite")
+        other = sqlite3.connect(path)
+        db.create_schema(other)
+        other.execute("INSERT INTO publication (id, isbn, title) VALUES (1, '9780262035613', 'Deep Learning');")
+        other.execute("INSERT INTO publication (id, isbn, title) VALUES (2, NULL, 'Notes');")
+        other.execute("INSERT INTO author VALUES (1, 'Ian', NULL, 'Goodfellow');")
+        other.execute("INSERT INTO author_pub VALUES (1, 1);")
+        self.db.execute("INSERT INTO publication (id, isbn, title) VALUES (7, '9780262035613', 'Deep Learning');")
+        self.db.commit()
+        repo = db.add_repository(other, "/mnt/books", "Laptop")
+        db.add_file(other, "00000000000000ff", publication=1, repository=repo, path="/mnt/books/dl.pdf")
+        db.add_files(other, [("aabbccddeeff0000", "/mnt/books/copy.txt"), ("00000000000000ee", "/mnt/books/n.txt")],
+                     repository=repo)
+        db.add_files(other, [("0000000000000011", "/elsewhere")])
+        added = db.merge_database(self.db, path)
+        self.assertEqual(added["repository"], 1)
+        self.assertEqual(added["file"], 3, msg="Only the digests missing here should be added.")
+        self.assertEqual(added["repository_file"], 3)
+        self.assertEqual(added["publication"], 1, msg="The publication with the same isbn should be reused.")
+        merged = [repo for repo in db.list_of_repository(self.db) if repo[2] == "/mnt/books"]
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(
+            sorted(db.files_of_repository(self.db, merged[0][0])),
+            [("00000000000000ee", "/mnt/books/n.txt"), ("00000000000000ff", "/mnt/books/dl.pdf"),
+             ("aabbccddeeff0000", "/mnt/books/copy.txt")]
+        )
+        self.assertEqual(
+            self.db.execute("SELECT publication FROM file WHERE md5=?;", (bytes.fromhex("00000000000000ff"), )).fetchone(),
+            (7, )
+        )
+        self.assertEqual(len(db.search(self.db, "goodfellow")), 1)
+        self.assertEqual(sum(db.merge_database(self.db, path).values()), 0, msg="Merging again should add nothing.")
+        db.add_files(other, [("0000000000000022", "/mnt/books/new.txt")], repository=repo)
+        added = db.merge_database(self.db, path)
+        self.assertEqual((added["file"], added["repository_file"]), (1, 1))
+        self.assertEqual(sum(db.merge_database(self.db, path, incremental=False).values()), 0)
+        self.assertEqual(len(db.list_of_repository(self.db)), 3)
+        other.close()
+        os.remove(path)
+
+    def test_search_ok(self):
+        self.fillDb()
+        self.db.execute("INSERT INTO publication (id, title, publisher) VALUES (2, 'Deep Learning', 'MIT Press');")
+        self.db.execute("INSERT INTO author VALUES (1, 'Ian', NULL, 'Goodfellow');")
+        self.db.execute("INSERT INTO author_pub VALUES (1, 2);")
+        db.add_files(self.db, [("aabbccddeeff0000", "/tmp/books/dl_book.pdf")], repository=1)
+        self.assertCountEqual(
+            db.search(self.db, "goodfellow"),
+            [
+                (1, "aabbccddeeff0000", "/tmp/books/dl_book.pdf", "Deep Learning"),
+                (2, "aabbccddeeff0000", "/tmp/file.txt", "Deep Learning"),
+            ]
+        )
+        self.assertEqual(len(db.search(self.db, "books dl")), 1, msg="Path components should be searchable.")
+        self.assertEqual(len(db.search(self.db, "goodfellow", limit=1, offset=1)), 1)
+        self.assertEqual(len(db.search(self.db, 'deep "learn')), 2, msg="Quotes should not break the query.")
+        self.db.execute("UPDATE publication SET title='Shallow Learning' WHERE id=2;")
+        self.assertEqual(len(db.search(self.db, "shallow")), 2)
+        db.apply_repository_changes(self.db, 2, ["/tmp/file.txt"], [])
+        self.assertEqual(len(db.search(self.db, "shallow")), 1)
+        self.db.execute("DELETE FROM author WHERE id=1;")
+        self.assertEqual(db.search(self.db, "goodfellow"), [], msg="Deleted authors should leave the index.")
+        self.db.execute("DELETE FROM publication WHERE id=2;")
+        self.assertEqual(db.search(self.db, "shallow"), [], msg="Deleted publications should leave the index.")
+        self.assertEqual(len(db.search(self.db, "books dl")), 1)
+
+    def test_upgrade_schema_search(self):
+        self.fillDb()
+        self.db.execute("DROP TABLE search_index;")
+        db.upgrade_schema(self.db)
+        self.assertEqual(
+            db.search(self.db, "info"),
+            [(1, "12345678abcdabcd", "C:\\USER\\info.ini", None)]
+        )
+
     def test_list_of_files_ok(self):
         self.fillDb()
         expected = [record[0] for record in tu.TEST_FILE_RECORDS]
@@ -240,6 +537,31 @@ class DbTest(unittest.TestCase):
             msg="Set of obtained and returned md5's are different."
         )
 
+    def test_iter_of_files_ok(self):
+        self.fillDb()
+        expected = [record[0] for record in tu.TEST_FILE_RECORDS]
+        obtained = list(db.iter_of_files(self.db, arraysize=2))
+        self.assertEqual(set(expected), set(obtained))
+        self.assertEqual(db.count_files(self.db), len(expected))
+
+    def test_page_of_files_ok(self):
+        self.fillDb()
+        expected = sorted(record[0] for record in tu.TEST_FILE_RECORDS)
+        first = db.page_of_files(self.db, limit=2)
+        self.assertEqual(first, expected[:2])
+        second = db.page_of_files(self.db, after=first[-1], limit=2)
+        self.assertEqual(second, expected[2:])
+        self.assertEqual(db.page_of_files(self.db, after=second[-1], limit=2), [])
+
+    def test_page_of_repository_ok(self):
+        self.fillDb()
+        first = db.page_of_repository(self.db, limit=1)
+        self.assertEqual(first, [tu.TEST_REPO_RECORDS[0]])
+        second = db.page_of_repository(self.db, after=first[-1][0], limit=1)
+        self.assertEqual(second, [tu.TEST_REPO_RECORDS[1]])
+        self.assertEqual(list(db.iter_of_repository(self.db)), tu.TEST_REPO_RECORDS)
+        self.assertEqual(db.count_repository(self.db), 2)
+
     def test_list_of_repositories_ok(self):
         self.fillDb()
         expected = [(int(t[0]), t[1], t[2]) for t in tu.TEST_REPO_RECORDS]
@@ -1,9 +1,13 @@
+import itertools
 import os
 import random
+import shutil
+import sys
 import unittest
 
-from testing_util import random_file_name
-from pynder.fs import hash_file
+from testing_util import random_file_name, create_testing_dir
+from pynder.fs import (ScanStats, chunk_file, db_for_dir, find_duplicates, hash_file, hash_file_multi, list_directory,
+                       walk_files)
 
 class FsTest(unittest.TestCase):
     def test_hash_file_md5(self):
@@ -14,4 +18,133 @@ class FsTest(unittest.TestCase):
         expected = "ed076287532e86365e841e92bfc50d8c"
         actual = hash_file(file_path)
         self.assertEqual(expected, actual)
-        os.remove(file_path)
\ No newline at end of file
+        os.remove(file_path)
+
+    def test_hash_file_small_buffer(self):
+        file_path = random_file_name()
+        f = open(file_path, "w")
+        f.write("Hello World!")
+        f.close()
+        expected = "ed076287532e86365e841e92bfc50d8c"
+        actual = hash_file(file_path, buffer_size=5)
+        self.assertEqual(expected, actual)
+        os.remove(file_path)
+
+    def test_hash_file_multi(self):
+        file_path = random_file_name()
+        f = open(file_path, "w")
+        f.write("Hello World!")
+        f.close()
+        actual = hash_file_multi(file_path, ("md5", "sha256"), buffer_size=4)
+        self.assertEqual(actual["md5"], "ed076287532e86365e841e92bfc50d8c")
+        self.assertEqual(
+            actual["sha256"],
+            "7f83b1657ff1fc53b92dc18148a1d65dfc2d4b1fa3d677284addd200126d9069"
+        )
+        os.remove(file_path)
+
+    def test_db_for_dir_parallel(self):
+        dir_name = random_file_name()
+        create_testing_dir(root_dir=dir_name)
+        serial = db_for_dir(dir_name, workers=1)
+        parallel = db_for_dir(dir_name, workers=4)
+        self.assertEqual(len(serial), 5)
+        self.assertEqual(set(serial), set(parallel))
+        shutil.rmtree(dir_name)
+
+    def test_walk_files_filters(self):
+        dir_name = random_file_name()
+        create_testing_dir(root_dir=dir_name)
+        os.mkdir(os.path.join(dir_name, ".git"))
+        open(os.path.join(dir_name, ".git", "HEAD"), "w").close()
+        names = lambda entries: sorted(e.name for e in entries)
+        self.assertEqual(
+            names(walk_files(dir_name, skip_dirs=[".git"])),
+            ["file1.txt", "file2.jpg", "file3.txt", "file4.txt", "subfile.txt"]
+        )
+        self.assertEqual(
+            names(walk_files(dir_name, max_depth=0)),
+            ["file1.txt", "file2.jpg", "file3.txt", "file4.txt"]
+        )
+        self.assertEqual(
+            names(walk_files(dir_name, include=["*.txt"], exclude=["subdir", "file1*"], skip_hidden=True)),
+            ["file3.txt", "file4.txt"]
+        )
+        self.assertEqual(names(walk_files(dir_name, include=["subdir/*"])), ["subfile.txt"])
+        shutil.rmtree(dir_name)
+
+    def test_walk_files_deep_tree(self):
+        dir_name = random_file_name()
+        current = dir_name
+        for _ in range(200):
+            current = os.path.join(current, "d")
+        os.makedirs(current)
+        open(os.path.join(current, "leaf.txt"), "w").close()
+        limit = sys.getrecursionlimit()
+        # The tree is deeper than the limit, a recursive walk would overflow
+        sys.setrecursionlimit(100)
+        try:
+            actual = [e.path for e in walk_files(dir_name)]
+        finally:
+            sys.setrecursionlimit(limit)
+        self.assertEqual(actual, [os.path.join(current, "leaf.txt")])
+        shutil.rmtree(dir_name)
+
+    def test_walk_files_errors(self):
+        missing = random_file_name()
+        with self.assertRaises(FileNotFoundError, msg="Listing errors should be raised by default."):
+            list(walk_files(missing))
+        errors = []
+        self.assertEqual(list(walk_files(missing, onerror=errors.append)), [])
+        self.assertEqual([type(e) for e in errors], [FileNotFoundError])
+        with self.assertRaises(FileNotFoundError):
+            list_directory(missing)
+        stats = ScanStats()
+        self.assertEqual(list_directory(missing, onerror=stats.skip), ([], []))
+        self.assertEqual(list(walk_files(missing, onerror=stats.skip)), [])
+        self.assertEqual(stats.skipped, [missing, missing])
+        self.assertTrue(str(stats).endswith(", 2 path(s) skipped"))
+
+    def test_find_duplicates(self):
+        dir_name = random_file_name()
+        create_testing_dir(root_dir=dir_name)
+        stats = ScanStats()
+        groups = list(find_duplicates(walk_files(dir_name), workers=2, stats=stats))
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(
+            sorted(os.path.basename(r.path) for r in groups[0]),
+            ["file1.txt", "file4.txt"]
+        )
+        self.assertEqual(groups[0][0].digest, "ed076287532e86365e841e92bfc50d8c")
+        # file2 and file3 share the size but are told apart by the partial hash
+        self.assertEqual(stats.files, 2, msg="Only the two identical files should be fully hashed.")
+        shutil.rmtree(dir_name)
+
+    def test_hash_file_mmap(self):
+        file_path = random_file_name()
+        content = bytes(range(256)) * 1000
+        with open(file_path, "wb") as f:
+            f.write(content)
+        expected = hash_file(file_path, mmap_threshold=None)
+        self.assertEqual(hash_file(file_path, buffer_size=1000, mmap_threshold=0), expected)
+        self.assertEqual(hash_file_multi(file_path, ("md5", "sha1"), mmap_threshold=1)["md5"], expected)
+        os.remove(file_path)
+
+    def test_chunk_file(self):
+        rng = random.Random(42)
+        content = rng.randbytes(200000)
+        first, second = random_file_name(), random_file_name()
+        with open(first, "wb") as f:
+            f.write(content)
+        with open(second, "wb") as f:
+            f.write(content[:50000] + b"Some inserted text" + content[50000:])
+        chunks = list(chunk_file(first))
+        self.assertEqual(sum(length for _, length, _ in chunks), len(content))
+        self.assertEqual([offset for offset, _, _ in chunks][1:], list(
+            itertools.accumulate(length for _, length, _ in chunks[:-1])
+        ))
+        self.assertTrue(all(length <= 64 * 1024 for _, length, _ in chunks))
+        shared = {h for _, _, h in chunks} & {h for _, _, h in chunk_file(second)}
+        self.assertGreaterEqual(len(shared), len(chunks) - 2, msg="An insertion should only change nearby chunks.")
+        os.remove(first)
+        os.remove(second)
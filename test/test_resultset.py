@@ -0,0 +1,100 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+import hashlib
+import shutil
+import sqlite3
+import unittest
+
+from testing_util import random_file_name, create_testing_dir, fill_testing_db
+import pynder.db as dbu
+import pynder.fs as fs
+from pynder.resultset import ScanResult, ScanResultSet
+
+def md5_of(i: int) -> str:
+    return hashlib.md5(str(i % 3).encode()).hexdigest()
+
+class ScanResultSetTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.results = ScanResultSet()
+        for i in range(10):
+            self.results.append(md5_of(i), f"/data/dir{i % 2}/file{i}.txt", size=i * 100, mtime_ns=i)
+
+    def test_access(self):
+        self.assertEqual(len(self.results), 10)
+        self.assertEqual(self.results[3], ScanResult(md5_of(3), "/data/dir1/file3.txt", 300, 3))
+        self.assertEqual(self.results[-1].path, "/data/dir1/file9.txt")
+        self.assertEqual([result.size for result in self.results], [i * 100 for i in range(10)])
+        self.assertEqual(self.results.tuples()[2], (md5_of(2), "/data/dir0/file2.txt"))
+        self.assertEqual(list(self.results.tuples()), [(md5_of(i), f"/data/dir{i % 2}/file{i}.txt") for i in range(10)])
+        self.assertLess(self.results.nbytes, 10 * (40 + len("/data/dir0/file0.txt")) + 1)
+        with self.assertRaises(IndexError):
+            self.results[10]
+        with self.assertRaises(ValueError, msg="Digests of the wrong size should be refused."):
+            self.results.append("abcd", "/data/short")
+
+    def test_slicing(self):
+        self.assertEqual(list(self.results[2:5]), list(self.results)[2:5])
+        self.assertEqual(list(self.results[::3]), list(self.results)[::3])
+        self.assertEqual(list(self.results[8:2]), [])
+        self.assertEqual(list(self.results.take([-1, 0])), [self.results[9], self.results[0]])
+        with self.assertRaises(IndexError):
+            self.results.take([10])
+        tail = self.results[7:]
+        tail.append(md5_of(0), "/data/new.txt")
+        self.assertEqual(tail[-1].path, "/data/new.txt", msg="A slice should be an independent set.")
+        self.assertEqual(len(self.results), 10)
+
+    def test_groups(self):
+        groups = dict(self.results.groups())
+        self.assertEqual(sorted(groups), sorted({md5_of(i) for i in range(3)}))
+        self.assertEqual(list(groups[md5_of(1)]), [1, 4, 7])
+        ordered = self.results.sorted()
+        self.assertEqual([result.digest for result in ordered], sorted(md5_of(i) for i in range(10)))
+        self.assertEqual(self.results.duplicates()[md5_of(2)], ["/data/dir0/file2.txt", "/data/dir1/file5.txt",
+                                                                "/data/dir0/file8.txt"])
+        self.assertEqual(list(ScanResultSet().groups()), [])
+
+    def test_sort_buckets(self):
+        # Enough rows to bucket them by the leading byte of their digest
+        results = ScanResultSet()
+        for i in range(70000):
+            results.append(hashlib.md5(str(i % 50000).encode()).digest(), f"/f{i}")
+        digests = [results.digest(i) for i in range(len(results))]
+        self.assertEqual(list(results.argsort()), sorted(range(len(results)), key=digests.__getitem__))
+        groups = list(results.groups(min_count=2))
+        self.assertEqual([digest for digest, _ in groups], sorted(digest.hex() for digest in digests[50000:]))
+        self.assertTrue(all(list(group) == [group[0], group[0] + 50000] for _, group in groups))
+
+    def test_insert(self):
+        db = sqlite3.connect(":memory:")
+        fill_testing_db(db)
+        self.assertEqual(self.results.insert(db, repository=1), 3)
+        self.assertEqual(sorted(dbu.files_of_repository(db, 1, prefix="/data")), sorted(self.results.tuples()))
+        db.close()
+
+    def test_db_for_dir(self):
+        dir_name = random_file_name()
+        create_testing_dir(root_dir=dir_name)
+        results = fs.db_for_dir(dir_name, workers=1)
+        self.assertIsInstance(results, ScanResultSet)
+        self.assertEqual(sorted(results.tuples()), sorted(
+            (fs.hash_file(result.path), result.path) for result in results
+        ))
+        self.assertEqual(len(results.duplicates()), 1)
+        shutil.rmtree(dir_name)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import unittest
+
+from testing_util import random_file_name, create_testing_dir
+import pynder.db as dbu
+import pynder.fs as fs
+import pynder.shard as shard
+import pynder.task as task
+
+class ShardTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dir_name = os.path.abspath(random_file_name())
+        self.results = [random_file_name(ext="pyr") for _ in range(3)]
+        self.db = sqlite3.connect(":memory:")
+        create_testing_dir(root_dir=self.dir_name)
+        dbu.create_schema(self.db)
+
+    def tearDown(self) -> None:
+        self.db.close()
+        shutil.rmtree(self.dir_name)
+        for path in self.results:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_write_and_read_results(self):
+        written = shard.scan_shard(self.dir_name, self.results[0], workers=1)
+        self.assertEqual(written, 5)
+        header = shard.read_header(self.results[0])
+        self.assertEqual(header, shard.ShardResults(self.dir_name, 0, 1, 5))
+        records = sorted(shard.read_results(self.results[0]))
+        self.assertEqual(
+            [(record.digest, record.path) for record in records],
+            sorted((fs.hash_file(os.path.join(self.dir_name, path)), path)
+                   for path in ["file1.txt", "file2.jpg", "file3.txt", "file4.txt", os.path.join("subdir", "subfile.txt")])
+        )
+        self.assertEqual(records[0].signature, fs.FileSignature.from_stat(os.stat(os.path.join(self.dir_name, records[0].path))))
+
+    def test_truncated_results(self):
+        shard.scan_shard(self.dir_name, self.results[0], workers=1)
+        with open(self.results[0], "r+b") as f:
+            f.truncate(os.path.getsize(self.results[0]) - 4)
+        with self.assertRaises(ValueError):
+            shard.read_header(self.results[0])
+        with self.assertRaises(ValueError, msg="Merging an incomplete results file should fail."):
+            task.merge_shards(self.db, self.results)
+        self.assertEqual(dbu.count_files(self.db), 0, msg="Nothing should be written if a results file is bad.")
+
+    def test_subtrees(self):
+        shard.scan_shard(self.dir_name, self.results[0], subtrees=["subdir"], workers=1)
+        self.assertEqual([record.path for record in shard.read_results(self.results[0])],
+                         [os.path.join("subdir", "subfile.txt")])
+
+    def test_sharded_workers(self):
+        # Each shard is hashed by its own process, as it would be on separate hosts
+        workers = [
+            subprocess.Popen([sys.executable, "-m", "pynder", "worker", self.dir_name, "--shard", f"{i}/3",
+                              "-o", self.results[i], "--workers", "1"], stdout=subprocess.DEVNULL)
+            for i in range(3)
+        ]
+        for worker in workers:
+            self.assertEqual(worker.wait(), 0)
+        paths = [record.path for result in self.results for record in shard.read_results(result)]
+        self.assertEqual(len(paths), 5, msg="Every file should be in exactly one shard.")
+        self.assertEqual(len(set(paths)), 5)
+        repo = dbu.add_repository(self.db, self.dir_name, "test")
+        added = task.merge_shards(self.db, self.results, repository=repo, cache=True)
+        self.assertEqual(added, 4)
+        self.assertEqual(sorted(path for _, path in dbu.files_of_repository(self.db, repo)),
+                         sorted(os.path.join(self.dir_name, path) for path in paths))
+        self.assertEqual(self.db.execute("SELECT count(*) FROM stat_cache;").fetchone()[0], 5)
+        self.assertEqual(task.merge_shards(self.db, self.results, repository=repo), 0,
+                         msg="Merging the same results again should add nothing.")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+import shutil
+import sqlite3
+import unittest
+
+from testing_util import random_file_name, create_testing_dir, fill_testing_db
+import pynder.stats as perf
+import pynder.task as task
+
+class StatsTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.dir_name = random_file_name()
+        self.db = sqlite3.connect(":memory:")
+        create_testing_dir(root_dir=self.dir_name)
+        fill_testing_db(self.db)
+        perf.reset()
+
+    def tearDown(self) -> None:
+        perf.enable(False)
+        perf.reset()
+        shutil.rmtree(self.dir_name)
+
+    def test_disabled(self):
+        task.scan_and_add_directory(self.db, self.dir_name, workers=1)
+        self.assertEqual(perf.report(), [], msg="Nothing should be collected while disabled.")
+
+    def test_enabled(self):
+        perf.enable()
+        task.scan_and_add_directory(self.db, self.dir_name, workers=2)
+        self.assertEqual(perf.stages["fs.hash_file"].calls, 5)
+        self.assertEqual(perf.stages["fs.walk_files"].items, 5)
+        self.assertEqual(perf.stages["db.add_files"].items, 5)
+        self.assertGreaterEqual(perf.counters["db.commits"], 2)
+        self.assertGreater(perf.stages["fs.hash_file"].percentile(95), 0)
+
+    def test_profile(self):
+        result, report = perf.profile(task.scan_and_add_directory, self.db, self.dir_name, workers=1)
+        self.assertEqual(result, 4)
+        self.assertIn("scan_and_add_directory", report)
@@ -12,13 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==========================================================================
+import hashlib
+import os
+import random
 import shutil
 import sqlite3
 import unittest
+from unittest import mock
 
 from testing_util import random_file_name, create_testing_dir, fill_testing_db
+import pynder.db as dbu
+import pynder.fs as fs
 import pynder.task as task
 
+def unreadable(path: str):
+    """Patches `os.scandir` so that listing `path` fails as if it had no read permission."""
+    scandir = os.scandir
+
+    def fake_scandir(directory):
+        if os.path.abspath(directory) == os.path.abspath(path):
+            raise PermissionError(13, "Permission denied", directory)
+        return scandir(directory)
+    return mock.patch("os.scandir", fake_scandir)
+
 class TaskTest(unittest.TestCase):
     
     def setUp(self) -> None:
@@ -46,3 +62,137 @@ class TaskTest(unittest.TestCase):
             msg="Tuple not found after SELECT",
         )
 
+
+    def test_add_repo_duplicate(self):
+        path, description = "/tmp", "Temp again"
+        self.assertIsNone(
+            task.add_repo(self.db, path, description),
+            msg="Repository with existing path should not be added."
+        )
+        self.assertIsNotNone(task.add_repo(self.db, path, description, allow_duplicate=True))
+
+    def test_scan_and_add_directory(self):
+        reports = []
+        actual = task.scan_and_add_directory(self.db, self.dir_name, workers=2, report=reports.append)
+        # five files, two of them share the same content
+        self.assertEqual(actual, 4)
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0].files, 5)
+        result = self.db.execute(
+            "SELECT * FROM file WHERE md5=?;", (bytes.fromhex("ed076287532e86365e841e92bfc50d8c"), ))
+        self.assertIsNotNone(result.fetchone())
+
+    def test_scan_and_add_directory_condition(self):
+        actual = task.scan_and_add_directory(
+            self.db, self.dir_name, lambda p: p.endswith(".jpg"), workers=1)
+        self.assertEqual(actual, 1)
+
+    def test_scan_and_add_directory_cached(self):
+        task.scan_and_add_directory(self.db, self.dir_name, workers=1)
+        reports = []
+        actual = task.scan_and_add_directory(self.db, self.dir_name, workers=1, report=reports.append)
+        self.assertEqual(actual, 0)
+        self.assertEqual(reports[0].cached, 5, msg="Unchanged files should not be hashed again.")
+        self.assertEqual(reports[0].bytes, 0)
+        task.scan_and_add_directory(self.db, self.dir_name, workers=1, report=reports.append, verify=True)
+        self.assertEqual(reports[1].cached, 0, msg="Verification should hash every file.")
+
+    def test_scan_and_add_directory_resumable(self):
+        repo = dbu.add_repository(self.db, self.dir_name, "Resumable")
+        progress = []
+
+        def interrupt(update):
+            progress.append(update)
+            raise KeyboardInterrupt()
+
+        with self.assertRaises(KeyboardInterrupt):
+            task.scan_and_add_directory(self.db, self.dir_name, workers=1, batch_size=1, repository=repo,
+                                        resumable=True, progress=interrupt)
+        jobs = dbu.unfinished_scan_jobs(self.db)
+        self.assertEqual(len(jobs), 1)
+        job = jobs[0][0]
+        self.assertEqual(progress[0].directories, 1)
+        self.assertEqual(progress[0].pending, 1, msg="The subdirectory should be left to scan.")
+        self.assertIsNotNone(progress[0].eta)
+        reports = []
+        added = task.resume_scan(self.db, job, workers=1, report=reports.append)
+        self.assertEqual(reports[0].files, 1, msg="Only the files of the pending directory should be hashed.")
+        self.assertEqual(added, 1)
+        self.assertEqual(dbu.unfinished_scan_jobs(self.db), [])
+        self.assertEqual(len(list(dbu.files_of_repository(self.db, repo))), 5)
+        self.assertEqual(dbu.scan_job(self.db, job)[6:8], (2, 5))
+        with self.assertRaises(ValueError):
+            task.resume_scan(self.db, job + 1)
+
+    def test_find_duplicates(self):
+        repo = task.add_repo(self.db, os.path.abspath(self.dir_name), "Testing dir")
+        actual = task.find_duplicates(self.db, repo, workers=1)
+        self.assertEqual(list(actual.keys()), ["ed076287532e86365e841e92bfc50d8c"])
+        self.assertEqual(
+            sorted(os.path.basename(p) for p in actual["ed076287532e86365e841e92bfc50d8c"]),
+            ["file1.txt", "file4.txt"]
+        )
+        self.assertIn((repo, 1, 1), dbu.duplicates_by_repository(self.db))
+
+    def test_rescan_repo(self):
+        root = os.path.abspath(self.dir_name)
+        repo = task.add_repo(self.db, root, "Testing dir")
+        summary = task.rescan_repo(self.db, repo, workers=1)
+        self.assertEqual(len(summary.added), 5)
+        with open(os.path.join(root, "file3.txt"), "w") as f:
+            f.write("File 3 changed")
+        os.rename(os.path.join(root, "file2.jpg"), os.path.join(root, "moved.jpg"))
+        os.remove(os.path.join(root, "subdir", "subfile.txt"))
+        with open(os.path.join(root, "subdir", "new.txt"), "w") as f:
+            f.write("New")
+        summary = task.rescan_repo(self.db, repo, workers=1)
+        self.assertEqual(summary.added, [os.path.join(root, "subdir", "new.txt")])
+        self.assertEqual(summary.modified, [os.path.join(root, "file3.txt")])
+        self.assertEqual(summary.moved, [(os.path.join(root, "file2.jpg"), os.path.join(root, "moved.jpg"))])
+        self.assertEqual(summary.deleted, [os.path.join(root, "subdir", "subfile.txt")])
+        self.assertEqual(summary.unchanged, 2)
+        self.assertEqual(summary.stats.bytes, len("File 3 changed") + len("New"), msg="Only changed files should be read.")
+        paths = sorted(path for _, path in dbu.files_of_repository(self.db, repo))
+        self.assertEqual(paths, sorted(os.path.join(root, p) for p in [
+            "file1.txt", "moved.jpg", "file3.txt", "file4.txt", os.path.join("subdir", "new.txt")
+        ]))
+        summary = task.rescan_repo(self.db, repo, subdir=os.path.join(root, "subdir"), workers=1)
+        self.assertEqual(str(summary), "0 added, 0 modified, 0 moved, 0 deleted, 1 unchanged")
+
+    def test_unreadable_directories(self):
+        root = os.path.abspath(self.dir_name)
+        subdir = os.path.join(root, "subdir")
+        repo = task.add_repo(self.db, root, "Testing dir")
+        task.rescan_repo(self.db, repo, workers=1)
+        with unreadable(subdir):
+            summary = task.rescan_repo(self.db, repo, workers=1)
+            self.assertEqual(summary.stats.skipped, [subdir])
+            self.assertEqual(summary.deleted, [], msg="Files of an unreadable directory should be kept.")
+            self.assertEqual(len(list(dbu.files_of_repository(self.db, repo))), 5)
+            reports = []
+            added = task.scan_and_add_directory(self.db, root, workers=1, report=reports.append,
+                                                repository=repo, resumable=True)
+            self.assertEqual(reports[0].skipped, [subdir], msg="Resumed scans should report skipped directories.")
+            self.assertEqual(reports[0].files, 4)
+            self.assertEqual(added, 0)
+            with self.assertRaises(PermissionError, msg="Walks without an error policy should raise."):
+                list(fs.walk_files(root))
+
+    def test_index_chunks(self):
+        root = os.path.abspath(self.dir_name)
+        content = random.Random(7).randbytes(100000)
+        with open(os.path.join(root, "book.pdf"), "wb") as f:
+            f.write(content)
+        with open(os.path.join(root, "book_v2.pdf"), "wb") as f:
+            f.write(content + b"An appended page")
+        repo = task.add_repo(self.db, root, "Testing dir")
+        task.rescan_repo(self.db, repo, workers=1)
+        self.assertEqual(task.index_chunks(self.db, repo, workers=1), 6)
+        self.assertEqual(task.index_chunks(self.db, repo, workers=1), 0, msg="Indexed files should be skipped.")
+        md5 = hashlib.md5(content).hexdigest()
+        similar = dbu.similar_files(self.db, md5, threshold=0.8)
+        self.assertEqual([other for other, _ in similar], [hashlib.md5(content + b"An appended page").hexdigest()])
+        (id_repo, total, reclaimable), = [r for r in dbu.reclaimable_bytes(self.db) if r[0] == repo]
+        self.assertEqual(total, 2 * len(content) + 16 + 12 + 12 + 14 + 14 + 15)
+        self.assertGreaterEqual(reclaimable, len(content) - 64 * 1024 + 12)
+
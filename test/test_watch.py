@@ -0,0 +1,111 @@
+# Copyright 2023 Michele Schimd
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==========================================================================
+import os
+import shutil
+import sqlite3
+import sys
+import unittest
+
+from testing_util import random_file_name, create_testing_dir
+import pynder.db as dbu
+import pynder.task as task
+
+@unittest.skipUnless(sys.platform.startswith("linux"), "inotify is only available on Linux")
+class WatchTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        import pynder.watch as watch
+        self.root = os.path.abspath(random_file_name())
+        create_testing_dir(root_dir=self.root)
+        self.db = sqlite3.connect(":memory:")
+        dbu.create_schema(self.db)
+        self.repo = task.add_repo(self.db, self.root, "Watched")
+        task.rescan_repo(self.db, self.repo, workers=1)
+        self.watcher = watch.Watcher(self.db, debounce=0)
+        self.watcher.watch_repositories()
+
+    def tearDown(self) -> None:
+        self.watcher.close()
+        shutil.rmtree(self.root)
+
+    def paths(self):
+        return sorted(
+            os.path.relpath(path, self.root)
+            for _, path in dbu.files_of_repository(self.db, self.repo)
+        )
+
+    def drain(self):
+        while self.watcher.poll(0.2):
+            pass
+        self.watcher.flush()
+
+    def test_watch_files(self):
+        with open(os.path.join(self.root, "new.txt"), "w") as f:
+            f.write("New content")
+        os.remove(os.path.join(self.root, "file3.txt"))
+        os.rename(os.path.join(self.root, "file2.jpg"), os.path.join(self.root, "subdir", "file2.jpg"))
+        self.drain()
+        self.assertEqual(self.paths(), [
+            "file1.txt", "file4.txt", "new.txt",
+            os.path.join("subdir", "file2.jpg"), os.path.join("subdir", "subfile.txt")
+        ])
+
+    def test_watch_new_directory(self):
+        other = os.path.join(self.root, "other")
+        os.mkdir(other)
+        with open(os.path.join(other, "inner.txt"), "w") as f:
+            f.write("Inner")
+        self.drain()
+        self.assertIn(os.path.join("other", "inner.txt"), self.paths())
+        with open(os.path.join(other, "later.txt"), "w") as f:
+            f.write("Later")
+        self.drain()
+        self.assertIn(os.path.join("other", "later.txt"), self.paths())
+
+    def test_watch_removed_directory(self):
+        shutil.rmtree(os.path.join(self.root, "subdir"))
+        self.drain()
+        self.assertEqual(self.paths(), ["file1.txt", "file2.jpg", "file3.txt", "file4.txt"])
+        self.assertEqual(self.watcher.rescans, set(), msg="Nothing should be left pending.")
+
+    def test_watch_moved_out_directory(self):
+        outside = os.path.abspath(random_file_name())
+        os.rename(os.path.join(self.root, "subdir"), outside)
+        try:
+            self.drain()
+            self.assertEqual(self.paths(), ["file1.txt", "file2.jpg", "file3.txt", "file4.txt"])
+            with open(os.path.join(outside, "ignored.txt"), "w") as f:
+                f.write("Not watched anymore")
+            self.drain()
+            self.assertEqual(len(self.paths()), 4, msg="A moved out directory should not be watched.")
+        finally:
+            shutil.rmtree(outside)
+
+    def test_watch_overflow(self):
+        messages = []
+        self.watcher.report = messages.append
+        self.watcher.debounce = 60
+        subdir = os.path.join(self.root, "subdir")
+        with open(os.path.join(subdir, "new.txt"), "w") as f:
+            f.write("New content")
+        while self.watcher.poll(0.2):
+            pass
+        # As if the kernel dropped the events that followed
+        self.watcher.overflow = True
+        self.watcher.flush()
+        self.assertEqual(messages[0], f"Queue overflow, rescanning {subdir}")
+        self.assertTrue(all(self.root + ":" not in message for message in messages),
+                        msg="Only the directories with events should be rescanned.")
+        self.assertIn(os.path.join("subdir", "new.txt"), self.paths())
@@ -29,7 +29,15 @@ ALL_TABLES = [
     "repository",
     "author_pub",
     "topic_pub",
-    "repository_file"
+    "directory",
+    "repository_file",
+    "stat_cache",
+    "file_chunk",
+    "search_index",
+    "merge_map",
+    "merge_log",
+    "scan_job",
+    "scan_job_directory"
 ]
 
 TEST_FILE_RECORDS = [
@@ -112,6 +120,57 @@ def create_testing_dir(root_dir="./dist", sub_dir="subdir"):
             print("{}{}".format(subindent, f))
 
 
+def create_corpus(root_dir: str, files: int = 1000, size_mu: float = 9.0, size_sigma: float = 1.5,
+                  max_size: int = 16 * 1024 * 1024, depth: int = 3, fanout: int = 4,
+                  duplicate_ratio: float = 0.1, seed: int = 0) -> dict:
+    """Creates a synthetic, reproducible corpus of files for benchmarks.
+
+    Files are spread over a tree of directories `depth` levels deep with
+    `fanout` subdirectories each. Their sizes follow a log-normal
+    distribution (`size_mu` and `size_sigma` are the mean and standard
+    deviation of the logarithm of the size in bytes) capped at `max_size`.
+    A fraction `duplicate_ratio` of the files are copies of earlier ones.
+    The same arguments always produce the same tree and contents.
+
+    Args:
+        root_dir (str): The directory to create, it must not exist.
+        files (int, optional): Number of files. Defaults to 1000.
+        size_mu (float, optional): Mean of the log of the sizes. Defaults to 9.0 (about 8 KiB).
+        size_sigma (float, optional): Standard deviation of the log of the sizes. Defaults to 1.5.
+        max_size (int, optional): Largest size of a file. Defaults to 16 MiB.
+        depth (int, optional): Levels of subdirectories. Defaults to 3.
+        fanout (int, optional): Subdirectories per directory. Defaults to 4.
+        duplicate_ratio (float, optional): Fraction of files duplicating another one. Defaults to 0.1.
+        seed (int, optional): Seed of the random generator. Defaults to 0.
+
+    Returns:
+        dict: The number of files, directories, duplicates and total bytes written.
+    """
+    rng = random.Random(seed)
+    dirs = [root_dir]
+    level = [root_dir]
+    for _ in range(depth):
+        level = [os.path.join(d, f"d{i}") for d in level for i in range(fanout)]
+        dirs.extend(level)
+    for d in dirs:
+        os.makedirs(d)
+    written = []
+    total = 0
+    duplicates = 0
+    for i in range(files):
+        path = os.path.join(rng.choice(dirs), f"f{i}.bin")
+        if written and rng.random() < duplicate_ratio:
+            shutil.copyfile(rng.choice(written), path)
+            duplicates += 1
+        else:
+            size = min(max_size, int(rng.lognormvariate(size_mu, size_sigma)))
+            with open(path, "wb") as f:
+                f.write(rng.randbytes(size))
+            written.append(path)
+        total += os.path.getsize(path)
+    return {"files": files, "directories": len(dirs), "duplicates": duplicates, "bytes": total}
+
+
 def fill_testing_db(db: sqlite3.Connection) -> None:
     """Fills the passed DB with testing data.
     
@@ -123,21 +182,15 @@ def fill_testing_db(db: sqlite3.Connection) -> None:
         db (sqlite3.Connection): The DB to be filled
     """
     dbu.create_schema(db)
-    for file_record in TEST_FILE_RECORDS:
+    for md5, publication in TEST_FILE_RECORDS:
         db.execute(
             "INSERT INTO file VALUES(?, ?);",
-            file_record
+            (bytes.fromhex(md5), publication)
         )
     for repo_record in TEST_REPO_RECORDS:
         db.execute(
             "INSERT INTO repository VALUES(?, ?, ?);",
             repo_record
         )
-    db.executemany(
-        "INSERT INTO repository_file VALUES(?, ?, ?);",
-        [
-            (2, "aabbccddeeff0000", "/tmp/file.txt"),
-            (1, "12345678abcdabcd", "C:\\USER\\info.ini")
-        ]
-    )
-    db.commit()
+    dbu.add_files(db, [("aabbccddeeff0000", "/tmp/file.txt")], repository=2)
+    dbu.add_files(db, [("12345678abcdabcd", "C:\\USER\\info.ini")], repository=1)